@@ -0,0 +1,103 @@
+import gc
+import json
+import argparse
+import tracemalloc
+from datetime import datetime
+
+import helper
+
+# Memory held by a year of meter interval data kept as the raw API JSON
+# objects versus compact MeterInterval records, run from the python_test directory:
+#
+#   python -m benchmarks.bench_interval_memory
+
+
+def get_api_response(meter_id: str, days: int) -> str:
+    # OpenVolt /v1/interval-data style response body for a meter
+
+    start_half_hour = helper.datetime_to_half_hour(datetime(2023, 1, 1))
+
+    return json.dumps(
+        {
+            "data": [
+                {
+                    "start_interval": helper.half_hour_to_datetime(
+                        start_half_hour + index
+                    ).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                    "meter_id": meter_id,
+                    "meter_number": "9999999999999",
+                    "customer_id": "6514153c23e3d1424bf82738",
+                    "consumption": str(40 + index % 30),
+                    "consumption_units": "kWh",
+                }
+                for index in range(days * 48)
+            ]
+        }
+    )
+
+
+def keep_raw(response: str) -> dict:
+    return {
+        helper.trim_timestamp(interval["start_interval"]): interval
+        for interval in json.loads(response)["data"]
+    }
+
+
+def keep_compact(response: str) -> dict:
+    meter_interval_data = {}
+
+    for interval in json.loads(response)["data"]:
+        half_hour = helper.timestamp_to_half_hour(interval["start_interval"])
+        meter_interval_data[
+            helper.half_hour_to_timestamp(half_hour)
+        ] = helper.MeterInterval.from_api(half_hour, interval)
+
+    return meter_interval_data
+
+
+def measure(keep, responses: list) -> int:
+    # Bytes still allocated after loading every meter's intervals
+
+    gc.collect()
+    tracemalloc.start()
+    kept = [keep(response) for response in responses]
+    held_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del kept
+    return held_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Meter interval memory benchmark")
+    parser.add_argument("--meters", type=int, default=20, help="meters to load")
+    parser.add_argument("--days", type=int, default=365, help="days per meter")
+    parser.add_argument(
+        "--scale-to", type=int, default=1000, help="meters to extrapolate to"
+    )
+    args = parser.parse_args()
+
+    responses = [
+        get_api_response(f"{index:024x}", args.days) for index in range(args.meters)
+    ]
+
+    # Warm the timestamp caches so both sides are measured the same way
+    keep_compact(responses[0])
+
+    print(f"{args.meters} meters x {args.days} days of half-hourly intervals")
+
+    results = {}
+    for name, keep in [("raw API JSON", keep_raw), ("MeterInterval", keep_compact)]:
+        results[name] = measure(keep, responses)
+        print(
+            f"  {name:14} {results[name] / args.meters / 2**20:8.2f} MiB per meter,"
+            f" ~{results[name] / args.meters * args.scale_to / 2**30:6.2f} GiB for {args.scale_to} meters"
+        )
+
+    print(
+        f"  reduction      {results['raw API JSON'] / results['MeterInterval']:8.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
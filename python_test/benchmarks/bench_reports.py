@@ -0,0 +1,478 @@
+import os
+import sys
+import csv
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import helper
+import dataset
+import metrics
+import openvolt_reporting
+from cache import LocalCache
+from http_client import HttpClient
+
+# Peak RSS comes from the resource module, which isn't available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# End to end benchmark of generate_reports against a local stand-in for the
+# OpenVolt and Carbon Intensity APIs, replaying the sample January 2023 data
+# streams scaled out to N meters x M months. Run from the python_test directory:
+#
+#   python -m benchmarks.bench_reports --meters 20 --months 3
+#   python -m benchmarks.bench_reports --json results.json
+#   python -m benchmarks.bench_reports --baseline results.json
+#
+# The stand-in server runs in its own process so its memory and CPU don't
+# count against the run being measured
+
+SAMPLE_DATA_PREFIX = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "davem_6514167223e3d1424bf82742",
+)
+
+CUSTOMER_ID = "6514153c23e3d1424bf82738"
+
+# Spread the stand-in meters over a few regions, two outcodes in London
+METER_POSTCODES = ["SW1A 2AB", "M1 1AE", "EH1 1YZ", "CF10 1EP", "BS1 4DJ", "EC1A 1BB"]
+
+# Carbon Intensity region ids of the stand-in outcodes
+POSTCODE_REGION_IDS = {"SW1A": 13, "M1": 3, "EH1": 2, "CF10": 7, "BS1": 11, "EC1A": 13}
+
+# Stand-in API endpoints, requests are counted per endpoint
+API_ROUTES = [
+    "/v1/meters",
+    "/v1/interval-data",
+    "/generation",
+    "/regional",
+    "/intensity/factors",
+]
+
+# Raw Carbon Intensity /intensity/factors values
+EMISSION_FACTORS = {
+    "Biomass": 120,
+    "Coal": 937,
+    "Dutch Imports": 474,
+    "French Imports": 53,
+    "Gas (Combined Cycle)": 394,
+    "Gas (Open Cycle)": 651,
+    "Hydro": 0,
+    "Irish Imports": 458,
+    "Nuclear": 0,
+    "Oil": 935,
+    "Other": 300,
+    "Pumped Storage": 0,
+    "Solar": 0,
+    "Wind": 0,
+}
+
+
+def load_fixtures(prefix: str = SAMPLE_DATA_PREFIX) -> tuple:
+    # Sample consumption and generation mix as lists, one entry per half-hour
+    # from the first sample interval, so they can be replayed cyclically
+
+    with open(f"{prefix}_meter_interval.csv", newline="") as csv_file:
+        consumption = [row[1] for row in csv.reader(csv_file) if row[0][:2] == "20"]
+
+    with open(f"{prefix}_generation_mix.csv", newline="") as csv_file:
+        rows = list(csv.DictReader(csv_file))
+
+    first_half_hour = helper.timestamp_to_half_hour(rows[0]["interval"])
+    generation_mix = [
+        [
+            {"fuel": fuel_type, "perc": float(perc)}
+            for fuel_type, perc in row.items()
+            if fuel_type != "interval"
+        ]
+        for row in rows
+    ]
+
+    return first_half_hour, consumption, generation_mix
+
+
+def meter_id(index: int) -> str:
+    return f"{index:024x}"
+
+
+class ReplayApiHandler(BaseHTTPRequestHandler):
+    # Answers OpenVolt and Carbon Intensity API requests from the fixtures,
+    # counting the requests made on each route
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = next(
+            (route for route in API_ROUTES if url.path.startswith(route)), url.path
+        )
+
+        with self.server.counts_lock:
+            self.server.request_counts[route] = (
+                self.server.request_counts.get(route, 0) + 1
+            )
+
+        if url.path == "/v1/meters":
+            self.send_json(200, {"data": self.server.meters})
+        elif url.path == "/v1/interval-data":
+            self.send_json(200, self.get_meter_intervals(parse_qs(url.query)))
+        elif url.path.startswith("/generation/"):
+            self.send_json(200, self.get_generation_mix(*url.path.split("/")[2:4]))
+        elif url.path.startswith("/regional/postcode/"):
+            self.send_json(200, self.get_postcode_region(url.path.split("/")[3]))
+        elif url.path.startswith("/regional/intensity/"):
+            _, _, _, from_date, to_date, _, region_id = url.path.split("/")
+            self.send_json(
+                200,
+                {
+                    "data": {
+                        "regionid": int(region_id),
+                        **self.get_generation_mix(from_date, to_date),
+                    }
+                },
+            )
+        elif url.path == "/intensity/factors":
+            self.send_json(200, {"data": [EMISSION_FACTORS]})
+        elif url.path == "/stats":
+            with self.server.counts_lock:
+                self.send_json(200, self.server.request_counts)
+        else:
+            self.send_json(404, {"error": {"code": "404 Not Found"}})
+
+    def get_meter_intervals(self, query: dict) -> dict:
+        # Intervals from start_date to end_date inclusive, as OpenVolt does
+
+        index = int(query["meter_id"][0], 16)
+        first_half_hour, consumption, _ = self.server.fixtures
+
+        return {
+            "data": [
+                {
+                    "start_interval": helper.half_hour_to_datetime(half_hour).strftime(
+                        "%Y-%m-%dT%H:%M:%S.000Z"
+                    ),
+                    "meter_id": query["meter_id"][0],
+                    "meter_number": "9999999999999",
+                    "customer_id": CUSTOMER_ID,
+                    "consumption": str(
+                        int(
+                            consumption[
+                                (half_hour - first_half_hour) % len(consumption)
+                            ]
+                        )
+                        + index % 5
+                    ),
+                    "consumption_units": "kWh",
+                }
+                for half_hour in range(
+                    helper.datetime_to_half_hour(
+                        datetime.fromisoformat(query["start_date"][0])
+                    ),
+                    helper.datetime_to_half_hour(
+                        datetime.fromisoformat(query["end_date"][0])
+                    )
+                    + 1,
+                )
+            ]
+        }
+
+    def get_postcode_region(self, postcode_region: str) -> dict:
+        return {
+            "data": [
+                {
+                    "regionid": POSTCODE_REGION_IDS[postcode_region],
+                    "postcode": postcode_region,
+                }
+            ]
+        }
+
+    def get_generation_mix(self, from_date: str, to_date: str) -> dict:
+        # Intervals starting from the from date up to the to date
+
+        first_half_hour, _, generation_mix = self.server.fixtures
+
+        return {
+            "data": [
+                {
+                    "from": helper.half_hour_to_datetime(half_hour).strftime(
+                        "%Y-%m-%dT%H:%MZ"
+                    ),
+                    "to": helper.half_hour_to_datetime(half_hour + 1).strftime(
+                        "%Y-%m-%dT%H:%MZ"
+                    ),
+                    "generationmix": generation_mix[
+                        (half_hour - first_half_hour) % len(generation_mix)
+                    ],
+                }
+                for half_hour in range(
+                    helper.datetime_to_half_hour(datetime.fromisoformat(from_date)),
+                    helper.datetime_to_half_hour(datetime.fromisoformat(to_date)),
+                )
+            ]
+        }
+
+    def send_json(self, status: int, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_fixtures(meters: int, port_queue: multiprocessing.Queue):
+    # Stand-in server process entry point, serves until terminated
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ReplayApiHandler)
+    server.fixtures = load_fixtures()
+    server.meters = [
+        {
+            "_id": meter_id(index),
+            "object": "meter",
+            "address": f"{index} Bench Street, {METER_POSTCODES[index % len(METER_POSTCODES)]}",
+            "status": "active",
+        }
+        for index in range(meters)
+    ]
+    server.request_counts = {}
+    server.counts_lock = threading.Lock()
+
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def peak_rss_mib() -> float:
+    # Process high water mark, ru_maxrss is KiB on Linux but bytes on macOS
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+def get_request_counts(replay_url: str) -> dict:
+    # Requests the stand-in server has answered so far, per route
+
+    stats_client = HttpClient()
+    try:
+        request_counts = stats_client.get(f"{replay_url}/stats").json()
+    finally:
+        stats_client.close()
+
+    request_counts.pop("/stats", None)
+    return request_counts
+
+
+def add_months(date: datetime, months: int) -> datetime:
+    month = date.month - 1 + months
+    return date.replace(year=date.year + month // 12, month=month % 12 + 1)
+
+
+async def run_reports(args, replay_url: str, cache_dir: str) -> dict:
+    start_date = datetime(2023, 1, 1)
+    end_date = add_months(start_date, args.months)
+
+    # Every API request goes to the stand-in server
+    dataset.OPENVOLT_API_URL = replay_url
+    dataset.CARBON_INTENSITY_API_URL = replay_url
+    dataset.USE_REGIONAL_GENERATION_MIX = args.regional
+
+    dataset.set_client(HttpClient(max_concurrent_requests=args.concurrency))
+    dataset.set_cache(
+        LocalCache(os.path.join(cache_dir, "bench_cache.sqlite"))
+        if args.warm_cache
+        else None
+    )
+
+    async def generate_reports():
+        return await openvolt_reporting.generate_reports(
+            start_date,
+            end_date,
+            CUSTOMER_ID,
+            None,
+            os.path.join(cache_dir, "export") if args.output else None,
+            engine=args.engine,
+            stream=args.stream,
+            workers=args.workers,
+        )
+
+    # Fill the local cache first so the measured run is served from it
+    if args.warm_cache:
+        await generate_reports()
+        dataset.set_client(HttpClient(max_concurrent_requests=args.concurrency))
+
+    # Stage timings come from the report's own metrics
+    run_metrics = metrics.Metrics()
+    metrics.set_metrics(run_metrics)
+
+    requests_before = get_request_counts(replay_url)
+    rss_before = peak_rss_mib()
+    start_time = time.perf_counter()
+    try:
+        consumption_source_report_totals, _ = await generate_reports()
+    finally:
+        wall_seconds = time.perf_counter() - start_time
+        metrics.set_metrics(None)
+
+    requests_made = {
+        route: count - requests_before.get(route, 0)
+        for route, count in get_request_counts(replay_url).items()
+        if count > requests_before.get(route, 0)
+    }
+
+    connections = {"opened": 0, "reused": 0}
+    for stats in dataset.get_client().connection_stats().values():
+        connections["opened"] += stats["opened"]
+        connections["reused"] += stats["reused"]
+
+    return {
+        "meters": len(consumption_source_report_totals),
+        "months": args.months,
+        "engine": args.engine,
+        "stream": args.stream,
+        "workers": args.workers,
+        "regional": args.regional,
+        "warm_cache": args.warm_cache,
+        "total_kwh": sum(
+            totals["total"] for totals in consumption_source_report_totals.values()
+        ),
+        "wall_seconds": round(wall_seconds, 4),
+        "stages": {
+            stage: {"calls": timing["calls"], "seconds": timing["busy_seconds"]}
+            for stage, timing in run_metrics.summary()["stages"].items()
+        },
+        "requests": requests_made,
+        "connections": connections,
+        "peak_rss_mib": peak_rss_mib(),
+        "rss_before_mib": rss_before,
+    }
+
+
+def check_baseline(results: dict, baseline_file: str, tolerance: float) -> list:
+    # Regressions beyond the tolerance against an earlier --json result
+
+    with open(baseline_file) as json_file:
+        baseline = json.load(json_file)
+
+    regressions = []
+
+    for measure in ["wall_seconds", "peak_rss_mib"]:
+        if results.get(measure) and baseline.get(measure):
+            if results[measure] > baseline[measure] * (1 + tolerance):
+                regressions.append(
+                    f"{measure} {results[measure]} vs baseline {baseline[measure]}"
+                )
+
+    for route, count in results["requests"].items():
+        if count > baseline.get("requests", {}).get(route, count):
+            regressions.append(
+                f"{route} requests {count} vs baseline {baseline['requests'][route]}"
+            )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate_reports benchmark")
+    parser.add_argument("--meters", type=int, default=10, help="meters to report on")
+    parser.add_argument("--months", type=int, default=1, help="months from Jan 2023")
+    parser.add_argument(
+        "--engine", choices=openvolt_reporting.REPORT_ENGINES, default="dict"
+    )
+    parser.add_argument("--stream", action="store_true", help="streamed reports")
+    parser.add_argument(
+        "--workers", type=int, help="processes the reports are worked out across"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=dataset.MAX_CONCURRENT_REQUESTS,
+        help="maximum API requests in flight",
+    )
+    parser.add_argument(
+        "--regional",
+        action="store_true",
+        help="use the regional generation mix for each meter",
+    )
+    parser.add_argument(
+        "--warm-cache", action="store_true", help="measure a run from a filled cache"
+    )
+    parser.add_argument(
+        "--output", action="store_true", help="include the data stream export"
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="earlier --json results to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="fraction worse than the baseline counted as a regression",
+    )
+    args = parser.parse_args()
+
+    # Keep the benchmark output readable
+    logging.getLogger().setLevel(logging.WARNING)
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve_fixtures, args=(args.meters, port_queue), daemon=True
+    )
+    server.start()
+    replay_url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            results = asyncio.run(run_reports(args, replay_url, cache_dir))
+    finally:
+        server.terminate()
+        server.join()
+
+    print(
+        f"{results['meters']} meters x {results['months']} months,"
+        f" {results['engine']} engine{', streamed' if results['stream'] else ''}"
+        f"{', ' + str(results['workers']) + ' workers' if results['workers'] else ''}"
+        f"{', warm cache' if results['warm_cache'] else ''}"
+    )
+    print(f"  wall time          {results['wall_seconds']:8.3f} s")
+    for stage, timing in results["stages"].items():
+        print(f"  {stage:18} {timing['seconds']:8.3f} s  ({timing['calls']} calls)")
+    for route, count in sorted(results["requests"].items()):
+        print(f"  {route:18} {count:8} requests")
+    print(
+        f"  connections        {results['connections']['opened']:8} opened,"
+        f" {results['connections']['reused']} reused"
+    )
+    if results["peak_rss_mib"] is not None:
+        print(
+            f"  peak RSS           {results['peak_rss_mib']:8.1f} MiB"
+            f" ({results['rss_before_mib']:.1f} MiB before the run)"
+        )
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+    if args.baseline:
+        regressions = check_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"  REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+import helper
+import pipeline
+import carbon_factors
+import openvolt_reporting
+from results_store import ResultsStore
+from benchmarks.bench_reports import CUSTOMER_ID, EMISSION_FACTORS, load_fixtures
+
+# Cold start benchmark of the openvolt_reporting CLI, each run a fresh
+# interpreter as a scheduled job would be. Run from the python_test directory:
+#
+#   python -m benchmarks.bench_startup
+#   python -m benchmarks.bench_startup --check
+#
+# help is --help on its own, stored_run a January report answered from a
+# results store, with both API URLs pointing at a closed port so any request
+# would fail the run
+
+SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "openvolt_reporting.py",
+)
+
+METER_ID = "6514167223e3d1424bf82742"
+
+# Median seconds each run should start and finish within, --check fails if not
+STARTUP_TARGETS = {"help": 0.3, "stored_run": 0.4}
+
+# Modules that should only be loaded by runs that need them
+LAZY_MODULES = ["requests", "numpy", "multiprocessing"]
+
+
+def write_results_store(path: str):
+    # Store the January sample reports for the sample meter
+
+    first_half_hour, consumption, generation_mix = load_fixtures()
+
+    meter_interval_data = {}
+    generation_mix_data = {}
+    for index, kwh in enumerate(consumption):
+        interval = helper.half_hour_to_timestamp(first_half_hour + index)
+        meter_interval_data[interval] = {
+            "consumption": kwh,
+            "consumption_units": "kWh",
+        }
+        generation_mix_data[interval] = {
+            fuel["fuel"]: fuel["perc"] for fuel in generation_mix[index]
+        }
+
+    carbon_emission_factors = carbon_factors.combine_fuel_buckets(
+        {fuel_type.lower(): factor for fuel_type, factor in EMISSION_FACTORS.items()}
+    )
+    consumption_source_report = openvolt_reporting.get_consumption_source_report(
+        meter_interval_data, generation_mix_data
+    )
+    carbon_emissions_report = openvolt_reporting.get_carbon_emissions_report(
+        meter_interval_data, consumption_source_report, carbon_emission_factors
+    )
+
+    window = helper.half_hour_window(datetime(2023, 1, 1), datetime(2023, 2, 1))
+
+    results_store = ResultsStore(path)
+    results_store.put_meters(CUSTOMER_ID, {METER_ID: {"_id": METER_ID}})
+    results_store.put_emissions_intervals(
+        METER_ID,
+        window[0],
+        window[-1],
+        pipeline.report_intervals(consumption_source_report, carbon_emissions_report),
+    )
+    results_store.close()
+
+
+def time_run(command: list, repeat: int) -> list:
+    # Wall time of each run of the command, failing if any run does
+
+    timings = []
+
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        completed = subprocess.run(command, capture_output=True, text=True)
+        timings.append(time.perf_counter() - start_time)
+
+        if completed.returncode != 0:
+            raise RuntimeError(f"{' '.join(command)} failed:\n{completed.stderr}")
+
+    return timings
+
+
+def get_loaded_modules(command: list) -> list:
+    # Which of LAZY_MODULES the command imports, from -X importtime
+
+    completed = subprocess.run(
+        [command[0], "-X", "importtime", *command[1:]], capture_output=True, text=True
+    )
+
+    imported = {
+        line.rsplit("|", 1)[-1].strip()
+        for line in completed.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+    return [module for module in LAZY_MODULES if module in imported]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CLI cold start benchmark")
+    parser.add_argument("--repeat", type=int, default=10, help="runs of each command")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="fail if a median is over its STARTUP_TARGETS seconds",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        results_db = os.path.join(temp_dir, "results.sqlite")
+        write_results_store(results_db)
+
+        closed_url = "http://127.0.0.1:9"
+        commands = {
+            "help": [sys.executable, SCRIPT, "--help"],
+            "stored_run": [
+                sys.executable,
+                SCRIPT,
+                "--results-db",
+                results_db,
+                "--customerid",
+                CUSTOMER_ID,
+                "--startdate",
+                "2023-01-01",
+                "--enddate",
+                "2023-02-01",
+                "--no-cache",
+                "--openvolt-url",
+                closed_url,
+                "--carbon-intensity-url",
+                closed_url,
+            ],
+        }
+
+        # One run first so every timed run finds the bytecode already compiled
+        time_run([sys.executable, "-c", "pass"], args.repeat)
+        interpreter_seconds = min(time_run([sys.executable, "-c", "pass"], args.repeat))
+        print(f"  interpreter        {interpreter_seconds:8.3f} s")
+
+        missed = []
+        for run, command in commands.items():
+            time_run(command, 1)
+            timings = time_run(command, args.repeat)
+            median = statistics.median(timings)
+            loaded = get_loaded_modules(command)
+
+            print(
+                f"  {run:18} {median:8.3f} s median, {min(timings):.3f} s best"
+                f" (target {STARTUP_TARGETS[run]} s)"
+                f", loads {', '.join(loaded) if loaded else 'none of ' + ', '.join(LAZY_MODULES)}"
+            )
+
+            if median > STARTUP_TARGETS[run]:
+                missed.append(run)
+
+    if args.check and missed:
+        for run in missed:
+            print(f"  MISSED TARGET {run}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import timeit
+import argparse
+from datetime import datetime, timedelta
+
+import helper
+
+# Micro-benchmark of the per interval timestamp handling in the dataset filters,
+# run from the python_test directory:
+#
+#   python -m benchmarks.bench_timestamps
+
+
+def get_api_timestamps(days: int) -> list:
+    # A run of half-hourly timestamps in the OpenVolt API format
+
+    start_date = datetime(2023, 1, 1)
+
+    return [
+        (start_date + index * helper.HALF_HOUR).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        for index in range(days * 48)
+    ]
+
+
+def filter_with_strptime(timestamps: list, start_date: datetime, end_date: datetime):
+    # The original approach, three trims and two strptime calls per interval
+
+    data = {}
+
+    for timestamp in timestamps:
+        if (
+            datetime.strptime(helper.trim_timestamp(timestamp), "%Y-%m-%dT%H%M")
+            >= start_date
+            and datetime.strptime(helper.trim_timestamp(timestamp), "%Y-%m-%dT%H%M")
+            <= end_date
+        ):
+            data[helper.trim_timestamp(timestamp)] = timestamp
+
+    return data
+
+
+def filter_with_half_hours(timestamps: list, start_date: datetime, end_date: datetime):
+    # Parse once into a half-hour index used for both the window check and the key
+
+    data = {}
+    window = helper.half_hour_window(start_date, end_date)
+
+    for timestamp in timestamps:
+        half_hour = helper.timestamp_to_half_hour(timestamp)
+        if half_hour in window:
+            data[helper.half_hour_to_timestamp(half_hour)] = timestamp
+
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Timestamp filter micro-benchmark")
+    parser.add_argument("--days", type=int, default=365, help="days of intervals")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats")
+    args = parser.parse_args()
+
+    timestamps = get_api_timestamps(args.days)
+    start_date = datetime(2023, 1, 1)
+    end_date = start_date + timedelta(days=args.days)
+
+    if filter_with_strptime(timestamps, start_date, end_date) != filter_with_half_hours(
+        timestamps, start_date, end_date
+    ):
+        raise AssertionError("Half-hour filter doesn't match the strptime filter")
+
+    print(f"{len(timestamps)} intervals, best of {args.repeat}")
+
+    for name, function in [
+        ("trim_timestamp + strptime", filter_with_strptime),
+        ("half-hour index", filter_with_half_hours),
+    ]:
+        seconds = min(
+            timeit.repeat(
+                lambda: function(timestamps, start_date, end_date),
+                number=1,
+                repeat=args.repeat,
+            )
+        )
+        print(f"  {name:28} {seconds * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+import helper
+
+# Region key used for the national generation mix dataset
+NATIONAL_REGION = ""
+
+
+class LocalCache:
+    # Persistent on-disk cache of API data, backed by a single sqlite file
+    #
+    # Generation mix is held per region and half-hour interval, and meter
+    # interval data per meter and half-hour interval, so a later run only
+    # needs to fetch the intervals it doesn't hold yet. The half-hour ranges
+    # each meter has been fetched for are kept too, so half-hours the meter
+    # never reported (outages, dropped reads) aren't asked for again, anything else
+    # (e.g. emission factors) is held as a JSON value with a stored time so
+    # callers can apply their own time-to-live
+
+    def __init__(self, path: str):
+        self.path = path
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS generation_mix ("
+                " region TEXT NOT NULL,"
+                " interval TEXT NOT NULL,"
+                " mix TEXT NOT NULL,"
+                " PRIMARY KEY (region, interval))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS meter_interval ("
+                " meter_id TEXT NOT NULL,"
+                " interval TEXT NOT NULL,"
+                " data TEXT NOT NULL,"
+                " PRIMARY KEY (meter_id, interval))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS meter_interval_fetched ("
+                " meter_id TEXT NOT NULL,"
+                " first_half_hour INTEGER NOT NULL,"
+                " last_half_hour INTEGER NOT NULL,"
+                " PRIMARY KEY (meter_id, first_half_hour)) WITHOUT ROWID"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cached_values ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " stored_at REAL NOT NULL)"
+            )
+
+        logging.debug(f"Opened local cache {path}")
+
+    def get_generation_mix(
+        self, region: str, first_interval: str, last_interval: str
+    ) -> dict:
+        # Cached generation mix for the region between two intervals inclusive,
+        # interval timestamps sort as strings so a range scan is enough
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT interval, mix FROM generation_mix"
+                " WHERE region = ? AND interval BETWEEN ? AND ?"
+                " ORDER BY interval",
+                (region or NATIONAL_REGION, first_interval, last_interval),
+            ).fetchall()
+
+        return {interval: json.loads(mix) for interval, mix in rows}
+
+    def put_generation_mix(self, region: str, generation_mix_data: dict):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO generation_mix (region, interval, mix)"
+                " VALUES (?, ?, ?)",
+                [
+                    (region or NATIONAL_REGION, interval, json.dumps(mix))
+                    for interval, mix in generation_mix_data.items()
+                ],
+            )
+
+    def get_meter_intervals(
+        self, meter_id: str, first_interval: str, last_interval: str
+    ) -> dict:
+        # Stored interval data for the meter between two intervals inclusive,
+        # as MeterInterval records
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT interval, data FROM meter_interval"
+                " WHERE meter_id = ? AND interval BETWEEN ? AND ?"
+                " ORDER BY interval",
+                (meter_id, first_interval, last_interval),
+            ).fetchall()
+
+        return {
+            interval: helper.MeterInterval.from_api(
+                helper.timestamp_to_half_hour(interval), json.loads(data)
+            )
+            for interval, data in rows
+        }
+
+    def put_meter_intervals(self, meter_id: str, meter_interval_data: dict):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO meter_interval (meter_id, interval, data)"
+                " VALUES (?, ?, ?)",
+                [
+                    (meter_id, interval, json.dumps(data.to_dict()))
+                    for interval, data in meter_interval_data.items()
+                ],
+            )
+
+    def get_meter_fetched_half_hours(
+        self, meter_id: str, first_half_hour: int, last_half_hour: int
+    ) -> set:
+        # Half-hours between the two inclusive the meter has already been
+        # fetched for, whether or not the API had data for them
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT first_half_hour, last_half_hour FROM meter_interval_fetched"
+                " WHERE meter_id = ? AND first_half_hour <= ? AND last_half_hour >= ?",
+                (meter_id, last_half_hour, first_half_hour),
+            ).fetchall()
+
+        return {
+            half_hour
+            for first_fetched, last_fetched in rows
+            for half_hour in range(
+                max(first_fetched, first_half_hour),
+                min(last_fetched, last_half_hour) + 1,
+            )
+        }
+
+    def put_meter_fetched_range(
+        self, meter_id: str, first_half_hour: int, last_half_hour: int
+    ):
+        # Record the meter as fetched between two half-hours inclusive
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO meter_interval_fetched"
+                " (meter_id, first_half_hour, last_half_hour) VALUES (?, ?, ?)"
+                " ON CONFLICT (meter_id, first_half_hour) DO UPDATE SET"
+                " last_half_hour = MAX(last_half_hour, excluded.last_half_hour)",
+                (meter_id, first_half_hour, last_half_hour),
+            )
+
+    def get_value(self, key: str, ttl: float):
+        # Cached value for key, or None if missing or older than ttl seconds
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, stored_at FROM cached_values WHERE key = ?", (key,)
+            ).fetchone()
+
+        if row is None or time.time() - row[1] > ttl:
+            return None
+
+        return json.loads(row[0])
+
+    def put_value(self, key: str, value):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cached_values (key, value, stored_at)"
+                " VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
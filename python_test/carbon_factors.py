@@ -0,0 +1,158 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+# !!!NOTE NationalGrid give emissions factors with Gas and Imports broken down to more granular sources
+# than the generation mix uses. Obviously this would be a discussion interally to agree how to address
+# (or to chase NG for clarity/API update), for now each generation mix fuel is made up from its sub-fuels
+# here, a list of sub-fuels is averaged and a dict of {sub-fuel: weight} is a weighted average
+FUEL_BUCKETS = {
+    "imports": ["dutch imports", "french imports", "irish imports"],
+    "gas": ["gas (combined cycle)", "gas (open cycle)"],
+}
+
+# Generation mix datasets whose interval factors are held at once by a
+# report, enough for the national dataset and every region
+MIX_CACHE_SIZE = 16
+
+
+def load_fuel_buckets(path: str) -> dict:
+    # Fuel buckets from a JSON file laid out as FUEL_BUCKETS, merged over the
+    # defaults so a file only needs the buckets it changes
+
+    with open(path) as fuel_buckets_file:
+        return {**FUEL_BUCKETS, **json.load(fuel_buckets_file)}
+
+
+def combine_fuel_buckets(
+    carbon_emission_factors: dict, fuel_buckets: dict = None
+) -> dict:
+    # Add a factor for each generation mix fuel bucket made up from the
+    # sub-fuel factors mapped to it, a bucket with none of its sub-fuels
+    # in the factors is left as it is
+
+    if fuel_buckets is None:
+        fuel_buckets = FUEL_BUCKETS
+
+    carbon_emission_factors = dict(carbon_emission_factors)
+
+    for fuel_type, sub_fuels in fuel_buckets.items():
+        if not isinstance(sub_fuels, dict):
+            sub_fuels = dict.fromkeys(sub_fuels, 1)
+
+        weights = {
+            sub_fuel: weight
+            for sub_fuel, weight in sub_fuels.items()
+            if sub_fuel in carbon_emission_factors
+        }
+
+        if not weights:
+            continue
+
+        if len(weights) < len(sub_fuels):
+            logging.warning(
+                f"Missing emission factors for {sorted(set(sub_fuels) - set(weights))}, combining {fuel_type} without them"
+            )
+
+        logging.debug(
+            f"Found {len(weights)} {fuel_type} fuel types, combining into {fuel_type} fuel type"
+        )
+
+        combined_emissions = 0
+        for sub_fuel, weight in weights.items():
+            combined_emissions += carbon_emission_factors[sub_fuel] * weight
+
+        carbon_emission_factors[fuel_type] = combined_emissions / sum(weights.values())
+
+    return carbon_emission_factors
+
+
+class CarbonFactorVector:
+    # Carbon emission factors resolved into vectors lined up with the fuel
+    # order of the generation mix, so an interval's emissions come from its
+    # mix percentages and the vector side by side rather than a factor
+    # lookup by name per fuel. Each fuel order (nearly always just the one)
+    # is resolved once, and each generation mix dataset's intervals are
+    # matched to their vector once and shared by every meter using it.
+    # Reads like the factors dict for anything still looking up by name.
+    # Factors kept across reports (the service, batches) hand each report its
+    # own copy through for_report, so interval vectors don't outlive it
+
+    def __init__(self, carbon_emission_factors: dict, fuel_vectors: dict = None):
+        self.carbon_emission_factors = dict(carbon_emission_factors)
+
+        self._lock = threading.Lock()
+        self._vectors = {} if fuel_vectors is None else fuel_vectors
+        self._interval_vectors = OrderedDict()
+
+    def __reduce__(self):
+        # Resolved vectors are cheap to rebuild, only send the factors
+        return (CarbonFactorVector, (self.carbon_emission_factors,))
+
+    def __getitem__(self, fuel_type: str) -> float:
+        return self.carbon_emission_factors[fuel_type]
+
+    def for_report(self) -> "CarbonFactorVector":
+        # The same factors and resolved fuel vectors with no interval vectors
+        # held yet, those it gathers are dropped along with it
+        return CarbonFactorVector(self.carbon_emission_factors, self._vectors)
+
+    def get_fuel_vector(self, fuels) -> tuple:
+        # (fuels, factors in the order of fuels), the same tuples every time
+        fuels = tuple(fuels)
+
+        fuel_vector = self._vectors.get(fuels)
+        if fuel_vector is None:
+            missing = [
+                fuel for fuel in fuels if fuel not in self.carbon_emission_factors
+            ]
+            if missing:
+                raise ValueError(
+                    f"No carbon emission factor for generation mix fuels {missing}, check the fuel buckets"
+                )
+
+            fuel_vector = (
+                fuels,
+                tuple(self.carbon_emission_factors[fuel] for fuel in fuels),
+            )
+            self._vectors[fuels] = fuel_vector
+
+        return fuel_vector
+
+    def get_vector(self, fuels) -> tuple:
+        return self.get_fuel_vector(fuels)[1]
+
+    def get_interval_vectors(self, generation_mix_data: dict) -> dict:
+        # {interval: (fuels, factors)} lined up with each interval's generation
+        # mix, held for the most recent datasets by identity as the same dict
+        # is shared by every meter in a region (see GenerationMixFetcher)
+
+        key = id(generation_mix_data)
+
+        with self._lock:
+            if key in self._interval_vectors:
+                self._interval_vectors.move_to_end(key)
+                return self._interval_vectors[key][1]
+
+        interval_vectors = {
+            interval: self.get_fuel_vector(generation_mix)
+            for interval, generation_mix in generation_mix_data.items()
+        }
+
+        with self._lock:
+            # Keep a reference to the dataset so its id can't be reused while held
+            self._interval_vectors[key] = (generation_mix_data, interval_vectors)
+            while len(self._interval_vectors) > MIX_CACHE_SIZE:
+                self._interval_vectors.popitem(last=False)
+
+        return interval_vectors
+
+
+def get_carbon_factor_vector(carbon_emission_factors) -> CarbonFactorVector:
+    # Factors as a CarbonFactorVector, resolving a plain dict of them once
+
+    if isinstance(carbon_emission_factors, CarbonFactorVector):
+        return carbon_emission_factors
+
+    return CarbonFactorVector(carbon_emission_factors)
@@ -0,0 +1,161 @@
+import logging
+
+import helper
+import carbon_factors
+
+# NumPy is only needed for the columnar engine and npz export, so it's
+# imported the first time one of them is used rather than slowing down every
+# start, the default dict based reports keep working without it installed
+np = None
+
+
+def is_available() -> bool:
+    global np
+
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            return False
+
+    return True
+
+
+def get_interval_columns(meter_interval_data: dict, generation_mix_data: dict) -> tuple:
+    # Join the meter intervals with the generation mix as columns, giving the
+    # interval timestamps, fuel names, kWh consumption per interval and a
+    # (timestamps x fuels) matrix of generation mix percentages
+
+    intervals = list(meter_interval_data)
+
+    # Fuels in the order first seen so reports list them as the dict path does
+    fuels = list(
+        dict.fromkeys(
+            fuel_type
+            for interval in intervals
+            for fuel_type in generation_mix_data[interval]
+        )
+    )
+
+    consumption = np.array(
+        [meter_interval_data[interval]["consumption"] for interval in intervals],
+        dtype=np.float64,
+    )
+    generation_mix = np.array(
+        [
+            [generation_mix_data[interval].get(fuel_type, 0) for fuel_type in fuels]
+            for interval in intervals
+        ],
+        dtype=np.float64,
+    ).reshape(len(intervals), len(fuels))
+
+    return intervals, fuels, consumption, generation_mix
+
+
+def get_reports(
+    meter_interval_data: dict,
+    generation_mix_data: dict,
+    carbon_emission_factors: dict,
+    keep_intervals: bool = True,
+    bucket_totals=None,
+) -> tuple:
+    # Columnar equivalent of get_consumption_source_report, get_carbon_emissions_report
+    # and the totals built in generate_reports, returning all four in that order.
+    # The per interval reports are only built when keep_intervals is set, an
+    # optional pipeline.BucketTotals is filled in from the same pass over the
+    # worked out interval rows
+
+    # Sums run in interval order (cumsum rather than sum) and fuel order so the
+    # floating point results are identical to the dict based reports
+
+    if not is_available():
+        raise ImportError("The columnar engine needs numpy installed")
+
+    for interval in meter_interval_data:
+        if meter_interval_data[interval]["consumption_units"].upper() != "KWH":
+            logging.error(f"Found non-standard consumption unit in interval {interval}")
+            raise ValueError(
+                f"Found non-standard consumption unit in interval {interval}"
+            )
+
+    intervals, fuels, consumption, generation_mix = get_interval_columns(
+        meter_interval_data, generation_mix_data
+    )
+
+    # Interval totals as the parsed consumption (whole kWh kept as int) as the
+    # dict reports total them, kWh per fuel is that percentage of it
+    total_kwh = [helper.parse_consumption(kwh) for kwh in consumption.tolist()]
+    fuel_kwh = (consumption[:, np.newaxis] / 100) * generation_mix
+
+    # gCO2 per fuel from the fuel's emission factor, totalled across fuels
+    factors = np.array(
+        carbon_factors.get_carbon_factor_vector(carbon_emission_factors).get_vector(
+            fuels
+        ),
+        dtype=np.float64,
+    )
+    fuel_emissions = fuel_kwh * factors
+
+    total_emissions = np.zeros(len(intervals))
+    for fuel_index in range(len(fuels)):
+        total_emissions = total_emissions + fuel_emissions[:, fuel_index]
+
+    consumption_source = {}
+    carbon_emissions = {}
+
+    if keep_intervals or bucket_totals is not None:
+        for interval, total, kwh, emissions_total, emissions in zip(
+            intervals,
+            total_kwh,
+            fuel_kwh.tolist(),
+            total_emissions.tolist(),
+            fuel_emissions.tolist(),
+        ):
+            fuel_consumption = dict(zip(fuels, kwh))
+            fuel_emission = dict(zip(fuels, emissions))
+
+            if keep_intervals:
+                consumption_source[interval] = {"total": total, **fuel_consumption}
+                carbon_emissions[interval] = {
+                    "total": emissions_total,
+                    **fuel_emission,
+                }
+
+            if bucket_totals is not None:
+                bucket_totals.add_interval(
+                    interval, total, fuel_consumption, emissions_total, fuel_emission
+                )
+
+    consumption_source_totals = {}
+    carbon_emissions_totals = {}
+
+    if intervals:
+        consumption_source_totals = {
+            "total": sum(total_kwh),
+            **dict(zip(fuels, np.cumsum(fuel_kwh, axis=0)[-1].tolist())),
+        }
+        carbon_emissions_totals = {
+            "total": np.cumsum(total_emissions / 1000)[-1].item(),
+            **dict(zip(fuels, np.cumsum(fuel_emissions / 1000, axis=0)[-1].tolist())),
+        }
+
+    return (
+        consumption_source,
+        carbon_emissions,
+        consumption_source_totals,
+        carbon_emissions_totals,
+    )
+
+
+def write_datastream_npz(file_name: str, half_hours: list, fields: list, columns: list):
+    # Write a datastream as compressed NumPy arrays, one per field plus the
+    # intervals as epoch half-hour indexes under "interval"
+
+    if not is_available():
+        raise ImportError("The npz export format needs numpy installed")
+
+    np.savez_compressed(
+        file_name,
+        interval=np.array(half_hours, dtype=np.int64),
+        **{field: np.asarray(column) for field, column in zip(fields, columns)},
+    )
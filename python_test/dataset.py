@@ -1,42 +1,373 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import helper
 import logging
 import json
-import requests as requests
+import asyncio
+import time
+from urllib.parse import urlsplit
+import metrics
+import diagnostics
+import carbon_factors
+from cache import LocalCache
 
 OPENVOLT_API_KEY = "test-Z9EB05N-07FMA5B-PYFEE46-X4ECYAR"
 
+# Upper limit on REST requests in flight at once across all callers
+MAX_CONCURRENT_REQUESTS = 8
+
+# API base URLs, e.g. pointed at a local stand-in server for testing
+OPENVOLT_API_URL = "https://api.openvolt.com"
+CARBON_INTENSITY_API_URL = "https://api.carbonintensity.org.uk"
+
+# Unless regional generation mix is switched on every meter is given the national
+# dataset. Regional data is fetched per Carbon Intensity region, the meter's
+# postcode outcode is looked up to find its region once and kept for
+# POSTCODE_REGION_CACHE_TTL. If a region's data can't be had the national dataset
+# is used instead, unless REGIONAL_FALLBACK_TO_NATIONAL is switched off
+USE_REGIONAL_GENERATION_MIX = False
+REGIONAL_FALLBACK_TO_NATIONAL = True
+POSTCODE_REGION_CACHE_TTL = timedelta(days=30)
+
+# Extra headers sent with every Carbon Intensity request, e.g. authorisation
+CARBON_INTENSITY_HEADERS = {}
+
+# Longest window of intervals asked for in a single request to each API, longer
+# ranges are split up and fetched in parallel (Carbon Intensity caps its ranges)
+METER_INTERVAL_MAX_WINDOW = timedelta(days=31)
+GENERATION_MIX_MAX_WINDOW = timedelta(days=14)
+
+# Times a chunk of a longer range is fetched again, on its own, once its
+# requests have run out of retries, before the whole fetch gives up
+CHUNK_RETRIES = 2
+
+# How meter intervals with no generation mix from NationalGrid are handled
+#   fail          - dataset validation fails and so does the report
+#   interpolate   - each fuel's share is interpolated between the intervals either side
+#   carry_forward - the last known mix carries on through the gap
+#   refetch       - just the missing intervals are fetched again, failing if still missing
+GAP_POLICIES = ["fail", "interpolate", "carry_forward", "refetch"]
+GAP_POLICY = "fail"
+
+# Carbon Intensity emission factors rarely change so only refresh them daily
+EMISSION_FACTORS_CACHE_TTL = timedelta(days=1)
+
+# Shared client so every API call reuses the same per-host connection pools.
+# http_client (and with it requests) is only imported when the client is first
+# needed, so runs making no API requests at all start quicker
+_client = None
+
+# Options the shared client is created with, see set_client_options
+_client_options = {}
+
+# Optional on-disk cache of published NationalGrid data and
+# past meter intervals, off unless set
+_cache = None
+
+# Carbon Intensity region id of each postcode outcode looked up so far
+_postcode_region_ids = {}
+
+# Outcodes and regions already logged as falling back to the national dataset
+_national_fallbacks_logged = set()
+
+
+class RestRequestError(ValueError):
+    # Non-200 response from an API, keeping the status code so callers can
+    # tell transient failures from ones that will never succeed
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _is_transient(error: Exception) -> bool:
+    import requests
+    from http_client import RETRY_STATUS_CODES
+
+    if isinstance(error, RestRequestError):
+        return error.status_code in RETRY_STATUS_CODES
+
+    return isinstance(
+        error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    )
+
+
+def _regional_errors() -> tuple:
+    # Errors a regional request can fail with that the national dataset is
+    # used for instead, bad responses as well as the API being unreachable
+    import requests
+
+    return (
+        ValueError,
+        IndexError,
+        KeyError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+    )
+
+
+def _log_national_fallback(key: str, message: str):
+    # Log falling back to the national dataset once per outcode or region
+    # rather than for every meter and chunk
+
+    if key not in _national_fallbacks_logged:
+        _national_fallbacks_logged.add(key)
+        logging.error(message)
+
+
+def get_client() -> "HttpClient":
+    # Return the shared client, creating it on first use
+
+    global _client
+
+    if _client is None:
+        from http_client import HttpClient
+
+        _client = HttpClient(
+            **{"max_concurrent_requests": MAX_CONCURRENT_REQUESTS, **_client_options}
+        )
+
+    return _client
+
+
+def set_client_options(**options):
+    # Set the HttpClient options (pool size, timeouts...) for the shared client,
+    # which is created with them when it's next needed rather than now
+
+    global _client_options
+
+    _client_options = options
+    set_client(None)
+
+
+def get_connection_stats() -> dict:
+    # Connection stats of the shared client, without creating one to ask
+
+    if _client is None:
+        return {}
+
+    return _client.connection_stats()
+
+
+def set_client(client: "HttpClient"):
+    # Replace the shared client, e.g. with different pool size or timeouts
+
+    global _client
+
+    if _client is not None and _client is not client:
+        _client.close()
+
+    _client = client
+
+
+def set_max_concurrent_requests(limit: int):
+    get_client().set_max_concurrent_requests(limit)
+
+
+def get_cache() -> LocalCache:
+    return _cache
+
+
+def set_cache(cache: LocalCache):
+    # Set the on-disk cache used for API data, None switches it off
+
+    global _cache
+
+    if _cache is not None and _cache is not cache:
+        _cache.close()
+
+    _cache = cache
+
+
+def _get_missing_ranges(
+    intervals: list,
+    held_data: dict,
+    max_window: timedelta,
+    fetched_half_hours: set = frozenset(),
+) -> list:
+    # Split the intervals not in held_data (nor already fetched and found to
+    # have no data) into (first, last) ranges no longer than max_window, the
+    # ranges never overlap so every interval is in just one
+
+    missing_intervals = [
+        half_hour
+        for half_hour in intervals
+        if half_hour not in fetched_half_hours
+        and helper.half_hour_to_timestamp(half_hour) not in held_data
+    ]
+
+    return [
+        window
+        for first_interval, last_interval in helper.contiguous_intervals(
+            missing_intervals
+        )
+        for window in helper.split_intervals(first_interval, last_interval, max_window)
+    ]
+
+
+async def _fetch_ranges(ranges: list, fetch_range, store_range=None) -> list:
+    # Fetch every (first, last) half-hour range at once with fetch_range(first, last),
+    # passing each result to store_range as soon as it arrives. A range that fails
+    # with a transient error is fetched again on its own, and if one fails for
+    # good the rest still finish and are stored before the error is raised, so
+    # with a cache a later run only has to fetch what's left
+
+    async def fetch(first_interval: int, last_interval: int):
+        attempt = 0
+
+        while True:
+            try:
+                fetched = await fetch_range(first_interval, last_interval)
+                break
+            except Exception as e:
+                if attempt >= CHUNK_RETRIES or not _is_transient(e):
+                    raise
+                metrics.count("chunk_retries")
+                diagnostics.log_event(
+                    logging.WARNING,
+                    "chunk_retry",
+                    first_interval=lambda: helper.half_hour_to_timestamp(
+                        first_interval
+                    ),
+                    last_interval=lambda: helper.half_hour_to_timestamp(last_interval),
+                    error=lambda: str(e),
+                )
+                await asyncio.sleep(get_client().retry_delay(attempt))
+                attempt += 1
+
+        if store_range:
+            store_range(fetched)
+
+        return fetched
+
+    fetched_ranges = await asyncio.gather(
+        *(
+            fetch(first_interval, last_interval)
+            for first_interval, last_interval in ranges
+        ),
+        return_exceptions=True,
+    )
+
+    for fetched in fetched_ranges:
+        if isinstance(fetched, BaseException):
+            raise fetched
+
+    return fetched_ranges
+
+
+def _is_finalised(timestamp: str) -> bool:
+    # Only half-hours that have fully passed (UTC) are safe to cache for good
+
+    return helper.timestamp_to_half_hour(timestamp) < helper.datetime_to_half_hour(
+        datetime.now(timezone.utc).replace(tzinfo=None)
+    )
+
 
 async def get_rest_req(
-    api_url: str, headers: dict = {}, params: dict = {}, validation: str = None
+    api_url: str,
+    headers: dict = None,
+    params: dict = None,
+    validation: str = None,
+    client: "HttpClient" = None,
 ) -> dict:
     # Function to standardise handling Rest API get requests
 
+    import requests
+    from http_client import RETRY_STATUS_CODES
+
+    # Copy so concurrent requests never share (and mutate) the same headers dict
+    headers = dict(headers or {})
     headers["Accept"] = "application/json"
 
+    client = client or get_client()
+    url = urlsplit(api_url)
+    response = None
+    attempt = 0
+    start_time = time.perf_counter()
+
     try:
-        # Invoke the requests call to make the API request
-        response = requests.get(api_url, headers=headers, params=params)
+        # Invoke the requests call to make the API request through the pooled client,
+        # trying again after a delay on throttling, server errors or lost connections
+        while True:
+            try:
+                response = await client.async_get(
+                    api_url, headers=headers, params=params
+                )
+                retryable = response.status_code in RETRY_STATUS_CODES
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ):
+                if attempt >= client.retries:
+                    raise
+                response = None
+                retryable = True
+
+            if not retryable or attempt >= client.retries:
+                break
+
+            delay = client.retry_delay(attempt, response, api_url)
+            diagnostics.log_event(
+                logging.WARNING,
+                "request_retry",
+                url=f"{url.netloc}{url.path}",
+                status=response.status_code if response is not None else None,
+                delay=round(delay, 2),
+                attempt=attempt + 1,
+                retries=client.retries,
+            )
+            attempt += 1
+            await asyncio.sleep(delay)
 
         # If all ok send back the response otherwise log it and send back None
         if response.status_code == 200:
-            if validation and validation in response.json():
-                return response.json()
+            response_json = response.json()
+            if validation and validation in response_json:
+                return response_json
             else:
                 raise AssertionError(
                     f" API Response validation error, '{validation}' missing"
                 )
         else:
-            raise ValueError(
-                f"Error making REST request: {response.text}, url: {api_url}, headers: {headers}, status code: {response.status_code}"
+            # Headers (the API key) and the response body stay out of the error,
+            # the start of the body is only logged with diagnostics on
+            diagnostics.log_event(
+                logging.DEBUG,
+                "request_error_response",
+                url=f"{url.netloc}{url.path}",
+                status=response.status_code,
+                response=lambda: response.text,
+            )
+            raise RestRequestError(
+                f"Error making REST request to {url.netloc}{url.path}, status code: {response.status_code}",
+                response.status_code,
             )
 
     except requests.exceptions.ConnectionError as e:
-        logging.error(f"Error creating REST API Connection {e}")
+        diagnostics.log_event(
+            logging.ERROR,
+            "request_connection_error",
+            url=f"{url.netloc}{url.path}",
+            error=lambda: type(e).__name__,
+        )
         raise (e)
     except Exception as e:
-        logging.error(f"Error while completing REST API request {e}")
+        diagnostics.log_event(
+            logging.ERROR,
+            "request_failed",
+            url=f"{url.netloc}{url.path}",
+            error=lambda: str(e),
+        )
         raise (e)
+    finally:
+        # Latency includes any wait for a free request slot
+        metrics.record_request(
+            f"{url.scheme}://{url.netloc}",
+            url.path,
+            response.status_code if response is not None else None,
+            time.perf_counter() - start_time,
+            len(response.content) if response is not None else 0,
+            retries=attempt,
+        )
 
 
 async def get_meters(
@@ -58,7 +389,7 @@ async def get_meters(
     if status:
         params["status"] = status
 
-    api_url = f"https://api.openvolt.com/v1/meters"
+    api_url = f"{OPENVOLT_API_URL}/v1/meters"
     headers = {"x-api-key": OPENVOLT_API_KEY}
 
     meters_json = await get_rest_req(
@@ -71,14 +402,15 @@ async def get_meters(
     return meters
 
 
-async def get_meter_interval_data(
+async def _get_meter_interval_range(
     start_date: datetime, end_date: datetime, meter_id: str
 ) -> dict:
-    # Get interval data for specific meter
+    # Get interval data for specific meter, for the intervals starting
+    # from start_date to end_date inclusive
 
     meter_interval_data = {}
 
-    api_url = f"https://api.openvolt.com/v1/interval-data?granularity=hh&meter_id={meter_id}&start_date={start_date.isoformat()}&end_date={end_date.isoformat()}"
+    api_url = f"{OPENVOLT_API_URL}/v1/interval-data?granularity=hh&meter_id={meter_id}&start_date={start_date.isoformat()}&end_date={end_date.isoformat()}"
     headers = {"x-api-key": OPENVOLT_API_KEY}
 
     meter_interval_data_json = await get_rest_req(
@@ -86,145 +418,476 @@ async def get_meter_interval_data(
     )
 
     # Validate intervals returned are actually within our time window and standardise the timestamp as interval identifier
+    window = helper.half_hour_window(start_date, end_date)
+    out_of_window = []
+
     for interval in meter_interval_data_json["data"]:
-        if (
-            datetime.strptime(
-                helper.trim_timestamp(interval["start_interval"]), "%Y-%m-%dT%H%M"
-            )
-            >= start_date
-            and datetime.strptime(
-                helper.trim_timestamp(interval["start_interval"]), "%Y-%m-%dT%H%M"
-            )
-            <= end_date
-        ):
+        half_hour = helper.timestamp_to_half_hour(interval["start_interval"])
+        if half_hour in window:
             meter_interval_data[
-                helper.trim_timestamp(interval["start_interval"])
-            ] = interval
+                helper.half_hour_to_timestamp(half_hour)
+            ] = helper.MeterInterval.from_api(half_hour, interval)
         else:
-            logging.warn("Meter Interval falls outside time scope")
-            logging.warn(interval)
+            out_of_window.append(half_hour)
+
+    # Counted rather than logged one by one
+    if out_of_window:
+        metrics.count("meter_intervals_out_of_window", len(out_of_window))
+        diagnostics.log_event(
+            logging.WARNING,
+            "meter_intervals_out_of_window",
+            meter_id=meter_id,
+            count=len(out_of_window),
+            first=lambda: helper.half_hour_to_timestamp(min(out_of_window)),
+            last=lambda: helper.half_hour_to_timestamp(max(out_of_window)),
+        )
 
     return meter_interval_data
 
 
-async def get_generation_mix_data(
-    start_date: datetime,
-    end_date: datetime,
-    postcode_region: str = None,
+async def get_meter_interval_data(
+    start_date: datetime, end_date: datetime, meter_id: str
 ) -> dict:
-    # Generate the interval data for fuel used to produce power from the National Grid
+    # Get interval data for specific meter, as compact MeterInterval records
 
-    generation_mix_data = {}
+    meter_interval_data = {}
 
-    # Increase our end time by 30 mins including additional interval to sync with OpenVolt intervals
-    end_date += timedelta(minutes=30)
+    intervals = helper.half_hour_window(start_date, end_date)
+    if not intervals:
+        return meter_interval_data
 
-    # Use the postcode from the meter address to get regional data
+    # Start from the intervals already held locally for this meter
+    # and only go to the API for the ones we're missing, half-hours already
+    # fetched that the meter has no data for aren't asked for again
+
+    fetched_half_hours = frozenset()
+
+    cache = get_cache()
+    if cache:
+        meter_interval_data = cache.get_meter_intervals(
+            meter_id,
+            helper.half_hour_to_timestamp(intervals[0]),
+            helper.half_hour_to_timestamp(intervals[-1]),
+        )
+        fetched_half_hours = cache.get_meter_fetched_half_hours(
+            meter_id, intervals[0], intervals[-1]
+        )
+        diagnostics.log_event(
+            logging.DEBUG,
+            "meter_intervals_cached",
+            meter_id=meter_id,
+            held=len(meter_interval_data),
+            intervals=len(intervals),
+        )
+
+    # Fetch the missing intervals in windows OpenVolt can serve comfortably,
+    # all at once with the client capping how many are actually in flight
+
+    missing_ranges = _get_missing_ranges(
+        intervals, meter_interval_data, METER_INTERVAL_MAX_WINDOW, fetched_half_hours
+    )
+
+    async def fetch_range(first_interval: int, last_interval: int) -> tuple:
+        fetched_meter_interval_data = await _get_meter_interval_range(
+            helper.half_hour_to_datetime(first_interval),
+            helper.half_hour_to_datetime(last_interval),
+            meter_id,
+        )
+        return first_interval, last_interval, fetched_meter_interval_data
+
+    def store_range(fetched_range: tuple):
+        first_interval, last_interval, fetched_meter_interval_data = fetched_range
+
+        if cache:
+            cache.put_meter_intervals(
+                meter_id,
+                {
+                    timestamp: interval
+                    for timestamp, interval in fetched_meter_interval_data.items()
+                    if _is_finalised(timestamp)
+                },
+            )
+
+            # The part of the range that has fully passed is final, whatever
+            # the API did or didn't have for it
+            last_final = min(
+                last_interval,
+                helper.datetime_to_half_hour(
+                    datetime.now(timezone.utc).replace(tzinfo=None)
+                )
+                - 1,
+            )
+            if last_final >= first_interval:
+                cache.put_meter_fetched_range(meter_id, first_interval, last_final)
+
+    fetched_ranges = await _fetch_ranges(missing_ranges, fetch_range, store_range)
+
+    for _, _, fetched_meter_interval_data in fetched_ranges:
+        meter_interval_data.update(fetched_meter_interval_data)
+
+    return {
+        timestamp: meter_interval_data[timestamp]
+        for timestamp in sorted(meter_interval_data)
+    }
+
+
+async def get_postcode_region_id(postcode_region: str) -> int:
+    # Carbon Intensity region id for a postcode outcode, looked up once per
+    # outcode (and kept in the local cache) so meters in different outcodes
+    # of the same region share its generation mix
+
+    if postcode_region in _postcode_region_ids:
+        return _postcode_region_ids[postcode_region]
+
+    api_url = f"{CARBON_INTENSITY_API_URL}/regional/postcode/{postcode_region}"
+
+    cache = get_cache()
+    region_json = None
+
+    if cache:
+        region_json = cache.get_value(
+            api_url, POSTCODE_REGION_CACHE_TTL.total_seconds()
+        )
+
+    if region_json is None:
+        region_json = await get_rest_req(
+            api_url=api_url, headers=CARBON_INTENSITY_HEADERS, validation="data"
+        )
+        if cache:
+            cache.put_value(api_url, region_json)
 
-    postcode_region = None
+    _postcode_region_ids[postcode_region] = region_json["data"][0]["regionid"]
 
-    # !!!NOTE the regional data by postcode seems to require authorisation (Which I don't have)
-    # Spec says it should work unauthorised...but to be fair it's in beta so it is what it is
-    # Catered for a retry using national dataset, this is ok for testing but should really have
-    # some sort of flag so moving to national dataset isn't implicit
+    return _postcode_region_ids[postcode_region]
 
-    if postcode_region:
-        api_url = f"https://api.carbonintensity.org.uk/regional/{start_date.isoformat()}/{end_date.isoformat()}/postcode/{postcode_region}"
+
+async def _get_region_id(postcode_region: str) -> int:
+    # Region id whose generation mix a meter with this outcode uses, None for
+    # the national dataset
+
+    if not USE_REGIONAL_GENERATION_MIX or not postcode_region:
+        return None
+
+    try:
+        return await get_postcode_region_id(postcode_region)
+    except _regional_errors() as e:
+        if not REGIONAL_FALLBACK_TO_NATIONAL:
+            raise
+
+        _log_national_fallback(
+            f"outcode {postcode_region}",
+            f"Couldn't find the Carbon Intensity region for {postcode_region}, using national stats: {e}",
+        )
+        return None
+
+
+def _get_cache_region(region_id: int) -> str:
+    # Local cache region key for a region id, None for the national dataset
+    return str(region_id) if region_id else None
+
+
+async def _get_generation_mix_range(
+    start_date: datetime, end_date: datetime, region_id: int = None
+) -> tuple:
+    # Fetch NationalGrid generation mix for the intervals starting from start_date
+    # to end_date inclusive, returning the data and the region it came from
+
+    generation_mix_data = {}
+
+    # Increase our end time by 30 mins including additional interval to sync with OpenVolt intervals
+    api_end_date = end_date + helper.HALF_HOUR
+
+    national_api_url = f"{CARBON_INTENSITY_API_URL}/generation/{start_date.isoformat()}/{api_end_date.isoformat()}"
+
+    if region_id:
+        api_url = f"{CARBON_INTENSITY_API_URL}/regional/intensity/{start_date.isoformat()}/{api_end_date.isoformat()}/regionid/{region_id}"
     else:
-        api_url = f"https://api.carbonintensity.org.uk/generation/{start_date.isoformat()}/{end_date.isoformat()}"
+        api_url = national_api_url
 
     try:
         generation_mix_data_json = await get_rest_req(
-            api_url=api_url, validation="data"
+            api_url=api_url, headers=CARBON_INTENSITY_HEADERS, validation="data"
         )
-    except ValueError as e:
-        # If regional by postcode dataset fails retry using the national dataset
+    except _regional_errors() as e:
+        # If the regional dataset fails retry using the national dataset, if allowed
 
-        if postcode_region:
-            logging.error(
-                "Couldn't retrieve National Grid data for local region, retrying using national stats"
+        if region_id and REGIONAL_FALLBACK_TO_NATIONAL:
+            _log_national_fallback(
+                f"region {region_id}",
+                f"Couldn't retrieve National Grid data for region {region_id}, retrying using national stats: {e}",
             )
-            api_url = f"https://api.carbonintensity.org.uk/generation/{start_date.isoformat()}/{end_date.isoformat()}"
+            region_id = None
             generation_mix_data_json = await get_rest_req(
-                api_url=api_url, validation="data"
+                api_url=national_api_url,
+                headers=CARBON_INTENSITY_HEADERS,
+                validation="data",
             )
         else:
             raise (e)
     except Exception as e:
         raise (e)
 
+    # Regional responses hold the intervals inside the region's details
+    generation_mix_intervals = generation_mix_data_json["data"]
+    if isinstance(generation_mix_intervals, dict):
+        generation_mix_intervals = generation_mix_intervals["data"]
+
     # Validate intervals returned are actually within our time window and standardise the timestamp as interval identifier
 
-    for interval in generation_mix_data_json["data"]:
-        if (
-            datetime.strptime(helper.trim_timestamp(interval["from"]), "%Y-%m-%dT%H%M")
-            >= start_date
-            and datetime.strptime(
-                helper.trim_timestamp(interval["from"]), "%Y-%m-%dT%H%M"
-            )
-            <= end_date
-        ):
+    window = helper.half_hour_window(start_date, end_date)
+
+    for interval in generation_mix_intervals:
+        half_hour = helper.timestamp_to_half_hour(interval["from"])
+        if half_hour in window:
             generation_mix_interval_entry = {}
             for entry in interval["generationmix"]:
                 generation_mix_interval_entry[entry["fuel"]] = entry["perc"]
             generation_mix_data[
-                helper.trim_timestamp(interval["from"])
+                helper.half_hour_to_timestamp(half_hour)
             ] = generation_mix_interval_entry
 
-    return generation_mix_data
+    return generation_mix_data, region_id
+
+
+async def get_generation_mix_data(
+    start_date: datetime,
+    end_date: datetime,
+    postcode_region: str = None,
+    national_fallbacks: set = None,
+) -> dict:
+    # Generate the interval data for fuel used to produce power from the National Grid.
+    # A window is all regional or all national, never a mix of the two. Regions
+    # in national_fallbacks (shared across a report) have already fallen back
+    # and go straight to the national dataset, any that fall back here are added
 
+    generation_mix_data = {}
 
-async def get_carbon_emission_factors() -> dict:
-    # Get carbon emissions data for fuel types from National Grid
+    intervals = helper.half_hour_window(start_date, end_date)
+    if not intervals:
+        return generation_mix_data
 
-    carbon_emission_factors = {}
+    # Use the postcode from the meter address to get regional data
+    region_id = await _get_region_id(postcode_region)
+    if national_fallbacks is not None and region_id in national_fallbacks:
+        region_id = None
 
-    api_url = f"https://api.carbonintensity.org.uk/intensity/factors"
+    # Past generation mix never changes so start from anything already cached
+    # and only go to the API for the intervals we're missing
 
-    carbon_emission_factors_json = await get_rest_req(
-        api_url=api_url, validation="data"
+    cache = get_cache()
+    if cache:
+        generation_mix_data = cache.get_generation_mix(
+            _get_cache_region(region_id),
+            helper.half_hour_to_timestamp(intervals[0]),
+            helper.half_hour_to_timestamp(intervals[-1]),
+        )
+        diagnostics.log_event(
+            logging.DEBUG,
+            "generation_mix_cached",
+            region_id=region_id,
+            held=len(generation_mix_data),
+            intervals=len(intervals),
+        )
+
+    # Carbon Intensity caps how long a range it will serve, so fetch the
+    # missing intervals in windows under that cap all at once
+
+    missing_ranges = _get_missing_ranges(
+        intervals, generation_mix_data, GENERATION_MIX_MAX_WINDOW
     )
 
-    # Create initial dict to store emission factors, convert keys to lowercase for consistency
-    for key, value in carbon_emission_factors_json["data"][0].items():
-        carbon_emission_factors[key.lower()] = value
+    def store_range(fetched_range: tuple):
+        fetched_generation_mix_data, region = fetched_range
+
+        if cache:
+            cache.put_generation_mix(
+                _get_cache_region(region),
+                {
+                    timestamp: generation_mix
+                    for timestamp, generation_mix in fetched_generation_mix_data.items()
+                    if _is_finalised(timestamp)
+                },
+            )
+
+    fetched_ranges = await _fetch_ranges(
+        missing_ranges,
+        lambda first_interval, last_interval: _get_generation_mix_range(
+            helper.half_hour_to_datetime(first_interval),
+            helper.half_hour_to_datetime(last_interval),
+            region_id,
+        ),
+        store_range,
+    )
+
+    # If any part of a regional window fell back the whole window is redone
+    # with the national dataset, so its figures come from a single source
+    if region_id and any(region is None for _, region in fetched_ranges):
+        metrics.count("regional_fallbacks")
+        if national_fallbacks is not None:
+            national_fallbacks.add(region_id)
+
+        return await get_generation_mix_data(start_date, end_date)
+
+    for fetched_generation_mix_data, region in fetched_ranges:
+        generation_mix_data.update(fetched_generation_mix_data)
 
-    # !!!NOTE NationalGrid give emissions factors with Gas and Imports broken down to more granular sources
-    # Obviously this would be a discussion interally to agree how to address (or to chase NG for clarity/API update)
-    # For now for Imports and Gases I'm just averaging them into their generic buckets even though it's not pretty
+    return {
+        timestamp: generation_mix_data[timestamp]
+        for timestamp in sorted(generation_mix_data)
+    }
 
-    # Create combined "import" emissions figure
-    overall_import_emissions = 0
-    overall_import_count = 0
 
-    for fuel_type in carbon_emission_factors:
-        if "imports" in fuel_type:
-            overall_import_count += 1
-            overall_import_emissions += carbon_emission_factors[fuel_type]
+class GenerationMixFetcher:
+    # Deduplicates get_generation_mix_data calls by (region, start, end) so many
+    # meters sharing a region and window trigger one download between them,
+    # callers arriving while a download is in flight wait on that same download.
+    # Each distinct postcode outcode's region is looked up once the same way
 
-    if overall_import_count > 1:
-        logging.debug(
-            f"Found {overall_import_count} Import fuel types, Combining and averaging into Imports fuel type"
+    # Once a region has fallen back to the national dataset it stays national
+    # for everything the fetcher (or others given the same national_fallbacks)
+    # fetches, so a report's figures for a meter come from a single source
+
+    # NOTE the same generation mix dict is handed to every caller, don't modify it
+
+    def __init__(self, national_fallbacks: set = None):
+        self._fetches = {}
+        self._region_ids = {}
+        self.requested = 0
+        self.fetched = 0
+
+        # Region ids that have fallen back to the national dataset
+        self.national_fallbacks = (
+            set() if national_fallbacks is None else national_fallbacks
         )
-        carbon_emission_factors["imports"] = (
-            overall_import_emissions / overall_import_count
+
+    @property
+    def saved(self) -> int:
+        return self.requested - self.fetched
+
+    async def get(
+        self, start_date: datetime, end_date: datetime, postcode_region: str = None
+    ) -> dict:
+        # Key on the region the data will actually come from
+        region_id = None
+        if USE_REGIONAL_GENERATION_MIX and postcode_region:
+            region_id = await self._get_region_id(postcode_region)
+            if region_id in self.national_fallbacks:
+                region_id = None
+
+        key = (region_id, start_date, end_date)
+        self.requested += 1
+
+        if key not in self._fetches:
+            self.fetched += 1
+            # Only a regional fetch has anything to fall back from
+            if region_id:
+                fetch = get_generation_mix_data(
+                    start_date,
+                    end_date,
+                    postcode_region,
+                    national_fallbacks=self.national_fallbacks,
+                )
+            else:
+                fetch = get_generation_mix_data(start_date, end_date, None)
+
+            self._fetches[key] = asyncio.ensure_future(fetch)
+
+        try:
+            # Shield so one cancelled caller doesn't cancel the download for the rest
+            return await asyncio.shield(self._fetches[key])
+        except Exception:
+            # Drop failed downloads so a later call can try again
+            if key in self._fetches and self._fetches[key].done():
+                del self._fetches[key]
+            raise
+
+    async def _get_region_id(self, postcode_region: str) -> int:
+        if postcode_region not in self._region_ids:
+            self._region_ids[postcode_region] = asyncio.ensure_future(
+                _get_region_id(postcode_region)
+            )
+
+        try:
+            return await asyncio.shield(self._region_ids[postcode_region])
+        except Exception:
+            if self._region_ids[postcode_region].done():
+                del self._region_ids[postcode_region]
+            raise
+
+
+async def get_carbon_emission_factors(fuel_buckets: dict = None) -> dict:
+    # Get carbon emissions data for fuel types from National Grid, with the
+    # generation mix fuel buckets made up from their sub-fuels (see carbon_factors)
+
+    carbon_emission_factors = {}
+
+    api_url = f"{CARBON_INTENSITY_API_URL}/intensity/factors"
+
+    # Factors change rarely so reuse a cached copy while it's fresh enough
+    cache = get_cache()
+    carbon_emission_factors_json = None
+
+    if cache:
+        carbon_emission_factors_json = cache.get_value(
+            api_url, EMISSION_FACTORS_CACHE_TTL.total_seconds()
         )
 
-    # Create combined "gas" emissions figure
-    overall_gas_emissions = 0
-    overall_gas_count = 0
-    for fuel_type in carbon_emission_factors:
-        if "gas" in fuel_type.lower():
-            overall_gas_count += 1
-            overall_gas_emissions += carbon_emission_factors[fuel_type]
-
-    if overall_gas_count > 1:
-        logging.debug(
-            f"Found {overall_gas_count} Gas fuel types, Combining and averaging into Gas fuel type"
+    if carbon_emission_factors_json is None:
+        carbon_emission_factors_json = await get_rest_req(
+            api_url=api_url, headers=CARBON_INTENSITY_HEADERS, validation="data"
         )
-        carbon_emission_factors["gas"] = overall_gas_emissions / overall_gas_count
+        if cache:
+            cache.put_value(api_url, carbon_emission_factors_json)
+
+    # Create initial dict to store emission factors, convert keys to lowercase for consistency
+    for key, value in carbon_emission_factors_json["data"][0].items():
+        carbon_emission_factors[key.lower()] = value
+
+    # Make up the Gas and Imports buckets from the sub-fuels NG break them down into
+    return carbon_factors.combine_fuel_buckets(carbon_emission_factors, fuel_buckets)
+
+
+def align_intervals(meter_interval_data: dict, generation_mix_data: dict) -> tuple:
+    # Line up the two datasets' intervals by half-hour in one merge, returning
+    # the meter intervals with no generation mix and the generation mix
+    # intervals with no meter interval, each as sorted (half-hour, key) pairs
+
+    # Both datasets come back in interval order so sorting is a single pass
+    meter_intervals = sorted(
+        (helper.timestamp_to_half_hour(interval), interval)
+        for interval in meter_interval_data
+    )
+    generation_mix_intervals = sorted(
+        (helper.timestamp_to_half_hour(interval), interval)
+        for interval in generation_mix_data
+    )
+
+    missing_intervals = []
+    extra_intervals = []
+
+    meter_index = 0
+    generation_mix_index = 0
+
+    while meter_index < len(meter_intervals) and generation_mix_index < len(
+        generation_mix_intervals
+    ):
+        meter_half_hour = meter_intervals[meter_index][0]
+        generation_mix_half_hour = generation_mix_intervals[generation_mix_index][0]
+
+        if meter_half_hour == generation_mix_half_hour:
+            meter_index += 1
+            generation_mix_index += 1
+        elif meter_half_hour < generation_mix_half_hour:
+            missing_intervals.append(meter_intervals[meter_index])
+            meter_index += 1
+        else:
+            extra_intervals.append(generation_mix_intervals[generation_mix_index])
+            generation_mix_index += 1
+
+    missing_intervals.extend(meter_intervals[meter_index:])
+    extra_intervals.extend(generation_mix_intervals[generation_mix_index:])
 
-    return carbon_emission_factors
+    return missing_intervals, extra_intervals
 
 
 def validate_openvolt_nationalgrid_datasets(
@@ -233,45 +896,201 @@ def validate_openvolt_nationalgrid_datasets(
     # Validates both the OpenVolt and NationalGrid
     # Intervals align and flags if not
 
-    meter_interval_timestamps = []
-    generation_mix_timestamps = []
-
-    # Pull the timestamps from both OpenVolt and NG into two defined lists
-    for interval in meter_interval_data:
-        meter_interval_timestamps.append(interval)
-
-    for interval in generation_mix_data:
-        generation_mix_timestamps.append(interval)
-
-    # Compare both lists against each other to spot gaps with interval slots
-    meter_interval_diff = set(meter_interval_timestamps) - set(
-        generation_mix_timestamps
-    )
-    generation_mix_interval_diff = set(generation_mix_timestamps) - set(
-        meter_interval_timestamps
+    missing_intervals, extra_intervals = align_intervals(
+        meter_interval_data, generation_mix_data
     )
 
-    logging.info(
-        f"Dataset validation Openvolt:NationalGrid, Openvolt Unmatched:{len(meter_interval_diff)} NationalGrid Unmatched:{len(generation_mix_interval_diff)}"
+    diagnostics.log_event(
+        logging.INFO,
+        "dataset_validation",
+        openvolt_unmatched=len(missing_intervals),
+        nationalgrid_unmatched=len(extra_intervals),
     )
 
     # Pass the check only giving a warning if NationalGrid have given us additional intervals
-    if generation_mix_interval_diff:
+    if extra_intervals:
+        metrics.count("intervals_missing_from_openvolt", len(extra_intervals))
         logging.warning(
-            f"Dataset validation Openvolt:NationalGrid, found {len(meter_interval_diff)} intervals missing from National Grid"
+            f"Dataset validation Openvolt:NationalGrid, found {len(extra_intervals)} intervals missing from Openvolt"
         )
-        logging.debug(
-            f"Could not find following timestamps in OpenVolt dataset: {generation_mix_interval_diff}"
+        diagnostics.log_event(
+            logging.DEBUG,
+            "openvolt_missing_intervals",
+            count=len(extra_intervals),
+            intervals=lambda: [interval for _, interval in extra_intervals],
         )
 
     # Fail the check if NationalGrid has missing intervals in their dataset
-    if meter_interval_diff:
+    if missing_intervals:
+        metrics.count("intervals_missing_from_nationalgrid", len(missing_intervals))
         logging.error(
-            f"Dataset validation Openvolt:NationalGrid, found {len(meter_interval_diff)} intervals missing from Openvolt"
+            f"Dataset validation Openvolt:NationalGrid, found {len(missing_intervals)} intervals missing from National Grid"
         )
-        logging.debug(
-            f"Could not find following timestamps in NationalGrid dataset: {meter_interval_diff}"
+        diagnostics.log_event(
+            logging.DEBUG,
+            "nationalgrid_missing_intervals",
+            count=len(missing_intervals),
+            intervals=lambda: [interval for _, interval in missing_intervals],
         )
         return False
 
     return True
+
+
+def _interpolate_generation_mix(
+    previous_mix: dict, next_mix: dict, fraction: float
+) -> dict:
+    # Each fuel's share the given fraction of the way from previous_mix to next_mix
+
+    return {
+        fuel_type: previous_mix.get(fuel_type, 0)
+        + (next_mix.get(fuel_type, 0) - previous_mix.get(fuel_type, 0)) * fraction
+        for fuel_type in dict.fromkeys([*previous_mix, *next_mix])
+    }
+
+
+async def fill_generation_mix_gaps(
+    meter_interval_data: dict,
+    generation_mix_data: dict,
+    gap_policy: str,
+    postcode_region: str = None,
+    missing_intervals: list = None,
+) -> dict:
+    # Generation mix with the meter intervals it's missing filled in as per
+    # gap_policy (see GAP_POLICIES), as a new dict since the one given is shared
+    # between meters. Anything the policy can't fill is left missing for
+    # validation to fail on. missing_intervals can be given if already worked
+    # out by align_intervals
+
+    if gap_policy not in GAP_POLICIES:
+        raise ValueError(
+            f"Unknown gap policy {gap_policy}, expected one of {GAP_POLICIES}"
+        )
+
+    if missing_intervals is None:
+        missing_intervals, _ = align_intervals(meter_interval_data, generation_mix_data)
+
+    if not missing_intervals or gap_policy == "fail":
+        return generation_mix_data
+
+    logging.warning(
+        f"Filling {len(missing_intervals)} intervals missing from National Grid, gap policy {gap_policy}"
+    )
+
+    filled_generation_mix_data = dict(generation_mix_data)
+
+    if gap_policy == "refetch":
+        # Ask for just the missing runs of intervals again
+        refetched_datasets = await asyncio.gather(
+            *(
+                get_generation_mix_data(
+                    helper.half_hour_to_datetime(first_interval),
+                    helper.half_hour_to_datetime(last_interval),
+                    postcode_region,
+                )
+                for first_interval, last_interval in helper.contiguous_intervals(
+                    [half_hour for half_hour, _ in missing_intervals]
+                )
+            )
+        )
+
+        refetched_generation_mix_data = {}
+        for refetched_dataset in refetched_datasets:
+            refetched_generation_mix_data.update(refetched_dataset)
+
+        for half_hour, interval in missing_intervals:
+            timestamp = helper.half_hour_to_timestamp(half_hour)
+            if timestamp in refetched_generation_mix_data:
+                filled_generation_mix_data[interval] = refetched_generation_mix_data[
+                    timestamp
+                ]
+    else:
+        known_intervals = sorted(
+            (helper.timestamp_to_half_hour(interval), interval)
+            for interval in generation_mix_data
+        )
+        if not known_intervals:
+            return generation_mix_data
+
+        # Walk the known intervals alongside the (sorted) missing ones so each
+        # gap finds the known intervals either side of it in one pass
+        known_index = 0
+
+        for half_hour, interval in missing_intervals:
+            while (
+                known_index < len(known_intervals)
+                and known_intervals[known_index][0] < half_hour
+            ):
+                known_index += 1
+
+            previous_interval = known_intervals[max(known_index - 1, 0)]
+            next_interval = known_intervals[min(known_index, len(known_intervals) - 1)]
+
+            if known_index == 0:
+                # Nothing before the gap, carry the first mix back
+                previous_interval = next_interval
+            elif known_index == len(known_intervals):
+                next_interval = previous_interval
+
+            previous_mix = generation_mix_data[previous_interval[1]]
+            next_mix = generation_mix_data[next_interval[1]]
+
+            if gap_policy == "interpolate" and next_interval[0] != previous_interval[0]:
+                filled_generation_mix_data[interval] = _interpolate_generation_mix(
+                    previous_mix,
+                    next_mix,
+                    (half_hour - previous_interval[0])
+                    / (next_interval[0] - previous_interval[0]),
+                )
+            else:
+                filled_generation_mix_data[interval] = dict(previous_mix)
+
+    # Keep the filled intervals in order with the rest
+    return {
+        interval: filled_generation_mix_data[interval]
+        for interval in sorted(
+            filled_generation_mix_data, key=helper.timestamp_to_half_hour
+        )
+    }
+
+
+class GenerationMixGapFiller:
+    # Fills the gaps in each shared generation mix dataset once for a report,
+    # rather than once per meter. Meters handed the same dataset (see
+    # GenerationMixFetcher) missing the same intervals get the same filled
+    # dict back, so a refetch is only made once and the filled dataset stays
+    # shared for the carbon factor vectors and worker processes
+
+    def __init__(self, gap_policy: str):
+        self.gap_policy = gap_policy
+
+        # (id of dataset, missing half-hours): (dataset, filled dataset), the
+        # dataset held so its id can't be reused while the filler is alive
+        self._filled = {}
+
+    async def fill(
+        self,
+        meter_interval_data: dict,
+        generation_mix_data: dict,
+        postcode_region: str = None,
+    ) -> dict:
+        missing_intervals, _ = align_intervals(meter_interval_data, generation_mix_data)
+
+        key = (
+            id(generation_mix_data),
+            tuple(half_hour for half_hour, _ in missing_intervals),
+        )
+
+        if key not in self._filled:
+            self._filled[key] = (
+                generation_mix_data,
+                await fill_generation_mix_gaps(
+                    meter_interval_data,
+                    generation_mix_data,
+                    self.gap_policy,
+                    postcode_region,
+                    missing_intervals=missing_intervals,
+                ),
+            )
+
+        return self._filled[key][1]
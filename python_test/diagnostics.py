@@ -0,0 +1,71 @@
+import json
+import logging
+import threading
+
+# Diagnostic log lines for things that can happen once per record (intervals
+# out of window, failed requests, per meter progress) are sampled, only the
+# first SAMPLE_FIRST of each event in the process and then one in SAMPLE_EVERY
+# are written, anything needing the full tally counts it in the report metrics
+SAMPLE_FIRST = 5
+SAMPLE_EVERY = 1000
+
+# Longest a logged field value is written out, longer ones are cut short
+MAX_FIELD_LENGTH = 200
+
+_lock = threading.Lock()
+_event_counts = {}
+
+
+def _format_value(value, max_length: int) -> str:
+    if isinstance(value, str) and value and not any(c.isspace() for c in value):
+        text = value
+    else:
+        text = json.dumps(value, default=str)
+
+    if max_length is not None and len(text) > max_length:
+        text = f"{text[:max_length]}..."
+
+    return text
+
+
+def log_event(
+    level: int,
+    event: str,
+    sample: bool = True,
+    max_length: int = MAX_FIELD_LENGTH,
+    **fields,
+):
+    # Log an event as one structured "event key=value ..." line, the event and
+    # fields also set on the record (record.event, record.fields) for handlers
+    # wanting them as data. Nothing is formatted unless the level is enabled
+    # and the event is in the sample, and a field given as a callable is only
+    # called then, so costly values (e.g. a list of timestamps) are free when
+    # the line isn't written. max_length None writes values out in full
+
+    logger = logging.getLogger()
+    if not logger.isEnabledFor(level):
+        return
+
+    if sample:
+        with _lock:
+            seen = _event_counts[event] = _event_counts.get(event, 0) + 1
+
+        if seen > SAMPLE_FIRST and seen % SAMPLE_EVERY:
+            return
+
+        fields["seen"] = seen
+
+    fields = {
+        name: value() if callable(value) else value for name, value in fields.items()
+    }
+
+    logger.log(
+        level,
+        "%s %s",
+        event,
+        " ".join(
+            f"{name}={_format_value(value, max_length)}"
+            for name, value in fields.items()
+        ),
+        extra={"event": event, "fields": fields},
+    )
@@ -1,19 +1,120 @@
 import re
+import sys
 import csv
 from enum import Enum
+from functools import lru_cache
+from datetime import date, datetime, timedelta
 
+import columnar
 
-def uk_address_to_region(address: str) -> str:
-    # NationalGrid accepts Outcode from Postcode to identify regions
+# Intervals are identified by their half-hour index from the epoch
+HALF_HOUR = timedelta(minutes=30)
+EPOCH = datetime(1970, 1, 1)
+_EPOCH_ORDINAL = EPOCH.toordinal()
+
+# Using regex filter for UK Postcode definition as per wikipedia for now:
+# https://en.wikipedia.org/wiki/Postcodes_in_the_United_Kingdom#Validation
+_UK_POSTCODE_REGEX = re.compile(
+    r"([Gg][Ii][Rr] 0[Aa]{2})|((([A-Za-z][0-9]{1,2})|(([A-Za-z][A-Ha-hJ-Yj-y][0-9]{1,2})|(([A-Za-z][0-9][A-Za-z])|([A-Za-z][A-Ha-hJ-Yj-y][0-9][A-Za-z]?))))\s?[0-9][A-Za-z]{2})"
+)
+
+
+class MeterInterval:
+    # Compact meter interval keeping only what the reports read, the half-hour
+    # index, consumption parsed to a number once and the (interned) unit,
+    # rather than the full API JSON object with its repeated meter/customer ids.
+    # Reads like the API interval dict for the fields the reports use.
+    # consumption_text is the consumption as the API wrote it, only kept (else
+    # None) when the parsed number wouldn't write back out the same, e.g. "54.0"
+
+    __slots__ = ("half_hour", "consumption", "consumption_units", "consumption_text")
+
+    def __init__(
+        self,
+        half_hour: int,
+        consumption,
+        consumption_units: str,
+        consumption_text: str = None,
+    ):
+        self.half_hour = half_hour
+        self.consumption = consumption
+        self.consumption_units = sys.intern(consumption_units)
+        self.consumption_text = consumption_text
+
+    @classmethod
+    def from_api(cls, half_hour: int, interval: dict):
+        consumption = parse_consumption(interval["consumption"])
+        consumption_text = interval["consumption"]
+
+        if not isinstance(consumption_text, str) or consumption_text == str(
+            consumption
+        ):
+            consumption_text = None
+
+        return cls(
+            half_hour,
+            consumption,
+            interval["consumption_units"],
+            consumption_text,
+        )
+
+    def __reduce__(self):
+        # Pickle as the constructor arguments, far smaller than the default
+        # slot state when records are sent to worker processes
+        return (
+            MeterInterval,
+            (
+                self.half_hour,
+                self.consumption,
+                self.consumption_units,
+                self.consumption_text,
+            ),
+        )
+
+    def __getitem__(self, key: str):
+        if key in MeterInterval.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MeterInterval) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f"MeterInterval({half_hour_to_timestamp(self.half_hour)}, {self.consumption} {self.consumption_units})"
+
+    def to_dict(self) -> dict:
+        # The fields as the API gave them, consumption in its original text
+        # where that differs from the parsed number
+        return {
+            "consumption": (
+                self.consumption
+                if self.consumption_text is None
+                else self.consumption_text
+            ),
+            "consumption_units": self.consumption_units,
+        }
+
+
+def parse_consumption(consumption):
+    # API consumption arrives as a string, keep whole numbers as int so
+    # they're written back out exactly as they came in
+
+    consumption = float(consumption)
+
+    if consumption.is_integer():
+        return int(consumption)
 
-    # Using regex filter for UK Postcode definition as per wikipedia for now:
-    # https://en.wikipedia.org/wiki/Postcodes_in_the_United_Kingdom#Validation
+    return consumption
 
-    ukpostcode_regex = r"([Gg][Ii][Rr] 0[Aa]{2})|((([A-Za-z][0-9]{1,2})|(([A-Za-z][A-Ha-hJ-Yj-y][0-9]{1,2})|(([A-Za-z][0-9][A-Za-z])|([A-Za-z][A-Ha-hJ-Yj-y][0-9][A-Za-z]?))))\s?[0-9][A-Za-z]{2})"
+
+@lru_cache(maxsize=4096)
+def uk_address_to_region(address: str) -> str:
+    # NationalGrid accepts Outcode from Postcode to identify regions, cached
+    # as a customer's meters often share an address
 
     # Sorting to pull back the shortest match which should be the outcode/first section
 
-    postcode = sorted(re.findall(ukpostcode_regex, address)[0], key=len)[-1].replace(
+    postcode = sorted(_UK_POSTCODE_REGEX.findall(address)[0], key=len)[-1].replace(
         " ", ""
     )[:-3]
 
@@ -29,10 +130,119 @@ def trim_timestamp(datetimestamp: str) -> str:
     return "".join(datetimestamp.split(":", 2)[:2]).replace("Z", "").replace("z", "")
 
 
+def timestamp_to_half_hour(datetimestamp: str) -> int:
+    # Parse a timestamp once into its epoch half-hour index, the number of
+    # half-hours since 1970-01-01T00:00, which is cheap to compare and sort.
+    # Takes API timestamps (2023-01-01T00:30:00.000Z) and trimmed ones (2023-01-01T0030)
+
+    if datetimestamp[13] == ":":
+        minute = int(datetimestamp[14:16])
+    else:
+        minute = int(datetimestamp[13:15])
+
+    return (
+        _day_to_half_hour(datetimestamp[:10])
+        + int(datetimestamp[11:13]) * 2
+        + minute // 30
+    )
+
+
+@lru_cache(maxsize=4096)
+def _day_to_half_hour(day: str) -> int:
+    # Half-hour index of midnight on a YYYY-MM-DD day, cached as days repeat 48 times
+
+    return (date.fromisoformat(day).toordinal() - _EPOCH_ORDINAL) * 48
+
+
+@lru_cache(maxsize=65536)
+def half_hour_to_timestamp(half_hour: int) -> str:
+    # Format a half-hour index the same way trim_timestamp leaves API timestamps
+
+    day, half_hour_of_day = divmod(half_hour, 48)
+
+    return f"{date.fromordinal(day + _EPOCH_ORDINAL).isoformat()}T{half_hour_of_day // 2:02}{(half_hour_of_day % 2) * 30:02}"
+
+
+def datetime_to_half_hour(interval: datetime) -> int:
+    # Half-hour index of the interval a datetime falls in
+
+    return (interval - EPOCH) // HALF_HOUR
+
+
+def half_hour_to_datetime(half_hour: int) -> datetime:
+    return EPOCH + half_hour * HALF_HOUR
+
+
+def half_hour_window(start_date: datetime, end_date: datetime) -> range:
+    # Half-hour indexes of every interval starting from start_date to end_date inclusive
+
+    return range(
+        -((EPOCH - start_date) // HALF_HOUR), datetime_to_half_hour(end_date) + 1
+    )
+
+
+def contiguous_intervals(half_hours: list) -> list:
+    # Group sorted half-hour indexes into (first, last) runs without gaps
+
+    runs = []
+
+    for half_hour in half_hours:
+        if runs and half_hour - runs[-1][1] == 1:
+            runs[-1][1] = half_hour
+        else:
+            runs.append([half_hour, half_hour])
+
+    return [tuple(run) for run in runs]
+
+
+def split_intervals(
+    first_half_hour: int, last_half_hour: int, max_window: timedelta
+) -> list:
+    # Split a run of half-hour indexes into (first, last) windows each covering
+    # at most max_window, windows meet without overlapping or leaving a gap
+
+    window_size = max(max_window // HALF_HOUR, 1)
+
+    return [
+        (window_start, min(window_start + window_size - 1, last_half_hour))
+        for window_start in range(first_half_hour, last_half_hour + 1, window_size)
+    ]
+
+
 def percent(smallnumber, bignumber, rounding: int = 2):
     return round((smallnumber / bignumber) * 100, 2)
 
 
+def get_datastream_columns(datastream: dict, fields: list = None) -> tuple:
+    # Turn an {interval: {field: value}} datastream into its intervals, field
+    # names and one column of values per field. Fields default to those found
+    # in the data itself, in the order first seen
+
+    intervals = list(datastream)
+
+    if fields is None:
+        fields = list(
+            dict.fromkeys(
+                field for interval in intervals for field in datastream[interval]
+            )
+        )
+
+    columns = [
+        [datastream[interval][field] for interval in intervals] for field in fields
+    ]
+
+    return intervals, fields, columns
+
+
+def write_datastream_csv(file_name: str, intervals: list, fields: list, columns: list):
+    # Write a datastream's columns to csv in one go, a row per interval
+
+    with open(file_name, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["interval", *fields])
+        writer.writerows(zip(intervals, *columns))
+
+
 def output_datastream_to_file(
     meter: str,
     output_file: str,
@@ -40,133 +250,39 @@ def output_datastream_to_file(
     generation_mix_data: dict,
     consumption_source_report: dict,
     carbon_emissions_report: dict,
+    output_formats: tuple = ("csv",),
 ):
-    # export of meter_interval_data
-    with open(f"{output_file}_{meter}_meter_interval.csv", "w", newline="") as csv_file:
-        writer = csv.writer(csv_file)
+    # Export each of the data streams for the meter, as csv and/or the binary
+    # npz columnar format (needs numpy) which suits large back-fills better
 
-        outputheader = ["interval", "consumption", "consumption_units"]
-        writer.writerow(outputheader)
+    # Meter intervals are written as the API gave them rather than as parsed
+    meter_interval_data = {
+        interval: (
+            interval_data.to_dict()
+            if isinstance(interval_data, MeterInterval)
+            else interval_data
+        )
+        for interval, interval_data in meter_interval_data.items()
+    }
 
-        for interval in meter_interval_data:
-            writer.writerow(
-                [
-                    interval,
-                    meter_interval_data[interval]["consumption"],
-                    meter_interval_data[interval]["consumption_units"],
-                ]
-            )
+    datastreams = {
+        "meter_interval": get_datastream_columns(
+            meter_interval_data, ["consumption", "consumption_units"]
+        ),
+        "generation_mix": get_datastream_columns(generation_mix_data),
+        "consumption_source": get_datastream_columns(consumption_source_report),
+        "carbon_emissions": get_datastream_columns(carbon_emissions_report),
+    }
 
-    # export of generation_mix_data
-    with open(f"{output_file}_{meter}_generation_mix.csv", "w", newline="") as csv_file:
-        writer = csv.writer(csv_file)
-
-        # TODO Note the headers are static so in future would need to leverage a sorted dictionary for header generation
-        outputheader = [
-            "interval",
-            "biomass",
-            "coal",
-            "imports",
-            "gas",
-            "nuclear",
-            "other",
-            "hydro",
-            "solar",
-            "wind",
-        ]
-        writer.writerow(outputheader)
-
-        for interval in generation_mix_data:
-            writer.writerow(
-                [
-                    interval,
-                    generation_mix_data[interval]["biomass"],
-                    generation_mix_data[interval]["coal"],
-                    generation_mix_data[interval]["imports"],
-                    generation_mix_data[interval]["gas"],
-                    generation_mix_data[interval]["nuclear"],
-                    generation_mix_data[interval]["other"],
-                    generation_mix_data[interval]["hydro"],
-                    generation_mix_data[interval]["solar"],
-                    generation_mix_data[interval]["wind"],
-                ]
-            )
-
-    # export of consumption_source_report
-    with open(
-        f"{output_file}_{meter}_consumption_source.csv", "w", newline=""
-    ) as csv_file:
-        writer = csv.writer(csv_file)
-
-        # TODO Note the headers are static so in future would need to leverage a sorted dictionary for header generation
-        outputheader = [
-            "interval",
-            "total",
-            "biomass",
-            "coal",
-            "imports",
-            "gas",
-            "nuclear",
-            "other",
-            "hydro",
-            "solar",
-            "wind",
-        ]
-        writer.writerow(outputheader)
-
-        for interval in consumption_source_report:
-            writer.writerow(
-                [
-                    interval,
-                    consumption_source_report[interval]["total"],
-                    consumption_source_report[interval]["biomass"],
-                    consumption_source_report[interval]["coal"],
-                    consumption_source_report[interval]["imports"],
-                    consumption_source_report[interval]["gas"],
-                    consumption_source_report[interval]["nuclear"],
-                    consumption_source_report[interval]["other"],
-                    consumption_source_report[interval]["hydro"],
-                    consumption_source_report[interval]["solar"],
-                    consumption_source_report[interval]["wind"],
-                ]
+    for datastream, (intervals, fields, columns) in datastreams.items():
+        if "csv" in output_formats:
+            write_datastream_csv(
+                f"{output_file}_{meter}_{datastream}.csv", intervals, fields, columns
             )
-
-    # export of carbon_emissions_report
-    with open(
-        f"{output_file}_{meter}_carbon_emissions.csv", "w", newline=""
-    ) as csv_file:
-        writer = csv.writer(csv_file)
-
-        # Note the headers are static so in future would need
-        # to leverage a sorted dictionary for automation
-        outputheader = [
-            "interval",
-            "total",
-            "biomass",
-            "coal",
-            "imports",
-            "gas",
-            "nuclear",
-            "other",
-            "hydro",
-            "solar",
-            "wind",
-        ]
-        writer.writerow(outputheader)
-
-        for interval in carbon_emissions_report:
-            writer.writerow(
-                [
-                    interval,
-                    carbon_emissions_report[interval]["total"],
-                    carbon_emissions_report[interval]["biomass"],
-                    carbon_emissions_report[interval]["coal"],
-                    carbon_emissions_report[interval]["imports"],
-                    carbon_emissions_report[interval]["gas"],
-                    carbon_emissions_report[interval]["nuclear"],
-                    carbon_emissions_report[interval]["other"],
-                    carbon_emissions_report[interval]["hydro"],
-                    carbon_emissions_report[interval]["solar"],
-                    carbon_emissions_report[interval]["wind"],
-                ]
+        if "npz" in output_formats:
+            columnar.write_datastream_npz(
+                f"{output_file}_{meter}_{datastream}.npz",
+                [timestamp_to_half_hour(interval) for interval in intervals],
+                fields,
+                columns,
             )
@@ -0,0 +1,302 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+import requests as requests
+from requests.adapters import HTTPAdapter
+
+# Responses worth trying again, throttling and transient server errors
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def _counting_connection_cls(connection_cls, counters: dict, lock: threading.Lock):
+    # Wrap a urllib3 connection class so every socket it opens is counted,
+    # this includes re-opening a pooled connection the server has closed
+
+    class CountingConnection(connection_cls):
+        def connect(self):
+            with lock:
+                counters["opened"] += 1
+            return super().connect()
+
+    return CountingConnection
+
+
+class _CountingAdapter(HTTPAdapter):
+    # HTTPAdapter keeping a count of requests sent and connections opened
+
+    def __init__(self, **kwargs):
+        self.counters = {"requests": 0, "opened": 0}
+        self._counters_lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+
+        # Swap in pool classes that build counting connections
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: type(
+                pool_cls.__name__,
+                (pool_cls,),
+                {
+                    "ConnectionCls": _counting_connection_cls(
+                        pool_cls.ConnectionCls, self.counters, self._counters_lock
+                    )
+                },
+            )
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def send(self, request, **kwargs):
+        with self._counters_lock:
+            self.counters["requests"] += 1
+        return super().send(request, **kwargs)
+
+
+class _HostThrottle:
+    # Spaces out the requests to one host so there are no more than rate a
+    # second, and holds them all back while the host has asked us to wait
+
+    def __init__(self, rate: float = None):
+        self.interval = 1 / rate if rate else 0.0
+        self.next_time = 0.0
+
+    async def wait(self):
+        # Reserve the next free slot then sleep until it comes round, all on
+        # the event loop thread so no lock is needed
+
+        now = time.monotonic()
+        start_time = max(now, self.next_time)
+        self.next_time = start_time + self.interval
+
+        if start_time > now:
+            await asyncio.sleep(start_time - now)
+
+    def pause(self, seconds: float):
+        self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+
+class HttpClient:
+    # Shared HTTP client holding one pooled keep-alive session per host, so
+    # repeat calls to the OpenVolt and Carbon Intensity APIs reuse connections
+    # rather than paying a new TCP and TLS handshake for every request
+
+    def __init__(
+        self,
+        pool_size: int = 8,
+        timeout: float = 30.0,
+        keep_alive: bool = True,
+        max_concurrent_requests: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        rate_limit: float = None,
+        hedge_after: float = None,
+    ):
+        if max_concurrent_requests < 1:
+            raise ValueError(
+                f"Concurrency limit must be at least 1, got {max_concurrent_requests}"
+            )
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.max_concurrent_requests = max_concurrent_requests
+
+        # Retry policy applied by callers through retry_delay, requests per
+        # second allowed to each host, and how long to wait on a response
+        # before sending a second (hedged) copy of the request
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limit = rate_limit
+        self.hedge_after = hedge_after
+
+        self._throttles = {}
+        self._hedged = {}
+
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._semaphore = None
+
+    def set_max_concurrent_requests(self, limit: int):
+        # Change the concurrency limit, the semaphore is rebuilt on next request
+
+        if limit < 1:
+            raise ValueError(f"Concurrency limit must be at least 1, got {limit}")
+
+        self.max_concurrent_requests = limit
+        self._semaphore = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # asyncio primitives belong to the event loop that first uses them so
+        # build a new semaphore whenever we find ourselves in a different loop
+
+        loop = asyncio.get_running_loop()
+
+        if self._semaphore is None or self._semaphore[0] is not loop:
+            self._semaphore = (loop, asyncio.Semaphore(self.max_concurrent_requests))
+
+        return self._semaphore[1]
+
+    def _get_session(self, api_url: str) -> requests.Session:
+        # Sessions are keyed on scheme and host so each API gets its own pool
+
+        url = urlsplit(api_url)
+        host = f"{url.scheme}://{url.netloc}"
+
+        with self._sessions_lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = _CountingAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size
+                )
+                session.mount(f"{host}/", adapter)
+
+                if not self.keep_alive:
+                    session.headers["Connection"] = "close"
+
+                logging.debug(f"Created HTTP session for {host}")
+                self._sessions[host] = (session, adapter)
+
+            return self._sessions[host][0]
+
+    def _get_throttle(self, api_url: str) -> _HostThrottle:
+        host = urlsplit(api_url).netloc
+
+        if host not in self._throttles:
+            self._throttles[host] = _HostThrottle(self.rate_limit)
+
+        return self._throttles[host]
+
+    def retry_delay(
+        self, attempt: int, response: requests.Response = None, api_url: str = None
+    ) -> float:
+        # Seconds to wait before retry number attempt (from 0). A Retry-After
+        # header on the response is honoured up to max_backoff, and holds back
+        # every request to api_url's host, otherwise it's exponential backoff
+        # with full jitter
+
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = (
+                        parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)
+                    ).total_seconds()
+                except (TypeError, ValueError):
+                    delay = None
+
+            if delay is not None:
+                delay = min(max(delay, 0.0), self.max_backoff)
+                if api_url:
+                    self._get_throttle(api_url).pause(delay)
+                return delay
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def get(
+        self, api_url: str, headers: dict = None, params: dict = None
+    ) -> requests.Response:
+        # Blocking GET through the pooled session for the URL's host
+
+        return self._get_session(api_url).get(
+            api_url, headers=headers, params=params, timeout=self.timeout
+        )
+
+    async def async_get(
+        self, api_url: str, headers: dict = None, params: dict = None
+    ) -> requests.Response:
+        # requests is blocking so run it on a worker thread, letting other
+        # requests overlap with it up to the concurrency limit
+
+        async with self._get_semaphore():
+            throttle = self._get_throttle(api_url)
+            await throttle.wait()
+
+            request = asyncio.ensure_future(
+                asyncio.to_thread(self.get, api_url, headers, params)
+            )
+
+            if not self.hedge_after:
+                return await request
+
+            return await self._hedge(request, throttle, api_url, headers, params)
+
+    async def _hedge(
+        self,
+        request: asyncio.Future,
+        throttle: _HostThrottle,
+        api_url: str,
+        headers: dict,
+        params: dict,
+    ) -> requests.Response:
+        # If the response is slow send the request again and take whichever
+        # answers first, a worker thread can't be stopped so the slower one is
+        # left to finish in the background. GETs are safe to send twice, and
+        # the hedge shares the request's concurrency slot but not its rate
+
+        done, pending = await asyncio.wait({request}, timeout=self.hedge_after)
+        if done:
+            return request.result()
+
+        await throttle.wait()
+        host = urlsplit(api_url).netloc
+        self._hedged[host] = self._hedged.get(host, 0) + 1
+        logging.debug(f"Hedging request to {host} after {self.hedge_after} seconds")
+
+        hedge = asyncio.ensure_future(
+            asyncio.to_thread(self.get, api_url, headers, params)
+        )
+        pending = {request, hedge}
+        error = None
+
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for finished in done:
+                if finished.exception() is None:
+                    # Don't leave the loser's error unretrieved
+                    for loser in pending:
+                        loser.add_done_callback(
+                            lambda task: task.cancelled() or task.exception()
+                        )
+                    return finished.result()
+                error = error or finished.exception()
+
+        raise error
+
+    def connection_stats(self) -> dict:
+        # Requests sent, connections opened and connections reused per host
+
+        stats = {}
+
+        with self._sessions_lock:
+            for host, (session, adapter) in self._sessions.items():
+                requests_sent = adapter.counters["requests"]
+                opened = adapter.counters["opened"]
+                stats[host] = {
+                    "requests": requests_sent,
+                    "opened": opened,
+                    "reused": max(requests_sent - opened, 0),
+                    "hedged": self._hedged.get(urlsplit(host).netloc, 0),
+                }
+
+        return stats
+
+    def close(self):
+        with self._sessions_lock:
+            for session, adapter in self._sessions.values():
+                session.close()
+            self._sessions = {}
@@ -0,0 +1,225 @@
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Metrics for the report being generated, held per asyncio task (and copied
+# into worker threads) so concurrent batch reports each get their own
+_metrics = contextvars.ContextVar("metrics", default=None)
+
+
+def get_metrics():
+    return _metrics.get()
+
+
+def set_metrics(metrics) -> contextvars.Token:
+    return _metrics.set(metrics)
+
+
+def reset_metrics(token: contextvars.Token):
+    _metrics.reset(token)
+
+
+def _percentile(values: list, fraction: float) -> float:
+    # Nearest rank percentile of already sorted values
+
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Metrics:
+    # Timings for each stage of a report and every API request it makes,
+    # summarised as a JSON ready dict. If a hook is given it's called with
+    # each stage and request event as it happens, tagged with the labels,
+    # e.g. to forward them on to monitoring
+    #
+    # A stage's seconds are summed across its calls, busy_seconds is the
+    # wall time with at least one call in progress, so concurrent fetches
+    # in the same stage only count once. Counters tally per record events
+    # (e.g. intervals dropped) that aren't worth a log line or hook event each
+
+    def __init__(self, hook=None, labels: dict = None):
+        self.hook = hook
+        self.labels = labels or {}
+
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._requests = []
+        self._counters = {}
+        self._start_time = time.perf_counter()
+
+    def _emit(self, event: dict):
+        if self.hook is None:
+            return
+
+        try:
+            self.hook({**self.labels, **event})
+        except Exception as e:
+            # Monitoring problems shouldn't stop the report
+            logging.error(f"Metrics hook failed: {e}")
+
+    @contextmanager
+    def stage(self, name: str):
+        # Time a stage, usable around awaits as well as plain calls
+
+        start_time = time.perf_counter()
+
+        with self._lock:
+            timing = self._stages.setdefault(
+                name,
+                {
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "busy_seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "active": 0,
+                    "busy_since": 0.0,
+                },
+            )
+            timing["calls"] += 1
+            if timing["active"] == 0:
+                timing["busy_since"] = start_time
+            timing["active"] += 1
+
+        try:
+            yield
+        finally:
+            end_time = time.perf_counter()
+            seconds = end_time - start_time
+
+            with self._lock:
+                timing["seconds"] += seconds
+                timing["max_seconds"] = max(timing["max_seconds"], seconds)
+                timing["active"] -= 1
+                if timing["active"] == 0:
+                    timing["busy_seconds"] += end_time - timing["busy_since"]
+
+            self._emit({"type": "stage", "stage": name, "seconds": seconds})
+
+    def record_request(
+        self,
+        host: str,
+        path: str,
+        status: int,
+        seconds: float,
+        response_bytes: int,
+        retries: int = 0,
+    ):
+        # One API request, status is None if no response came back
+
+        request = {
+            "host": host,
+            "path": path,
+            "status": status,
+            "seconds": seconds,
+            "bytes": response_bytes,
+            "retries": retries,
+        }
+
+        with self._lock:
+            self._requests.append(request)
+
+        self._emit({"type": "request", **request})
+
+    def count(self, name: str, amount: int = 1) -> int:
+        # Add to a counter, returning its new value
+
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+            return self._counters[name]
+
+    def summary(self) -> dict:
+        with self._lock:
+            stages = {
+                name: {
+                    "calls": timing["calls"],
+                    "seconds": round(timing["seconds"], 6),
+                    "busy_seconds": round(timing["busy_seconds"], 6),
+                    "max_seconds": round(timing["max_seconds"], 6),
+                }
+                for name, timing in self._stages.items()
+            }
+            requests = list(self._requests)
+            counters = dict(self._counters)
+
+        hosts = {}
+        for request in requests:
+            hosts.setdefault(request["host"], []).append(request)
+
+        request_summary = {}
+        for host, host_requests in hosts.items():
+            latencies = sorted(request["seconds"] for request in host_requests)
+            request_summary[host] = {
+                "requests": len(host_requests),
+                "errors": sum(
+                    1 for request in host_requests if request["status"] != 200
+                ),
+                "retries": sum(request["retries"] for request in host_requests),
+                "bytes": sum(request["bytes"] for request in host_requests),
+                "seconds": round(sum(latencies), 6),
+                "p50_seconds": round(_percentile(latencies, 0.5), 6),
+                "p95_seconds": round(_percentile(latencies, 0.95), 6),
+                "max_seconds": round(latencies[-1], 6),
+            }
+
+        return {
+            **self.labels,
+            "wall_seconds": round(time.perf_counter() - self._start_time, 6),
+            "stages": stages,
+            "requests": request_summary,
+            "counters": counters,
+        }
+
+
+class JsonLinesHook:
+    # Metrics hook appending each event to a file as a line of JSON
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def __call__(self, event: dict):
+        with self._lock:
+            self._file.write(json.dumps(event) + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+@contextmanager
+def stage(name: str):
+    # Time a stage against the current report's metrics, if it has any
+
+    metrics = get_metrics()
+
+    if metrics is None:
+        yield
+    else:
+        with metrics.stage(name):
+            yield
+
+
+def record_request(*args, **kwargs):
+    metrics = get_metrics()
+
+    if metrics is not None:
+        metrics.record_request(*args, **kwargs)
+
+
+def count(name: str, amount: int = 1):
+    metrics = get_metrics()
+
+    if metrics is not None:
+        metrics.count(name, amount)
+
+
+async def timed(name: str, awaitable):
+    # Await something as a stage, for use inside asyncio.gather
+
+    with stage(name):
+        return await awaitable
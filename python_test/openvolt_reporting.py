@@ -1,16 +1,32 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import os
+import json
 import logging
-import argparse
 import helper
 import dataset
 import asyncio
-
-logging.basicConfig(
-    encoding="utf-8",
-    level=logging.DEBUG,
-    format="%(asctime)s %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+from cache import LocalCache
+from results_store import ResultsStore, get_stored_reports
+import columnar
+import pipeline
+import metrics
+import parallel
+import diagnostics
+import carbon_factors
+
+# Logging level used unless --log-level says otherwise, e.g. DEBUG to see the
+# full report data, also settable for scheduled runs through the environment
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+LOG_LEVEL = os.environ.get("OPENVOLT_LOG_LEVEL", "INFO").upper()
+
+# Ways of calculating the reports, all giving the same figures
+#   dict     - per interval dicts, the original reference implementation
+#   fused    - one pass over the intervals working out everything together
+#   columnar - NumPy arrays of intervals x fuels, for large multi-meter runs
+REPORT_ENGINES = ["dict", "fused", "columnar"]
+
+# --output-format choices and the data stream file formats each writes
+OUTPUT_FORMATS = {"csv": ("csv",), "npz": ("npz",), "both": ("csv", "npz")}
 
 
 def get_consumption_source_report(
@@ -31,7 +47,7 @@ def get_consumption_source_report(
             return None
 
         # Increase the total Kwh's with the intervals total usage
-        consumption_source[interval]["total"] += int(
+        consumption_source[interval]["total"] += helper.parse_consumption(
             meter_interval_data[interval]["consumption"]
         )
 
@@ -51,13 +67,24 @@ def get_consumption_source_report(
 
 
 def get_carbon_emissions_report(
-    meter_interval_data: dict, consumption_source: dict, carbon_emission_factors: dict
+    meter_interval_data: dict,
+    consumption_source: dict,
+    carbon_emission_factors: dict,
+    generation_mix_data: dict = None,
 ) -> dict:
     # Create a report for CO2(g) emission using Consumption Source report
-    # and the carbon emission factors from NG
+    # and the carbon emission factors from NG. Given the generation mix the
+    # Consumption Source report came from, each interval's factors come from
+    # its vector (see CarbonFactorVector) rather than a lookup by fuel name
 
     carbon_emissions = {}
 
+    interval_vectors = None
+    if generation_mix_data is not None:
+        interval_vectors = carbon_factors.get_carbon_factor_vector(
+            carbon_emission_factors
+        ).get_interval_vectors(generation_mix_data)
+
     # Loop through each of the interval datasets for the meter
     for interval in meter_interval_data:
         carbon_emissions[interval] = {}
@@ -69,6 +96,17 @@ def get_carbon_emissions_report(
         # Loop through each of the fuel types and calculate emissions for the interval
         carbon_emissions[interval]["total"] = 0
 
+        if interval_vectors is not None:
+            # Fuels in the same order the Consumption Source report has them
+            interval_consumption = consumption_source[interval]
+            for fuel_type, carbon_emission_factor in zip(*interval_vectors[interval]):
+                generated_carbon = (
+                    interval_consumption[fuel_type] * carbon_emission_factor
+                )
+                carbon_emissions[interval][fuel_type] = generated_carbon
+                carbon_emissions[interval]["total"] += generated_carbon
+            continue
+
         for fuel_type in consumption_source[interval]:
             if fuel_type != "total":
                 if fuel_type not in carbon_emissions[interval]:
@@ -87,6 +125,150 @@ def get_carbon_emissions_report(
     return carbon_emissions
 
 
+def get_report_totals(
+    consumption_source: dict,
+    carbon_emissions: dict,
+    bucket_totals: pipeline.BucketTotals = None,
+) -> tuple:
+    # Total the Consumption Source and Carbon Emissions reports across intervals,
+    # filling in the optional BucketTotals in the same pass
+
+    consumption_source_totals = {}
+    carbon_emissions_totals = {}
+
+    # Loop through the intervals of the
+    # merged datasets to calculate totals
+
+    for interval in consumption_source:
+        # Generate the consumption report, overall total kWh
+        # including breakdown by fuel type
+
+        for fuel_type in consumption_source[interval]:
+            if fuel_type not in consumption_source_totals:
+                consumption_source_totals[fuel_type] = 0
+            consumption_source_totals[fuel_type] = (
+                consumption_source_totals[fuel_type]
+                + consumption_source[interval][fuel_type]
+            )
+
+        # Generate the Carbon Emissions generated
+        # (in KG of CO2 per kWh), overall total including breakdown
+
+        for fuel_type in carbon_emissions[interval]:
+            if fuel_type not in carbon_emissions_totals:
+                carbon_emissions_totals[fuel_type] = 0
+            carbon_emissions_totals[fuel_type] = carbon_emissions_totals[fuel_type] + (
+                carbon_emissions[interval][fuel_type] / 1000
+            )
+
+        if bucket_totals is not None:
+            bucket_totals.add_interval(
+                *pipeline.report_interval(
+                    interval, consumption_source[interval], carbon_emissions[interval]
+                )
+            )
+
+    return consumption_source_totals, carbon_emissions_totals
+
+
+def get_fused_report(
+    meter_interval_data: dict,
+    generation_mix_data: dict,
+    carbon_emission_factors: dict,
+    keep_intervals: bool = False,
+    bucket_totals: pipeline.BucketTotals = None,
+) -> tuple:
+    # Single pass equivalent of get_consumption_source_report, get_carbon_emissions_report
+    # and get_report_totals, returning all four in that order. Per interval reports
+    # are only kept when keep_intervals is set so memory doesn't grow with the window,
+    # bucket_totals if given is filled in during the same pass
+
+    # Additions happen in the same order as the three separate passes
+    # so the totals come out identical to the dict based reports
+
+    # Emission factors lined up with each interval's fuels, shared by the
+    # meters using the same generation mix
+    interval_vectors = carbon_factors.get_carbon_factor_vector(
+        carbon_emission_factors
+    ).get_interval_vectors(generation_mix_data)
+
+    consumption_source = {}
+    carbon_emissions = {}
+
+    consumption_source_totals = {}
+    carbon_emissions_totals = {}
+
+    if meter_interval_data:
+        consumption_source_totals["total"] = 0
+        carbon_emissions_totals["total"] = 0
+
+    for interval, interval_data in meter_interval_data.items():
+        if interval_data["consumption_units"].upper() != "KWH":
+            logging.error(f"Found non-standard consumption unit in interval {interval}")
+            raise ValueError(
+                f"Found non-standard consumption unit in interval {interval}"
+            )
+
+        # Parse the consumption once for the whole interval
+        interval_total = helper.parse_consumption(interval_data["consumption"])
+        interval_consumption = interval_total / 100
+        interval_emissions = 0
+        fuel_consumptions = {}
+        fuel_emissions = {}
+
+        if keep_intervals:
+            consumption_source[interval] = {"total": interval_total}
+            carbon_emissions[interval] = {"total": 0}
+
+        consumption_source_totals["total"] += interval_total
+
+        # Split the consumption by fuel type, work out its emissions and
+        # add both to the running totals while the values are to hand
+        fuels, factors = interval_vectors[interval]
+        for fuel_type, perc, factor in zip(
+            fuels, generation_mix_data[interval].values(), factors
+        ):
+            fuel_consumption = interval_consumption * perc
+            generated_carbon = fuel_consumption * factor
+            interval_emissions += generated_carbon
+
+            consumption_source_totals[fuel_type] = (
+                consumption_source_totals.get(fuel_type, 0) + fuel_consumption
+            )
+            carbon_emissions_totals[fuel_type] = carbon_emissions_totals.get(
+                fuel_type, 0
+            ) + (generated_carbon / 1000)
+
+            if keep_intervals:
+                consumption_source[interval][fuel_type] = fuel_consumption
+                carbon_emissions[interval][fuel_type] = generated_carbon
+
+            if bucket_totals is not None:
+                fuel_consumptions[fuel_type] = fuel_consumption
+                fuel_emissions[fuel_type] = generated_carbon
+
+        carbon_emissions_totals["total"] += interval_emissions / 1000
+
+        if bucket_totals is not None:
+            bucket_totals.add_interval(
+                interval,
+                interval_total,
+                fuel_consumptions,
+                interval_emissions,
+                fuel_emissions,
+            )
+
+        if keep_intervals:
+            carbon_emissions[interval]["total"] = interval_emissions
+
+    return (
+        consumption_source,
+        carbon_emissions,
+        consumption_source_totals,
+        carbon_emissions_totals,
+    )
+
+
 async def generate_reports(
     start_date: datetime,
     end_date: datetime,
@@ -94,44 +276,201 @@ async def generate_reports(
     meter_id: str,
     output_file: str,
     validate_dataset: bool = True,
+    generation_mix_fetcher: dataset.GenerationMixFetcher = None,
+    engine: str = "dict",
+    carbon_emission_factors: dict = None,
+    stream: bool = False,
+    stream_chunk_window: timedelta = pipeline.STREAM_CHUNK_WINDOW,
+    output_formats: tuple = ("csv",),
+    workers: int = None,
+    bucket_sizes: list = None,
+    gap_policy: str = None,
+    results_store: ResultsStore = None,
+    use_stored_results: bool = True,
 ):
-    # Main function to generate the required reports for the test scenario
+    # Main function to generate the required reports for the test scenario,
+    # with workers above 1 the reports are worked out across a process pool.
+    # If bucket_sizes are given the totals split into those buckets are
+    # returned as well, {meter: {size: {bucket: totals}}}, see pipeline.BucketTotals.
+    # gap_policy decides what happens to intervals missing from the generation
+    # mix, see dataset.GAP_POLICIES, dataset.GAP_POLICY by default.
+    # With a results_store every meter's per interval results are stored, and
+    # unless use_stored_results is off a window the store already covers for
+    # every meter is totalled from it without going to the APIs at all
 
     consumption_source_report = {}
     carbon_emissions_report = {}
 
     consumption_source_report_totals = {}
     carbon_emissions_report_totals = {}
+    bucket_report_totals = {}
 
-    # Get a list of meters filtering on customer and/or meter id
-    logging.info("Retrieving meter interval data...")
-    meters = await dataset.get_meters(customer_id=customer_id, meter_id=meter_id)
+    # Per interval reports are only kept to export or store them
+    store_intervals = results_store is not None
+    keep_intervals = output_file is not None or store_intervals
 
-    # Get the factors for emissions generated per Kwh for fuel types
-    logging.info("Retrieving carbon emission factors...")
-    carbon_emission_factors = await dataset.get_carbon_emission_factors()
+    if stream and output_file is not None:
+        raise ValueError("Streamed reports don't keep the data streams to export")
 
-    # Loop through the meters found to cover single customer with multiple meters
-    for meter in meters:
+    if gap_policy is None:
+        gap_policy = dataset.GAP_POLICY
+
+    if gap_policy not in dataset.GAP_POLICIES:
+        raise ValueError(
+            f"Unknown gap policy {gap_policy}, expected one of {dataset.GAP_POLICIES}"
+        )
+
+    if engine not in REPORT_ENGINES:
+        raise ValueError(
+            f"Unknown report engine {engine}, expected one of {REPORT_ENGINES}"
+        )
+
+    # Exporting the data streams needs them fetched, anything else can come
+    # from results worked out before
+    if store_intervals and use_stored_results and output_file is None:
+        with metrics.stage("results_store"):
+            stored_reports = get_stored_reports(
+                results_store,
+                start_date,
+                end_date,
+                customer_id,
+                meter_id,
+                bucket_sizes=bucket_sizes,
+            )
+        if stored_reports is not None:
+            logging.info("Reports totalled from the results store")
+            return stored_reports
+
+    # Meters sharing a region and window share one generation mix download
+    if generation_mix_fetcher is None:
+        generation_mix_fetcher = dataset.GenerationMixFetcher()
+
+    # Get a list of meters filtering on customer and/or meter id and the
+    # factors for emissions generated per Kwh for fuel types at the same time,
+    # unless the caller already has the factors
+    logging.info("Retrieving meters...")
+    if carbon_emission_factors is None:
+        logging.info("Retrieving carbon emission factors...")
+        meters, carbon_emission_factors = await asyncio.gather(
+            metrics.timed(
+                "meters",
+                dataset.get_meters(customer_id=customer_id, meter_id=meter_id),
+            ),
+            metrics.timed("emission_factors", dataset.get_carbon_emission_factors()),
+        )
+    else:
+        with metrics.stage("meters"):
+            meters = await dataset.get_meters(
+                customer_id=customer_id, meter_id=meter_id
+            )
+
+    if store_intervals:
+        results_store.put_meters(customer_id, meters)
+
+    # Resolve the factors into vectors once for every meter in the report, the
+    # interval vectors it holds are the report's own and go when it finishes
+    carbon_emission_factors = carbon_factors.get_carbon_factor_vector(
+        carbon_emission_factors
+    ).for_report()
+
+    if stream:
+        # Work through the window a chunk at a time so memory stays flat
+        # however long it is, totals are identical to the other engines
+        logging.info("Streaming meter interval and generation mix data...")
+        async for meter, chunk_start, chunk_end, totals in pipeline.stream_reports(
+            start_date,
+            end_date,
+            meters,
+            carbon_emission_factors,
+            chunk_window=stream_chunk_window,
+            validate_dataset=validate_dataset,
+            bucket_sizes=bucket_sizes,
+            gap_policy=gap_policy,
+            results_store=results_store,
+        ):
+            diagnostics.log_event(
+                logging.INFO,
+                "stream_chunk_totals",
+                meter=meter,
+                chunk_end=chunk_end,
+                # Totals stay empty until the meter's first interval comes in
+                kwh=lambda: round(totals.consumption_source.get("total", 0), 2),
+                co2_kg=lambda: round(totals.carbon_emissions.get("total", 0), 2),
+            )
+            consumption_source_report_totals[meter] = totals.consumption_source
+            carbon_emissions_report_totals[meter] = totals.carbon_emissions
+
+            if bucket_sizes:
+                bucket_report_totals[meter] = totals.bucket_totals.to_dict()
+
+        if bucket_sizes:
+            return [
+                consumption_source_report_totals,
+                carbon_emissions_report_totals,
+                bucket_report_totals,
+            ]
+
+        return [consumption_source_report_totals, carbon_emissions_report_totals]
+
+    async def get_meter_datasets(meter: str) -> list:
         # Pull the postcode from the address to use with regional NationalGrid data
         postcode_region = helper.uk_address_to_region(meters[meter]["address"])
 
         # Generate both the OpenVolt meter interval data and
         # National Grid Generation / Emission data
-        logging.info("Retrieving meter interval data...")
-        logging.info("Retrieving generation mix data...")
-
-        meter_interval_data, generation_mix_data = await asyncio.gather(
-            dataset.get_meter_interval_data(start_date, end_date, meter),
-            dataset.get_generation_mix_data(start_date, end_date, postcode_region),
+        return await asyncio.gather(
+            metrics.timed(
+                "meter_intervals",
+                dataset.get_meter_interval_data(start_date, end_date, meter),
+            ),
+            metrics.timed(
+                "generation_mix",
+                generation_mix_fetcher.get(start_date, end_date, postcode_region),
+            ),
         )
 
-        # Validate dataset to ensure each meter interval has a corresponding entry
+    # Fetch the datasets for every meter together, the number of requests
+    # actually in flight is capped by the dataset request concurrency limit
+    logging.info("Retrieving meter interval data...")
+    logging.info("Retrieving generation mix data...")
+    meter_datasets = await asyncio.gather(
+        *(get_meter_datasets(meter) for meter in meters)
+    )
 
-        if validate_dataset:
-            if not dataset.validate_openvolt_nationalgrid_datasets(
-                meter_interval_data, generation_mix_data
-            ):
+    logging.info(
+        f"Generation mix fetches: {generation_mix_fetcher.requested} requested, {generation_mix_fetcher.fetched} downloaded, {generation_mix_fetcher.saved} saved by dedup"
+    )
+    if generation_mix_fetcher.national_fallbacks:
+        logging.warning(
+            f"Report uses the national generation mix for regions {sorted(generation_mix_fetcher.national_fallbacks)}, their regional data couldn't be had"
+        )
+
+    # Validate dataset to ensure each meter interval has a corresponding entry,
+    # filling any gaps in the generation mix as per the gap policy first, once
+    # for each generation mix dataset the meters share
+    if validate_dataset:
+        gap_filler = dataset.GenerationMixGapFiller(gap_policy)
+        for meter_index, (
+            meter,
+            (meter_interval_data, generation_mix_data),
+        ) in enumerate(zip(meters, meter_datasets)):
+            with metrics.stage("validation"):
+                dataset_valid = dataset.validate_openvolt_nationalgrid_datasets(
+                    meter_interval_data, generation_mix_data
+                )
+            if not dataset_valid and gap_policy != "fail":
+                with metrics.stage("gap_fill"):
+                    generation_mix_data = await gap_filler.fill(
+                        meter_interval_data,
+                        generation_mix_data,
+                        helper.uk_address_to_region(meters[meter]["address"]),
+                    )
+                meter_datasets[meter_index] = [meter_interval_data, generation_mix_data]
+                with metrics.stage("validation"):
+                    dataset_valid = dataset.validate_openvolt_nationalgrid_datasets(
+                        meter_interval_data, generation_mix_data
+                    )
+            if not dataset_valid:
                 logging.error(
                     "Missing intervals from NationalGrid dataset, dataset validation failed"
                 )
@@ -139,67 +478,288 @@ async def generate_reports(
                     "Missing intervals from NationalGrid dataset, dataset validation failed"
                 )
 
+    # Work every meter's reports out at once across worker processes, the
+    # results are identical to working them out here one meter at a time
+    parallel_reports = None
+    if workers and workers > 1 and len(meter_datasets) > 1:
+        with metrics.stage("parallel_reports"):
+            parallel_reports = await parallel.get_reports(
+                meter_datasets,
+                carbon_emission_factors,
+                workers,
+                engine=engine,
+                keep_intervals=output_file is not None or store_intervals,
+                bucket_sizes=bucket_sizes,
+            )
+
+    # Loop through the meters found to cover single customer with multiple meters
+    for meter_index, (meter, (meter_interval_data, generation_mix_data)) in enumerate(
+        zip(meters, meter_datasets)
+    ):
         # Generate raw reports for both Consumption Source(Generation Mix)
         # and Carbon Emissions for the OpenVolt meter data
 
-        logging.info("Generating consumption source report...")
-        consumption_source_report[meter] = get_consumption_source_report(
-            meter_interval_data, generation_mix_data
-        )
-        logging.info("Generating carbon emissions report...")
-        carbon_emissions_report[meter] = get_carbon_emissions_report(
-            meter_interval_data,
-            consumption_source_report[meter],
-            carbon_emission_factors,
+        meter_bucket_totals = None
+        if bucket_sizes:
+            meter_bucket_totals = pipeline.BucketTotals(bucket_sizes)
+
+        # One line per meter adds up over a large portfolio, so it's sampled
+        diagnostics.log_event(
+            logging.INFO,
+            "meter_report",
+            meter=meter,
+            engine=engine,
+            workers=workers if parallel_reports is not None else None,
+            intervals=len(meter_interval_data),
         )
 
-        logging.info("Building final report...")
+        if parallel_reports is not None:
+            (
+                consumption_source_report[meter],
+                carbon_emissions_report[meter],
+                consumption_source_report_totals[meter],
+                carbon_emissions_report_totals[meter],
+            ) = parallel_reports[meter_index][:4]
+
+            if bucket_sizes:
+                bucket_report_totals[meter] = parallel_reports[meter_index][4]
+        elif engine == "fused":
+            # Same figures in one pass, buckets included, per interval
+            # detail is only kept if it's being exported
+            with metrics.stage("reports"):
+                (
+                    consumption_source_report[meter],
+                    carbon_emissions_report[meter],
+                    consumption_source_report_totals[meter],
+                    carbon_emissions_report_totals[meter],
+                ) = get_fused_report(
+                    meter_interval_data,
+                    generation_mix_data,
+                    carbon_emission_factors,
+                    keep_intervals=output_file is not None or store_intervals,
+                    bucket_totals=meter_bucket_totals,
+                )
+        elif engine == "columnar":
+            # Same figures from array operations
+            with metrics.stage("reports"):
+                (
+                    consumption_source_report[meter],
+                    carbon_emissions_report[meter],
+                    consumption_source_report_totals[meter],
+                    carbon_emissions_report_totals[meter],
+                ) = columnar.get_reports(
+                    meter_interval_data,
+                    generation_mix_data,
+                    carbon_emission_factors,
+                    keep_intervals=keep_intervals,
+                    bucket_totals=meter_bucket_totals,
+                )
+        else:
+            with metrics.stage("consumption_report"):
+                consumption_source_report[meter] = get_consumption_source_report(
+                    meter_interval_data, generation_mix_data
+                )
+            with metrics.stage("emissions_report"):
+                carbon_emissions_report[meter] = get_carbon_emissions_report(
+                    meter_interval_data,
+                    consumption_source_report[meter],
+                    carbon_emission_factors,
+                    generation_mix_data,
+                )
+
+            # Build the final dataset to deliver the required report
+            with metrics.stage("totals"):
+                (
+                    consumption_source_report_totals[meter],
+                    carbon_emissions_report_totals[meter],
+                ) = get_report_totals(
+                    consumption_source_report[meter],
+                    carbon_emissions_report[meter],
+                    bucket_totals=meter_bucket_totals,
+                )
+
+        # Every engine has split the totals into buckets as it totalled them,
+        # the process pool sends them back already laid out
+        if meter_bucket_totals is not None and meter not in bucket_report_totals:
+            bucket_report_totals[meter] = meter_bucket_totals.to_dict()
+
+        # Keep the per interval results to answer later reports from
+        window = helper.half_hour_window(start_date, end_date)
+        if store_intervals and window:
+            with metrics.stage("results_store"):
+                results_store.put_emissions_intervals(
+                    meter,
+                    window[0],
+                    window[-1],
+                    pipeline.report_intervals(
+                        consumption_source_report[meter], carbon_emissions_report[meter]
+                    ),
+                )
 
-        # Build the final dataset to deliver the required report
+        # For validation, optional export of data streams to a file
+        if output_file is not None:
+            with metrics.stage("export"):
+                helper.output_datastream_to_file(
+                    meter,
+                    output_file,
+                    meter_interval_data,
+                    generation_mix_data,
+                    consumption_source_report[meter],
+                    carbon_emissions_report[meter],
+                    output_formats=output_formats,
+                )
 
-        consumption_source_report_totals[meter] = {}
-        carbon_emissions_report_totals[meter] = {}
+        # Drop per interval reports only kept to store them
+        if output_file is None:
+            consumption_source_report[meter] = {}
+            carbon_emissions_report[meter] = {}
 
-        # Loop through the intervals of the
-        # merged datasets to calculate totals
+    # return the datasets ready to be consumed
+    if bucket_sizes:
+        return [
+            consumption_source_report_totals,
+            carbon_emissions_report_totals,
+            bucket_report_totals,
+        ]
 
-        for interval in consumption_source_report[meter]:
-            # Generate the consumption report, overall total kWh
-            # including breakdown by fuel type
+    return [consumption_source_report_totals, carbon_emissions_report_totals]
 
-            for fuel_type in consumption_source_report[meter][interval]:
-                if fuel_type not in consumption_source_report_totals[meter]:
-                    consumption_source_report_totals[meter][fuel_type] = 0
-                consumption_source_report_totals[meter][fuel_type] = (
-                    consumption_source_report_totals[meter][fuel_type]
-                    + consumption_source_report[meter][interval][fuel_type]
-                )
 
-            # Generate the Carbon Emissions generated
-            # (in KG of CO2 per kWh), overall total including breakdown
+def read_batch_file(batch_file: str) -> list:
+    # Read the batch of reports to run, one customer_id per line or meter:<meter_id>
+    # for a single meter, blank lines and lines starting with # are skipped.
+    # Returns a list of (customer_id, meter_id)
 
-            for fuel_type in carbon_emissions_report[meter][interval]:
-                if fuel_type not in carbon_emissions_report_totals[meter]:
-                    carbon_emissions_report_totals[meter][fuel_type] = 0
-                carbon_emissions_report_totals[meter][
-                    fuel_type
-                ] = carbon_emissions_report_totals[meter][fuel_type] + (
-                    carbon_emissions_report[meter][interval][fuel_type] / 1000
+    batch = []
+
+    with open(batch_file) as batch_lines:
+        for line in batch_lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            if line.lower().startswith("meter:"):
+                batch.append((None, line.split(":", 1)[1].strip()))
+            else:
+                batch.append((line.split(":", 1)[-1].strip(), None))
+
+    return batch
+
+
+async def generate_batch_reports(
+    batch: list,
+    start_date: datetime,
+    end_date: datetime,
+    output_dir: str,
+    concurrency: int = 4,
+    engine: str = "dict",
+    metrics_hook=None,
+    bucket_sizes: list = None,
+    results_store: ResultsStore = None,
+    use_stored_results: bool = True,
+) -> dict:
+    # Generate reports for a batch of (customer_id, meter_id) in one process,
+    # up to concurrency at a time, sharing the emission factors and generation
+    # mix downloads between them. Each report's totals and metrics are written
+    # to a JSON file in output_dir, a failed report is logged and doesn't stop
+    # the rest. metrics_hook is given every report's metric events as they happen,
+    # results_store is shared by every report (see generate_reports)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    generation_mix_fetcher = dataset.GenerationMixFetcher()
+
+    logging.info("Retrieving carbon emission factors...")
+    carbon_emission_factors = carbon_factors.get_carbon_factor_vector(
+        await dataset.get_carbon_emission_factors()
+    )
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def generate_batch_report(customer_id: str, meter_id: str) -> list:
+        if customer_id:
+            report_name = f"customer_{customer_id}"
+        else:
+            report_name = f"meter_{meter_id}"
+
+        # Each report runs in its own task so this doesn't reach the others,
+        # a shared generation mix download counts against the report starting it
+        report_metrics = metrics.Metrics(
+            hook=metrics_hook,
+            labels={"report": report_name},
+        )
+        metrics.set_metrics(report_metrics)
+
+        async with semaphore:
+            diagnostics.log_event(
+                logging.INFO, "batch_report_started", report=report_name
+            )
+            try:
+                (
+                    consumption_source_report_totals,
+                    carbon_emissions_report_totals,
+                    *bucket_report_totals,
+                ) = await generate_reports(
+                    start_date,
+                    end_date,
+                    customer_id,
+                    meter_id,
+                    None,
+                    generation_mix_fetcher=generation_mix_fetcher,
+                    engine=engine,
+                    carbon_emission_factors=carbon_emission_factors,
+                    bucket_sizes=bucket_sizes,
+                    results_store=results_store,
+                    use_stored_results=use_stored_results,
                 )
+            except Exception as e:
+                logging.error(f"Batch report {report_name} failed: {e}")
+                return [report_name, None]
+
+        with open(os.path.join(output_dir, f"{report_name}.json"), "w") as json_file:
+            json.dump(
+                {
+                    "customer_id": customer_id,
+                    "meter_id": meter_id,
+                    "start_date": start_date.isoformat(),
+                    "end_date": end_date.isoformat(),
+                    "consumption_source_report_totals": consumption_source_report_totals,
+                    "carbon_emissions_report_totals": carbon_emissions_report_totals,
+                    **(
+                        {"bucket_report_totals": bucket_report_totals[0]}
+                        if bucket_report_totals
+                        else {}
+                    ),
+                    "metrics": report_metrics.summary(),
+                },
+                json_file,
+                indent=2,
+            )
 
-        # For validation, optional export of data streams to a file
-        if output_file is not None:
-            helper.output_datastream_to_file(
-                meter,
-                output_file,
-                meter_interval_data,
-                generation_mix_data,
-                consumption_source_report[meter],
-                carbon_emissions_report[meter],
+        return [
+            report_name,
+            [consumption_source_report_totals, carbon_emissions_report_totals],
+        ]
+
+    batch_results = dict(
+        await asyncio.gather(
+            *(
+                generate_batch_report(customer_id, meter_id)
+                for customer_id, meter_id in batch
             )
+        )
+    )
 
-    # return the datasets ready to be consumed
-    return [consumption_source_report_totals, carbon_emissions_report_totals]
+    failed = [name for name, result in batch_results.items() if result is None]
+
+    logging.info(
+        f"Batch complete, {len(batch_results) - len(failed)} reports written to {output_dir}, {len(failed)} failed"
+    )
+    logging.info(
+        f"Generation mix fetches: {generation_mix_fetcher.requested} requested, {generation_mix_fetcher.fetched} downloaded, {generation_mix_fetcher.saved} saved by dedup"
+    )
+
+    return batch_results
 
 
 def display_report(
@@ -237,8 +797,27 @@ def display_report(
     print("\n")
 
 
+def display_bucket_report(bucket_report_totals: dict):
+    # Consumption and emissions totals per bucket, one line each
+
+    for meter in bucket_report_totals:
+        print(f"Meter ID {meter} by bucket")
+
+        for bucket_size, buckets in bucket_report_totals[meter].items():
+            print(f"\n  {bucket_size}")
+            for bucket_label, totals in buckets.items():
+                print(
+                    f"    {bucket_label} {round(totals['consumption_source']['total'],2)} kWh, {round(totals['carbon_emissions']['total'],2)} CO2 kg's"
+                )
+
+        print("\n")
+
+
 def process_cmdline_parser():
-    # Set up the parser to accept command line arguments
+    # Set up the parser to accept command line arguments, argparse is only
+    # imported here as nothing else needs it
+
+    import argparse
 
     parser = argparse.ArgumentParser(description="OpenVolt API Test")
     parser.add_argument("--customerid", "-c", help="Generate data using customer_id")
@@ -248,9 +827,185 @@ def process_cmdline_parser():
     parser.add_argument(
         "--output", "-o", help="specify file output prefix for debug data streams"
     )
+    parser.add_argument(
+        "--output-format",
+        choices=list(OUTPUT_FORMATS),
+        default="csv",
+        help="format of the --output data streams, npz needs numpy",
+    )
+    parser.add_argument(
+        "--batch",
+        "-b",
+        help="file of customer ids (or meter:<meter_id>) to report on in one run",
+    )
+    parser.add_argument(
+        "--batch-output",
+        default="batch_reports",
+        help="directory the batch report JSON files are written to",
+    )
+    parser.add_argument(
+        "--batch-concurrency",
+        type=int,
+        default=4,
+        help="maximum number of batch reports generated at once",
+    )
+    parser.add_argument(
+        "--concurrency",
+        "-n",
+        type=int,
+        default=dataset.MAX_CONCURRENT_REQUESTS,
+        help="maximum number of API requests in flight at once",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=8,
+        help="maximum pooled connections kept open per API host",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30.0,
+        help="seconds to wait on an API response before giving up",
+    )
+    parser.add_argument(
+        "--no-keep-alive",
+        action="store_true",
+        help="close API connections after every request",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="times a throttled, failed or dropped API request is retried",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        help="maximum API requests per second sent to each host",
+    )
+    parser.add_argument(
+        "--hedge-after",
+        type=float,
+        help="seconds to wait on an API response before sending a second copy",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=REPORT_ENGINES,
+        default="dict",
+        help="how the reports are calculated, columnar needs numpy",
+    )
+    parser.add_argument(
+        "--buckets",
+        nargs="+",
+        choices=pipeline.BUCKET_SIZES,
+        help="also split the totals into these buckets, from the same data",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="worker processes the per meter reports are worked out across",
+    )
+    parser.add_argument(
+        "--regional",
+        action="store_true",
+        help="use the regional generation mix for each meter's postcode",
+    )
+    parser.add_argument(
+        "--no-regional-fallback",
+        action="store_true",
+        help="fail rather than use the national generation mix if a region's can't be had",
+    )
+    parser.add_argument(
+        "--carbon-intensity-header",
+        action="append",
+        default=[],
+        metavar="NAME:VALUE",
+        help="extra header sent to the Carbon Intensity API, e.g. for authorisation, repeatable",
+    )
+    parser.add_argument(
+        "--openvolt-url",
+        default=dataset.OPENVOLT_API_URL,
+        help="OpenVolt API base URL",
+    )
+    parser.add_argument(
+        "--carbon-intensity-url",
+        default=dataset.CARBON_INTENSITY_API_URL,
+        help="Carbon Intensity API base URL",
+    )
+    parser.add_argument(
+        "--gap-policy",
+        choices=dataset.GAP_POLICIES,
+        default=dataset.GAP_POLICY,
+        help="how intervals missing from the generation mix are handled",
+    )
+    parser.add_argument(
+        "--fuel-buckets",
+        help="JSON file mapping generation mix fuels to the emission factor sub-fuels averaged into them, as a list, or a dict of weights",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="fetch and total the window a chunk at a time to bound memory",
+    )
+    parser.add_argument(
+        "--stream-chunk-days",
+        type=int,
+        default=pipeline.STREAM_CHUNK_WINDOW.days,
+        help="days of intervals in each streamed chunk",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="write a JSON summary of stage timings and API requests to this file",
+    )
+    parser.add_argument(
+        "--metrics-events",
+        help="append every stage and API request metric to this file as JSON lines",
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        metavar="PORT",
+        help="run as a service answering report requests over HTTP on this port",
+    )
+    parser.add_argument(
+        "--serve-host",
+        default="127.0.0.1",
+        help="address the --serve service listens on",
+    )
+    parser.add_argument(
+        "--results-db",
+        help="sqlite file every report's per interval results are stored in, reports it already covers are answered from it",
+    )
+    parser.add_argument(
+        "--refresh-results",
+        action="store_true",
+        help="work reports out from the APIs again even if --results-db covers them",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=LOG_LEVELS,
+        default=LOG_LEVEL,
+        help="lowest level of log message shown, DEBUG includes the full report data",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.path.join(os.path.expanduser("~"), ".cache", "openvolt"),
+        help="directory for the local NationalGrid data and meter interval cache",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always fetch NationalGrid data and meter intervals from the API, bypassing the local cache and meter interval store",
+    )
     args = vars(parser.parse_args())
 
-    logging.debug(f"Parser arguments: {args}")
+    # argparse doesn't check a default against choices, so one taken from
+    # OPENVOLT_LOG_LEVEL is checked here
+    if args["log_level"] not in LOG_LEVELS:
+        parser.error(
+            f"OPENVOLT_LOG_LEVEL must be one of {', '.join(LOG_LEVELS)}, got {args['log_level']}"
+        )
 
     return args
 
@@ -263,9 +1018,18 @@ async def main():
     # Get list of command line arguements
     args = process_cmdline_parser()
 
+    logging.basicConfig(
+        encoding="utf-8",
+        level=args["log_level"],
+        format="%(asctime)s %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    diagnostics.log_event(logging.DEBUG, "parser_arguments", sample=False, args=args)
+
     # Set default target customer/meter and timeframe's to match the test scope
 
-    if not args["customerid"] and not args["meterid"]:
+    if not args["customerid"] and not args["meterid"] and not args["batch"]:
         args["customerid"] = "6514153c23e3d1424bf82738"
         logging.info(
             f"Missing customerid and meterid parameters, customerid set to test customer id: {args['customerid']}"
@@ -283,30 +1047,153 @@ async def main():
     end_date = datetime.strptime(args["enddate"], "%Y-%m-%d")
     output_file = args["output"]
 
+    # Share one pooled client across all OpenVolt and NationalGrid requests,
+    # only created once the first request is made
+    dataset.set_client_options(
+        pool_size=args["pool_size"],
+        timeout=args["timeout"],
+        keep_alive=not args["no_keep_alive"],
+        max_concurrent_requests=args["concurrency"],
+        retries=args["retries"],
+        rate_limit=args["rate_limit"],
+        hedge_after=args["hedge_after"],
+    )
+
+    dataset.GAP_POLICY = args["gap_policy"]
+
+    dataset.OPENVOLT_API_URL = args["openvolt_url"].rstrip("/")
+    dataset.CARBON_INTENSITY_API_URL = args["carbon_intensity_url"].rstrip("/")
+    dataset.USE_REGIONAL_GENERATION_MIX = args["regional"]
+    dataset.REGIONAL_FALLBACK_TO_NATIONAL = not args["no_regional_fallback"]
+
+    for header in args["carbon_intensity_header"]:
+        name, value = header.split(":", 1)
+        dataset.CARBON_INTENSITY_HEADERS[name.strip()] = value.strip()
+
+    if args["fuel_buckets"]:
+        carbon_factors.FUEL_BUCKETS = carbon_factors.load_fuel_buckets(
+            args["fuel_buckets"]
+        )
+
+    # Reuse previously downloaded generation mix and emission factors
+    if not args["no_cache"]:
+        dataset.set_cache(
+            LocalCache(os.path.join(args["cache_dir"], "openvolt_cache.sqlite"))
+        )
+
+    # Store per interval results, answering repeat reports from them
+    results_store = None
+    if args["results_db"]:
+        results_store = ResultsStore(args["results_db"])
+
+    # Time each stage and API request of the run, optionally writing every
+    # event out as it happens for monitoring to pick up
+    metrics_hook = None
+    if args["metrics_events"]:
+        metrics_hook = metrics.JsonLinesHook(args["metrics_events"])
+
+    run_metrics = metrics.Metrics(
+        hook=metrics_hook,
+        labels={"customer_id": customer_id, "meter_id": meter_id},
+    )
+    metrics.set_metrics(run_metrics)
+
     # Uncomment as a quick way to test start and end dates
     # start_date = datetime.strptime("2023-01-01 00:00", "%Y-%m-%d %H:%M")
     # end_date = datetime.strptime("2023-01-01 02:00", "%Y-%m-%d %H:%M")
 
-    # Generate the reports as per requirements
-    logging.info("Starting Report Generation...")
-    (
-        consumption_source_report_totals,
-        carbon_emissions_report_totals,
-    ) = await generate_reports(start_date, end_date, customer_id, meter_id, output_file)
-
-    # Dump the raw data to debug
-    logging.debug("Consumption Report Data")
-    logging.debug(consumption_source_report_totals)
-    logging.debug("Carbon Emissions Report Data")
-    logging.debug(carbon_emissions_report_totals)
-
-    # Display final report
-    display_report(
-        consumption_source_report_totals,
-        carbon_emissions_report_totals,
-        start_date,
-        end_date,
-    )
+    if args["serve"] is not None:
+        # Imported here as the service imports this module
+        import service
+
+        # Reports run on the service's own event loop, this one just waits
+        logging.info("Starting Report Service...")
+        service.serve(
+            args["serve_host"],
+            args["serve"],
+            engine=args["engine"],
+            results_store=results_store,
+        )
+    elif args["batch"]:
+        # Run every report in the batch file, writing results to files
+        logging.info("Starting Batch Report Generation...")
+        await generate_batch_reports(
+            read_batch_file(args["batch"]),
+            start_date,
+            end_date,
+            args["batch_output"],
+            concurrency=args["batch_concurrency"],
+            engine=args["engine"],
+            metrics_hook=metrics_hook,
+            bucket_sizes=args["buckets"],
+            results_store=results_store,
+            use_stored_results=not args["refresh_results"],
+        )
+    else:
+        # Generate the reports as per requirements
+        logging.info("Starting Report Generation...")
+        (
+            consumption_source_report_totals,
+            carbon_emissions_report_totals,
+            *bucket_report_totals,
+        ) = await generate_reports(
+            start_date,
+            end_date,
+            customer_id,
+            meter_id,
+            output_file,
+            engine=args["engine"],
+            stream=args["stream"],
+            stream_chunk_window=timedelta(days=args["stream_chunk_days"]),
+            output_formats=OUTPUT_FORMATS[args["output_format"]],
+            workers=args["workers"],
+            bucket_sizes=args["buckets"],
+            results_store=results_store,
+            use_stored_results=not args["refresh_results"],
+        )
+
+        # Dump the raw data to debug, only formatted if debug logging is on
+        diagnostics.log_event(
+            logging.DEBUG,
+            "report_totals",
+            sample=False,
+            max_length=None,
+            consumption_source=consumption_source_report_totals,
+            carbon_emissions=carbon_emissions_report_totals,
+        )
+
+        # Display final report
+        display_report(
+            consumption_source_report_totals,
+            carbon_emissions_report_totals,
+            start_date,
+            end_date,
+        )
+
+        if bucket_report_totals:
+            display_bucket_report(bucket_report_totals[0])
+
+    for host, stats in dataset.get_connection_stats().items():
+        logging.info(
+            f"{host}: {stats['requests']} requests, {stats['opened']} connections opened, {stats['reused']} reused"
+        )
+
+    run_summary = run_metrics.summary()
+
+    for stage, timing in run_summary["stages"].items():
+        logging.info(
+            f"Stage {stage}: {timing['calls']} calls, {round(timing['busy_seconds'], 3)} seconds"
+        )
+
+    if args["metrics"]:
+        with open(args["metrics"], "w") as json_file:
+            json.dump(run_summary, json_file, indent=2)
+
+    if metrics_hook:
+        metrics_hook.close()
+
+    if results_store:
+        results_store.close()
 
     app_end_time = datetime.now()
 
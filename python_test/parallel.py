@@ -0,0 +1,151 @@
+import asyncio
+import logging
+
+import columnar
+import pipeline
+import carbon_factors
+
+# Generation mix datasets and emission factors for the reports being worked
+# out, set once per worker process by the pool initializer rather than being
+# pickled again with every meter
+_generation_mixes = None
+_carbon_emission_factors = None
+
+
+def _init_worker(generation_mixes: list, carbon_emission_factors: dict):
+    global _generation_mixes, _carbon_emission_factors
+
+    _generation_mixes = generation_mixes
+    _carbon_emission_factors = carbon_factors.get_carbon_factor_vector(
+        carbon_emission_factors
+    )
+
+
+def _get_meter_reports(
+    meter_interval_data: dict,
+    generation_mix_index: int,
+    engine: str,
+    keep_intervals: bool,
+    bucket_sizes: list = None,
+) -> tuple:
+    # Worker side, the meter's reports from the chosen engine returned in the
+    # same (consumption source, carbon emissions, totals...) order as the fused
+    # and columnar engines, per interval detail only sent back if it's needed.
+    # With bucket_sizes the bucket totals dict is added on the end
+
+    # Imported here as openvolt_reporting imports this module
+    import openvolt_reporting
+
+    generation_mix_data = _generation_mixes[generation_mix_index]
+
+    bucket_totals = None
+    if bucket_sizes:
+        bucket_totals = pipeline.BucketTotals(bucket_sizes)
+
+    if engine == "fused":
+        reports = openvolt_reporting.get_fused_report(
+            meter_interval_data,
+            generation_mix_data,
+            _carbon_emission_factors,
+            keep_intervals=keep_intervals,
+            bucket_totals=bucket_totals,
+        )
+    else:
+        if engine == "columnar":
+            reports = columnar.get_reports(
+                meter_interval_data,
+                generation_mix_data,
+                _carbon_emission_factors,
+                keep_intervals=keep_intervals,
+                bucket_totals=bucket_totals,
+            )
+        else:
+            consumption_source_report = (
+                openvolt_reporting.get_consumption_source_report(
+                    meter_interval_data, generation_mix_data
+                )
+            )
+            carbon_emissions_report = openvolt_reporting.get_carbon_emissions_report(
+                meter_interval_data,
+                consumption_source_report,
+                _carbon_emission_factors,
+                generation_mix_data,
+            )
+            reports = (
+                consumption_source_report,
+                carbon_emissions_report,
+                *openvolt_reporting.get_report_totals(
+                    consumption_source_report,
+                    carbon_emissions_report,
+                    bucket_totals=bucket_totals,
+                ),
+            )
+
+        if not keep_intervals:
+            reports = ({}, {}, *reports[2:])
+
+    if bucket_totals is not None:
+        return (*reports, bucket_totals.to_dict())
+
+    return reports
+
+
+async def get_reports(
+    meter_datasets: list,
+    carbon_emission_factors: dict,
+    workers: int,
+    engine: str = "dict",
+    keep_intervals: bool = False,
+    bucket_sizes: list = None,
+) -> list:
+    # Work out the reports for every (meter interval data, generation mix data)
+    # pair across a pool of worker processes, returning the four reports for
+    # each in the same order. Meters sharing a generation mix (the same dict,
+    # as handed out by GenerationMixFetcher) share one copy in the workers
+
+    generation_mixes = []
+    generation_mix_indexes = {}
+    meter_tasks = []
+
+    for meter_interval_data, generation_mix_data in meter_datasets:
+        if id(generation_mix_data) not in generation_mix_indexes:
+            generation_mix_indexes[id(generation_mix_data)] = len(generation_mixes)
+            generation_mixes.append(generation_mix_data)
+
+        meter_tasks.append(
+            (meter_interval_data, generation_mix_indexes[id(generation_mix_data)])
+        )
+
+    logging.info(
+        f"Working out reports for {len(meter_tasks)} meters across {workers} processes, {len(generation_mixes)} generation mix datasets shared"
+    )
+
+    # Imported here as it brings in multiprocessing, which most runs don't need
+    from concurrent.futures import ProcessPoolExecutor
+
+    loop = asyncio.get_running_loop()
+
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(generation_mixes, carbon_emission_factors),
+    )
+
+    try:
+        return await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    pool,
+                    _get_meter_reports,
+                    meter_interval_data,
+                    generation_mix_index,
+                    engine,
+                    keep_intervals,
+                    bucket_sizes,
+                )
+                for meter_interval_data, generation_mix_index in meter_tasks
+            )
+        )
+    finally:
+        # Don't hold up the event loop while the workers exit
+        await asyncio.to_thread(pool.shutdown, True, cancel_futures=True)
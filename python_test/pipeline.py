@@ -0,0 +1,364 @@
+import asyncio
+import logging
+import functools
+from zoneinfo import ZoneInfo
+from datetime import datetime, timedelta, timezone
+
+import dataset
+import helper
+import metrics
+import carbon_factors
+
+# Window of intervals each streamed chunk covers, peak memory
+# depends on this and the number of meters, not the date range
+STREAM_CHUNK_WINDOW = timedelta(days=7)
+
+# Sizes of bucket totals can be split into, and the local time zone and
+# weekday hours (start inclusive, end exclusive) counted as peak
+BUCKET_SIZES = ["daily", "weekly", "monthly", "peak"]
+REPORT_TIMEZONE = ZoneInfo("Europe/London")
+REPORT_PEAK_HOURS = (16, 19)
+
+
+def join_intervals(meter_interval_data: dict, generation_mix_data: dict):
+    # Pair each meter interval with the NationalGrid generation mix for it
+
+    for interval, interval_data in meter_interval_data.items():
+        yield interval, interval_data, generation_mix_data[interval]
+
+
+def consumption_stage(joined_intervals):
+    # Split each interval's kWh consumption across the fuel types in its mix
+
+    for interval, interval_data, generation_mix in joined_intervals:
+        if interval_data["consumption_units"].upper() != "KWH":
+            logging.error(f"Found non-standard consumption unit in interval {interval}")
+            raise ValueError(
+                f"Found non-standard consumption unit in interval {interval}"
+            )
+
+        total = helper.parse_consumption(interval_data["consumption"])
+        consumption = total / 100
+
+        yield interval, total, {
+            fuel_type: consumption * perc for fuel_type, perc in generation_mix.items()
+        }
+
+
+def emissions_stage(consumption_intervals, interval_vectors: dict):
+    # Work out the gCO2 emitted per fuel type and in total for each interval,
+    # interval_vectors being the emission factors lined up with each interval's
+    # fuels (see CarbonFactorVector.get_interval_vectors)
+
+    for interval, total, fuel_consumption in consumption_intervals:
+        fuels, factors = interval_vectors[interval]
+        fuel_emissions = {
+            fuel_type: consumption * factor
+            for fuel_type, consumption, factor in zip(
+                fuels, fuel_consumption.values(), factors
+            )
+        }
+
+        # Added one at a time, in fuel order, to match the dict based reports
+        emissions_total = 0
+        for generated_carbon in fuel_emissions.values():
+            emissions_total += generated_carbon
+
+        yield interval, total, fuel_consumption, emissions_total, fuel_emissions
+
+
+def report_interval(
+    interval: str, consumption_source: dict, carbon_emissions: dict
+) -> tuple:
+    # An interval's Consumption Source and Carbon Emissions reports back as the
+    # (interval, total, fuel consumption, emissions total, fuel emissions)
+    # tuple emissions_stage yields
+
+    return (
+        interval,
+        consumption_source["total"],
+        {
+            fuel_type: consumption
+            for fuel_type, consumption in consumption_source.items()
+            if fuel_type != "total"
+        },
+        carbon_emissions["total"],
+        {
+            fuel_type: generated_carbon
+            for fuel_type, generated_carbon in carbon_emissions.items()
+            if fuel_type != "total"
+        },
+    )
+
+
+def report_intervals(consumption_source_report: dict, carbon_emissions_report: dict):
+    # Every interval of the reports as report_interval tuples, in interval order
+
+    for interval, consumption_source in consumption_source_report.items():
+        yield report_interval(
+            interval, consumption_source, carbon_emissions_report[interval]
+        )
+
+
+class ReportTotals:
+    # Running Consumption Source and Carbon Emissions (kg) totals for a meter,
+    # built up an interval at a time in the same order as get_report_totals
+
+    def __init__(self, bucket_totals=None):
+        self.consumption_source = {}
+        self.carbon_emissions = {}
+
+        # Optional BucketTotals filled in from the same intervals
+        self.bucket_totals = bucket_totals
+
+    def add_interval(
+        self,
+        interval: str,
+        total,
+        fuel_consumption: dict,
+        emissions_total: float,
+        fuel_emissions: dict,
+    ):
+        self.consumption_source["total"] = (
+            self.consumption_source.get("total", 0) + total
+        )
+        for fuel_type, consumption in fuel_consumption.items():
+            self.consumption_source[fuel_type] = (
+                self.consumption_source.get(fuel_type, 0) + consumption
+            )
+
+        self.carbon_emissions["total"] = self.carbon_emissions.get("total", 0) + (
+            emissions_total / 1000
+        )
+        for fuel_type, generated_carbon in fuel_emissions.items():
+            self.carbon_emissions[fuel_type] = self.carbon_emissions.get(
+                fuel_type, 0
+            ) + (generated_carbon / 1000)
+
+        if self.bucket_totals is not None:
+            self.bucket_totals.add_interval(
+                interval, total, fuel_consumption, emissions_total, fuel_emissions
+            )
+
+    def add_intervals(self, emissions_intervals):
+        for emissions_interval in emissions_intervals:
+            self.add_interval(*emissions_interval)
+
+
+@functools.lru_cache(maxsize=65536)
+def get_bucket_labels(half_hour: int) -> dict:
+    # Bucket each size puts the half-hour interval in, by UK local time so a
+    # day or month matches the customer's, peak is REPORT_PEAK_HOURS on weekdays
+
+    local_time = (
+        helper.half_hour_to_datetime(half_hour)
+        .replace(tzinfo=timezone.utc)
+        .astimezone(REPORT_TIMEZONE)
+    )
+    iso_year, iso_week, _ = local_time.isocalendar()
+
+    peak = (
+        REPORT_PEAK_HOURS[0] <= local_time.hour < REPORT_PEAK_HOURS[1]
+        and local_time.weekday() < 5
+    )
+
+    return {
+        "daily": local_time.strftime("%Y-%m-%d"),
+        "weekly": f"{iso_year}-W{iso_week:02d}",
+        "monthly": local_time.strftime("%Y-%m"),
+        "peak": "peak" if peak else "off_peak",
+    }
+
+
+class BucketTotals:
+    # Consumption Source and Carbon Emissions (kg) totals for a meter split
+    # into buckets of each size, {size: {bucket: ReportTotals}}, built up an
+    # interval at a time alongside the overall totals. A bucket holding the
+    # whole window comes out identical to the overall totals
+
+    def __init__(self, bucket_sizes: list = BUCKET_SIZES):
+        for bucket_size in bucket_sizes:
+            if bucket_size not in BUCKET_SIZES:
+                raise ValueError(
+                    f"Unknown bucket size {bucket_size}, expected one of {BUCKET_SIZES}"
+                )
+
+        self.buckets = {bucket_size: {} for bucket_size in bucket_sizes}
+
+    def add_interval(
+        self,
+        interval: str,
+        total,
+        fuel_consumption: dict,
+        emissions_total: float,
+        fuel_emissions: dict,
+    ):
+        bucket_labels = get_bucket_labels(helper.timestamp_to_half_hour(interval))
+
+        for bucket_size, buckets in self.buckets.items():
+            bucket_label = bucket_labels[bucket_size]
+            if bucket_label not in buckets:
+                buckets[bucket_label] = ReportTotals()
+
+            buckets[bucket_label].add_interval(
+                interval, total, fuel_consumption, emissions_total, fuel_emissions
+            )
+
+    def to_dict(self) -> dict:
+        # {size: {bucket: {"consumption_source": totals, "carbon_emissions": totals}}}
+
+        return {
+            bucket_size: {
+                bucket_label: {
+                    "consumption_source": totals.consumption_source,
+                    "carbon_emissions": totals.carbon_emissions,
+                }
+                for bucket_label, totals in buckets.items()
+            }
+            for bucket_size, buckets in self.buckets.items()
+        }
+
+
+async def stream_reports(
+    start_date: datetime,
+    end_date: datetime,
+    meters: dict,
+    carbon_emission_factors: dict,
+    chunk_window: timedelta = STREAM_CHUNK_WINDOW,
+    validate_dataset: bool = True,
+    bucket_sizes: list = None,
+    gap_policy: str = "fail",
+    results_store=None,
+):
+    # Stream the reports for the meters one chunk of the window at a time,
+    # yielding (meter, chunk start, chunk end, running ReportTotals) as each
+    # meter's chunk is totalled. The next chunk downloads while the current
+    # one is worked on, and a chunk's data is dropped once it's totalled.
+    # With bucket_sizes each ReportTotals also carries BucketTotals for them,
+    # gaps in a chunk's generation mix are filled as per gap_policy. With a
+    # results_store (see results_store.ResultsStore) each meter's chunk is
+    # stored as it's totalled
+
+    window = helper.half_hour_window(start_date, end_date)
+    if not window:
+        return
+
+    chunks = [
+        (helper.half_hour_to_datetime(first), helper.half_hour_to_datetime(last))
+        for first, last in helper.split_intervals(window[0], window[-1], chunk_window)
+    ]
+
+    carbon_emission_factors = carbon_factors.get_carbon_factor_vector(
+        carbon_emission_factors
+    )
+
+    postcode_regions = {
+        meter: helper.uk_address_to_region(meters[meter]["address"]) for meter in meters
+    }
+    report_totals = {
+        meter: ReportTotals(BucketTotals(bucket_sizes) if bucket_sizes else None)
+        for meter in meters
+    }
+
+    # Regions that have fallen back to the national dataset stay national for
+    # the chunks after, earlier chunks already totalled can't be redone so the
+    # run's regional_fallbacks metric shows it happened
+    national_fallbacks = set()
+
+    async def get_chunk_datasets(chunk_start: datetime, chunk_end: datetime) -> list:
+        # Meters in the same region share the chunk's generation mix download
+        generation_mix_fetcher = dataset.GenerationMixFetcher(national_fallbacks)
+
+        async def get_meter_datasets(meter: str) -> list:
+            return await asyncio.gather(
+                metrics.timed(
+                    "meter_intervals",
+                    dataset.get_meter_interval_data(chunk_start, chunk_end, meter),
+                ),
+                metrics.timed(
+                    "generation_mix",
+                    generation_mix_fetcher.get(
+                        chunk_start, chunk_end, postcode_regions[meter]
+                    ),
+                ),
+            )
+
+        return await asyncio.gather(*(get_meter_datasets(meter) for meter in meters))
+
+    next_chunk_datasets = asyncio.ensure_future(get_chunk_datasets(*chunks[0]))
+
+    try:
+        for chunk_index, (chunk_start, chunk_end) in enumerate(chunks):
+            chunk_datasets = await next_chunk_datasets
+
+            if chunk_index + 1 < len(chunks):
+                next_chunk_datasets = asyncio.ensure_future(
+                    get_chunk_datasets(*chunks[chunk_index + 1])
+                )
+
+            # Gaps in a generation mix the chunk's meters share are filled once
+            gap_filler = dataset.GenerationMixGapFiller(gap_policy)
+
+            for meter, (meter_interval_data, generation_mix_data) in zip(
+                meters, chunk_datasets
+            ):
+                if validate_dataset:
+                    with metrics.stage("validation"):
+                        dataset_valid = dataset.validate_openvolt_nationalgrid_datasets(
+                            meter_interval_data, generation_mix_data
+                        )
+                    if not dataset_valid and gap_policy != "fail":
+                        with metrics.stage("gap_fill"):
+                            generation_mix_data = await gap_filler.fill(
+                                meter_interval_data,
+                                generation_mix_data,
+                                postcode_regions[meter],
+                            )
+                        with metrics.stage("validation"):
+                            dataset_valid = (
+                                dataset.validate_openvolt_nationalgrid_datasets(
+                                    meter_interval_data, generation_mix_data
+                                )
+                            )
+                else:
+                    dataset_valid = True
+
+                if not dataset_valid:
+                    logging.error(
+                        "Missing intervals from NationalGrid dataset, dataset validation failed"
+                    )
+                    raise ValueError(
+                        "Missing intervals from NationalGrid dataset, dataset validation failed"
+                    )
+
+                # The generator stages all run as the totals pull intervals through
+                with metrics.stage("reports"):
+                    emissions_intervals = emissions_stage(
+                        consumption_stage(
+                            join_intervals(meter_interval_data, generation_mix_data)
+                        ),
+                        carbon_emission_factors.get_interval_vectors(
+                            generation_mix_data
+                        ),
+                    )
+
+                    # Only held for the chunk if it's being stored as well
+                    if results_store is not None:
+                        emissions_intervals = list(emissions_intervals)
+
+                    report_totals[meter].add_intervals(emissions_intervals)
+
+                if results_store is not None:
+                    chunk_half_hours = helper.half_hour_window(chunk_start, chunk_end)
+                    with metrics.stage("results_store"):
+                        results_store.put_emissions_intervals(
+                            meter,
+                            chunk_half_hours[0],
+                            chunk_half_hours[-1],
+                            emissions_intervals,
+                        )
+
+                yield meter, chunk_start, chunk_end, report_totals[meter]
+    finally:
+        # Don't leave a prefetch running if the consumer stops early
+        next_chunk_datasets.cancel()
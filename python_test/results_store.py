@@ -0,0 +1,311 @@
+import os
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+import helper
+import pipeline
+
+
+class ResultsStore:
+    # Embedded store of worked out report results, backed by a single sqlite
+    # file, so a period already reported on can be totalled again (as a whole,
+    # a part of it, or bucketed differently) without going back to the APIs
+    #
+    # Each meter's results are held per half-hour interval, the total kWh and
+    # gCO2 in one table and the split per fuel type in another, both keyed on
+    # meter and epoch half-hour index (see helper.timestamp_to_half_hour) so a
+    # meter's period is a single range scan. Only intervals that have fully
+    # passed (UTC) and came back from the API are stored, so a window is only
+    # answered from here once every half-hour of it is held, one with gaps or
+    # reaching into unfinished time goes back to the APIs and fills them in.
+    # Meters are kept with the customer they were reported for so a
+    # customer's meters can be found offline too.
+    # Results are as worked out with the emission factors and generation mix
+    # at the time, reporting a period again writes over them
+
+    def __init__(self, path: str):
+        self.path = path
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS meters ("
+                " meter_id TEXT PRIMARY KEY,"
+                " customer_id TEXT,"
+                " meter TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS meters_customer_id"
+                " ON meters (customer_id)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS interval_results ("
+                " meter_id TEXT NOT NULL,"
+                " half_hour INTEGER NOT NULL,"
+                " consumption NOT NULL,"
+                " emissions REAL NOT NULL,"
+                " PRIMARY KEY (meter_id, half_hour)) WITHOUT ROWID"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS fuel_results ("
+                " meter_id TEXT NOT NULL,"
+                " half_hour INTEGER NOT NULL,"
+                " position INTEGER NOT NULL,"
+                " fuel_type TEXT NOT NULL,"
+                " consumption REAL NOT NULL,"
+                " emissions REAL NOT NULL,"
+                " PRIMARY KEY (meter_id, half_hour, position)) WITHOUT ROWID"
+            )
+
+        logging.debug(f"Opened results store {path}")
+
+    def put_meters(self, customer_id: str, meters: dict):
+        # Meters as returned by dataset.get_meters, a meter looked up on its
+        # own keeps the customer it was last reported for
+
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO meters (meter_id, customer_id, meter) VALUES (?, ?, ?)"
+                " ON CONFLICT (meter_id) DO UPDATE SET"
+                " customer_id = COALESCE(excluded.customer_id, customer_id),"
+                " meter = excluded.meter",
+                [
+                    (meter_id, customer_id, json.dumps(meter))
+                    for meter_id, meter in meters.items()
+                ],
+            )
+
+    def get_meters(self, customer_id: str = None, meter_id: str = None) -> dict:
+        # Stored meters filtering on customer and/or meter id as dataset.get_meters does
+
+        conditions = []
+        params = []
+
+        if customer_id:
+            conditions.append("customer_id = ?")
+            params.append(customer_id)
+        if meter_id:
+            conditions.append("meter_id = ?")
+            params.append(meter_id)
+
+        if not conditions:
+            return {}
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT meter_id, meter FROM meters"
+                f" WHERE {' AND '.join(conditions)} ORDER BY rowid",
+                params,
+            ).fetchall()
+
+        return {meter_id: json.loads(meter) for meter_id, meter in rows}
+
+    def put_emissions_intervals(
+        self,
+        meter_id: str,
+        first_half_hour: int,
+        last_half_hour: int,
+        emissions_intervals,
+    ):
+        # Store a meter's results for the window between two half-hours
+        # inclusive, from (interval, total kWh, {fuel: kWh}, total gCO2,
+        # {fuel: gCO2}) tuples as pipeline.emissions_stage yields, replacing
+        # anything held for the window all at once. Intervals that haven't
+        # fully passed yet are left out, as LocalCache does
+
+        interval_rows = []
+        fuel_rows = []
+
+        current_half_hour = helper.datetime_to_half_hour(
+            datetime.now(timezone.utc).replace(tzinfo=None)
+        )
+
+        for (
+            interval,
+            total,
+            fuel_consumption,
+            emissions_total,
+            fuel_emissions,
+        ) in emissions_intervals:
+            half_hour = helper.timestamp_to_half_hour(interval)
+            if half_hour >= current_half_hour:
+                continue
+
+            interval_rows.append((meter_id, half_hour, total, emissions_total))
+            fuel_rows.extend(
+                (
+                    meter_id,
+                    half_hour,
+                    position,
+                    fuel_type,
+                    consumption,
+                    generated_carbon,
+                )
+                for position, (fuel_type, consumption, generated_carbon) in enumerate(
+                    zip(
+                        fuel_consumption,
+                        fuel_consumption.values(),
+                        fuel_emissions.values(),
+                    )
+                )
+            )
+
+        window = (meter_id, first_half_hour, last_half_hour)
+
+        with self._lock, self._connection:
+            for table in ["interval_results", "fuel_results"]:
+                self._connection.execute(
+                    f"DELETE FROM {table}"
+                    " WHERE meter_id = ? AND half_hour BETWEEN ? AND ?",
+                    window,
+                )
+            self._connection.executemany(
+                "INSERT INTO interval_results"
+                " (meter_id, half_hour, consumption, emissions) VALUES (?, ?, ?, ?)",
+                interval_rows,
+            )
+            self._connection.executemany(
+                "INSERT INTO fuel_results"
+                " (meter_id, half_hour, position, fuel_type, consumption, emissions)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                fuel_rows,
+            )
+
+    def covers(self, meter_id: str, first_half_hour: int, last_half_hour: int) -> bool:
+        # Whether every half-hour between the two inclusive is held for the meter
+
+        with self._lock:
+            held = self._connection.execute(
+                "SELECT COUNT(*) FROM interval_results"
+                " WHERE meter_id = ? AND half_hour BETWEEN ? AND ?",
+                (meter_id, first_half_hour, last_half_hour),
+            ).fetchone()[0]
+
+        return held == last_half_hour - first_half_hour + 1
+
+    def get_emissions_intervals(
+        self, meter_id: str, first_half_hour: int, last_half_hour: int
+    ) -> list:
+        # The meter's stored results between two half-hours inclusive, as the
+        # same tuples put_emissions_intervals takes, in interval order
+
+        with self._lock:
+            interval_rows = self._connection.execute(
+                "SELECT half_hour, consumption, emissions FROM interval_results"
+                " WHERE meter_id = ? AND half_hour BETWEEN ? AND ?"
+                " ORDER BY half_hour",
+                (meter_id, first_half_hour, last_half_hour),
+            ).fetchall()
+            fuel_rows = self._connection.execute(
+                "SELECT half_hour, fuel_type, consumption, emissions FROM fuel_results"
+                " WHERE meter_id = ? AND half_hour BETWEEN ? AND ?"
+                " ORDER BY half_hour, position",
+                (meter_id, first_half_hour, last_half_hour),
+            ).fetchall()
+
+        emissions_intervals = []
+        fuel_index = 0
+
+        for half_hour, total, emissions_total in interval_rows:
+            fuel_consumption = {}
+            fuel_emissions = {}
+
+            while fuel_index < len(fuel_rows) and fuel_rows[fuel_index][0] == half_hour:
+                _, fuel_type, consumption, generated_carbon = fuel_rows[fuel_index]
+                fuel_consumption[fuel_type] = consumption
+                fuel_emissions[fuel_type] = generated_carbon
+                fuel_index += 1
+
+            emissions_intervals.append(
+                (
+                    helper.half_hour_to_timestamp(half_hour),
+                    total,
+                    fuel_consumption,
+                    emissions_total,
+                    fuel_emissions,
+                )
+            )
+
+        return emissions_intervals
+
+    def get_report_totals(
+        self,
+        meter_id: str,
+        start_date: datetime,
+        end_date: datetime,
+        bucket_sizes: list = None,
+    ) -> pipeline.ReportTotals:
+        # Totals for the meter's stored intervals between the dates, added up
+        # in interval order so they match the report engines exactly
+
+        report_totals = pipeline.ReportTotals(
+            pipeline.BucketTotals(bucket_sizes) if bucket_sizes else None
+        )
+
+        window = helper.half_hour_window(start_date, end_date)
+        if window:
+            report_totals.add_intervals(
+                self.get_emissions_intervals(meter_id, window[0], window[-1])
+            )
+
+        return report_totals
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def get_stored_reports(
+    results_store: ResultsStore,
+    start_date: datetime,
+    end_date: datetime,
+    customer_id: str,
+    meter_id: str,
+    bucket_sizes: list = None,
+) -> list:
+    # Report totals laid out as generate_reports returns them, from the store
+    # alone, or None unless it holds every interval of the window for every
+    # meter asked for
+
+    meters = results_store.get_meters(customer_id=customer_id, meter_id=meter_id)
+    if not meters:
+        return None
+
+    window = helper.half_hour_window(start_date, end_date)
+    if not window:
+        return None
+
+    for meter in meters:
+        if not results_store.covers(meter, window[0], window[-1]):
+            return None
+
+    consumption_source_report_totals = {}
+    carbon_emissions_report_totals = {}
+    bucket_report_totals = {}
+
+    for meter in meters:
+        report_totals = results_store.get_report_totals(
+            meter, start_date, end_date, bucket_sizes=bucket_sizes
+        )
+        consumption_source_report_totals[meter] = report_totals.consumption_source
+        carbon_emissions_report_totals[meter] = report_totals.carbon_emissions
+
+        if bucket_sizes:
+            bucket_report_totals[meter] = report_totals.bucket_totals.to_dict()
+
+    if bucket_sizes:
+        return [
+            consumption_source_report_totals,
+            carbon_emissions_report_totals,
+            bucket_report_totals,
+        ]
+
+    return [consumption_source_report_totals, carbon_emissions_report_totals]
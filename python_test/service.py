@@ -0,0 +1,355 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dataset
+import metrics
+import pipeline
+import carbon_factors
+import openvolt_reporting
+from results_store import ResultsStore
+
+# Generation mix downloads are shared between reports for this long before
+# starting afresh, so recent intervals that weren't published yet get picked up
+GENERATION_MIX_TTL = timedelta(minutes=30)
+
+# Identical report requests within this long share the one result
+REPORT_RESULT_TTL = timedelta(minutes=1)
+REPORT_RESULT_CACHE_SIZE = 256
+
+# Longest an HTTP request waits on its report, in seconds
+REPORT_TIMEOUT = 300
+
+
+class ReportService:
+    # Long running report generation keeping the emission factors, generation
+    # mix downloads and API connection pools warm between reports. Reports run
+    # concurrently on one event loop in a background thread, requested from
+    # any other thread (e.g. the HTTP handlers) with run_report. With a
+    # results_store, reports over periods already worked out come from it
+
+    def __init__(
+        self,
+        engine: str = "dict",
+        generation_mix_ttl: timedelta = GENERATION_MIX_TTL,
+        result_ttl: timedelta = REPORT_RESULT_TTL,
+        results_store: ResultsStore = None,
+    ):
+        self.engine = engine
+        self.generation_mix_ttl = generation_mix_ttl
+        self.result_ttl = result_ttl
+        self.results_store = results_store
+
+        self.reports = 0
+        self.result_hits = 0
+        self._start_time = time.monotonic()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="report-service", daemon=True
+        )
+
+        self._factors_lock = asyncio.Lock()
+        self._carbon_emission_factors = None
+        self._carbon_emission_factors_time = 0.0
+
+        self._generation_mix_fetcher = None
+        self._generation_mix_fetcher_time = 0.0
+
+        self._results = OrderedDict()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def get_carbon_emission_factors(self) -> carbon_factors.CarbonFactorVector:
+        # Emission factors resolved once and kept as long as the cache would
+        async with self._factors_lock:
+            if (
+                self._carbon_emission_factors is None
+                or time.monotonic() - self._carbon_emission_factors_time
+                > dataset.EMISSION_FACTORS_CACHE_TTL.total_seconds()
+            ):
+                logging.info("Retrieving carbon emission factors...")
+                self._carbon_emission_factors = carbon_factors.get_carbon_factor_vector(
+                    await dataset.get_carbon_emission_factors()
+                )
+                self._carbon_emission_factors_time = time.monotonic()
+
+        return self._carbon_emission_factors
+
+    def get_generation_mix_fetcher(self) -> dataset.GenerationMixFetcher:
+        # Downloads in flight on the old fetcher still finish for their callers
+        if (
+            self._generation_mix_fetcher is None
+            or time.monotonic() - self._generation_mix_fetcher_time
+            > self.generation_mix_ttl.total_seconds()
+        ):
+            self._generation_mix_fetcher = dataset.GenerationMixFetcher()
+            self._generation_mix_fetcher_time = time.monotonic()
+
+        return self._generation_mix_fetcher
+
+    async def generate_report(
+        self,
+        customer_id: str,
+        meter_id: str,
+        start_date: datetime,
+        end_date: datetime,
+        bucket_sizes: list = None,
+        gap_policy: str = None,
+    ) -> dict:
+        # Report totals as a JSON ready dict, laid out as the batch report
+        # files are. Requests matching one already running or finished within
+        # result_ttl share its result rather than working it out again
+
+        key = (
+            customer_id,
+            meter_id,
+            start_date,
+            end_date,
+            tuple(bucket_sizes or ()),
+            gap_policy,
+        )
+
+        if (
+            key in self._results
+            and time.monotonic() - self._results[key][0]
+            <= self.result_ttl.total_seconds()
+        ):
+            self._results.move_to_end(key)
+            self.result_hits += 1
+            report = self._results[key][1]
+        else:
+            report = asyncio.ensure_future(
+                self._generate_report(
+                    customer_id,
+                    meter_id,
+                    start_date,
+                    end_date,
+                    bucket_sizes,
+                    gap_policy,
+                )
+            )
+            self._results[key] = (time.monotonic(), report)
+            while len(self._results) > REPORT_RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
+
+        try:
+            # Shield so one caller giving up doesn't cancel the report for the rest
+            return await asyncio.shield(report)
+        except Exception:
+            # Drop failed reports so the next request tries again
+            if key in self._results and self._results[key][1] is report:
+                del self._results[key]
+            raise
+
+    async def _generate_report(
+        self,
+        customer_id: str,
+        meter_id: str,
+        start_date: datetime,
+        end_date: datetime,
+        bucket_sizes: list,
+        gap_policy: str,
+    ) -> dict:
+        # Each report runs in its own task, so gets its own metrics
+        report_metrics = metrics.Metrics(
+            labels={"customer_id": customer_id, "meter_id": meter_id}
+        )
+        metrics.set_metrics(report_metrics)
+
+        (
+            consumption_source_report_totals,
+            carbon_emissions_report_totals,
+            *bucket_report_totals,
+        ) = await openvolt_reporting.generate_reports(
+            start_date,
+            end_date,
+            customer_id,
+            meter_id,
+            None,
+            generation_mix_fetcher=self.get_generation_mix_fetcher(),
+            engine=self.engine,
+            carbon_emission_factors=await self.get_carbon_emission_factors(),
+            bucket_sizes=bucket_sizes,
+            gap_policy=gap_policy,
+            results_store=self.results_store,
+        )
+
+        self.reports += 1
+
+        return {
+            "customer_id": customer_id,
+            "meter_id": meter_id,
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat(),
+            "consumption_source_report_totals": consumption_source_report_totals,
+            "carbon_emissions_report_totals": carbon_emissions_report_totals,
+            **(
+                {"bucket_report_totals": bucket_report_totals[0]}
+                if bucket_report_totals
+                else {}
+            ),
+            "metrics": report_metrics.summary(),
+        }
+
+    def run_report(self, **report_request) -> dict:
+        # generate_report from another thread, waiting up to REPORT_TIMEOUT
+        return asyncio.run_coroutine_threadsafe(
+            self.generate_report(**report_request), self._loop
+        ).result(REPORT_TIMEOUT)
+
+    def status(self) -> dict:
+        return {
+            "uptime_seconds": round(time.monotonic() - self._start_time, 3),
+            "engine": self.engine,
+            "reports": self.reports,
+            "result_hits": self.result_hits,
+            "connections": dataset.get_connection_stats(),
+        }
+
+
+def parse_report_request(query: dict) -> dict:
+    # generate_report arguments from a parsed query string, raising
+    # ValueError for anything missing or malformed
+
+    def get_value(name: str) -> str:
+        values = query.get(name)
+        return values[0] if values else None
+
+    customer_id = get_value("customer_id")
+    meter_id = get_value("meter_id")
+
+    if not customer_id and not meter_id:
+        raise ValueError("customer_id or meter_id is required")
+
+    dates = {}
+    for name in ["start_date", "end_date"]:
+        if not get_value(name):
+            raise ValueError(f"{name} is required, in YYYY-MM-DD format")
+        dates[name] = datetime.strptime(get_value(name), "%Y-%m-%d")
+
+    if dates["end_date"] < dates["start_date"]:
+        raise ValueError("end_date is before start_date")
+
+    bucket_sizes = None
+    if get_value("buckets"):
+        bucket_sizes = get_value("buckets").split(",")
+        for bucket_size in bucket_sizes:
+            if bucket_size not in pipeline.BUCKET_SIZES:
+                raise ValueError(
+                    f"Unknown bucket size {bucket_size}, expected one of {pipeline.BUCKET_SIZES}"
+                )
+
+    gap_policy = get_value("gap_policy")
+    if gap_policy is not None and gap_policy not in dataset.GAP_POLICIES:
+        raise ValueError(
+            f"Unknown gap policy {gap_policy}, expected one of {dataset.GAP_POLICIES}"
+        )
+
+    return {
+        "customer_id": customer_id,
+        "meter_id": meter_id,
+        **dates,
+        "bucket_sizes": bucket_sizes,
+        "gap_policy": gap_policy,
+    }
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    # GET /reports?customer_id=...&start_date=YYYY-MM-DD&end_date=YYYY-MM-DD
+    #     with meter_id in place of (or as well as) customer_id, and optional
+    #     buckets=daily,weekly,... and gap_policy=...
+    # GET /status
+    # Answers are JSON, errors as {"error": message}
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+
+        if url.path == "/status":
+            self.send_json(200, self.server.service.status())
+            return
+
+        if url.path != "/reports":
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+            return
+
+        try:
+            report_request = parse_report_request(parse_qs(url.query))
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        try:
+            report = self.server.service.run_report(**report_request)
+        except dataset.RestRequestError as e:
+            logging.error(f"Report request {url.query} failed: {e}")
+            self.send_json(
+                502, {"error": f"API request failed with status {e.status_code}"}
+            )
+            return
+        except ValueError as e:
+            logging.error(f"Report request {url.query} failed: {e}")
+            self.send_json(422, {"error": str(e)})
+            return
+        except Exception as e:
+            logging.error(f"Report request {url.query} failed: {e}")
+            self.send_json(500, {"error": "Report generation failed"})
+            return
+
+        self.send_json(200, report)
+
+    def send_json(self, status: int, body: dict):
+        body = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+class ReportServer(ThreadingHTTPServer):
+    # Handles each request on its own thread, all sharing the one service
+
+    daemon_threads = True
+
+    def __init__(self, server_address: tuple, service: ReportService):
+        super().__init__(server_address, ReportRequestHandler)
+        self.service = service
+
+
+def serve(
+    host: str, port: int, engine: str = "dict", results_store: ResultsStore = None
+):
+    # Serve reports over HTTP until interrupted
+
+    service = ReportService(engine=engine, results_store=results_store)
+    service.start()
+
+    server = ReportServer((host, port), service)
+    logging.info(f"Serving reports on http://{host}:{server.server_address[1]}/reports")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopping report service")
+    finally:
+        server.server_close()
+        service.stop()
@@ -0,0 +1,827 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+import asyncio
+import json
+import logging
+import threading
+import os
+import time
+import tempfile
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dataset
+import helper
+import metrics
+import diagnostics
+from cache import LocalCache
+from http_client import HttpClient
+
+
+class StandInApiHandler(BaseHTTPRequestHandler):
+    # Minimal local stand-in for the APIs, answers every GET with empty data
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = json.dumps({"data": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestTimestamps(unittest.TestCase):
+    def test_half_hour_matches_trim_timestamp(self):
+        for timestamp in [
+            "2023-01-01T00:00:00.000Z",
+            "2023-01-31T23:30Z",
+            "2024-02-29T12:30:00Z",
+            "2023-06-15T0030",
+        ]:
+            half_hour = helper.timestamp_to_half_hour(timestamp)
+
+            self.assertEqual(
+                helper.half_hour_to_timestamp(half_hour),
+                helper.trim_timestamp(timestamp),
+            )
+            self.assertEqual(
+                helper.half_hour_to_datetime(half_hour),
+                datetime.strptime(helper.trim_timestamp(timestamp), "%Y-%m-%dT%H%M"),
+            )
+
+    def test_half_hour_window(self):
+        window = helper.half_hour_window(
+            datetime(2023, 1, 1, 0, 10), datetime(2023, 1, 1, 2, 0)
+        )
+
+        self.assertEqual(
+            [helper.half_hour_to_timestamp(half_hour) for half_hour in window],
+            [
+                "2023-01-01T0030",
+                "2023-01-01T0100",
+                "2023-01-01T0130",
+                "2023-01-01T0200",
+            ],
+        )
+
+
+class TestRestRequests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        dataset.set_max_concurrent_requests(8)
+
+    def slow_get(self, *args, **kwargs):
+        # Stand in for requests.get that records how many calls overlap
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+
+        response = MagicMock()
+        response.status_code = 200
+        response.json.return_value = {"data": []}
+        return response
+
+    @patch("http_client.requests.Session.get")
+    async def test_requests_overlap_within_limit(self, requests_get):
+        requests_get.side_effect = self.slow_get
+        dataset.set_max_concurrent_requests(3)
+
+        await asyncio.gather(
+            *(
+                dataset.get_rest_req("https://example.com", validation="data")
+                for _ in range(6)
+            )
+        )
+
+        self.assertEqual(requests_get.call_count, 6)
+        self.assertEqual(self.max_in_flight, 3)
+
+    @patch("http_client.requests.Session.get")
+    async def test_validation_error(self, requests_get):
+        response = MagicMock()
+        response.status_code = 200
+        response.json.return_value = {"other": []}
+        requests_get.return_value = response
+
+        with self.assertRaises(AssertionError):
+            await dataset.get_rest_req("https://example.com", validation="data")
+
+    @patch("http_client.requests.Session.get")
+    async def test_requests_recorded_in_metrics(self, requests_get):
+        response = MagicMock()
+        response.status_code = 404
+        response.content = b"server error"
+        requests_get.return_value = response
+
+        events = []
+        report_metrics = metrics.Metrics(hook=events.append, labels={"report": "1"})
+        metrics.set_metrics(report_metrics)
+
+        with self.assertRaises(ValueError):
+            await dataset.get_rest_req(
+                "https://example.com/v1/meters", validation="data"
+            )
+
+        self.assertEqual(events[0]["report"], "1")
+        self.assertEqual(events[0]["path"], "/v1/meters")
+        self.assertEqual(
+            report_metrics.summary()["requests"]["https://example.com"]["errors"], 1
+        )
+        self.assertEqual(
+            report_metrics.summary()["requests"]["https://example.com"]["bytes"], 12
+        )
+
+    @patch("http_client.requests.Session.get")
+    async def test_transient_errors_retried(self, requests_get):
+        responses = []
+        for status_code, headers in [(429, {"Retry-After": "0"}), (503, {}), (200, {})]:
+            response = MagicMock()
+            response.status_code = status_code
+            response.headers = headers
+            response.json.return_value = {"data": ["ok"]}
+            responses.append(response)
+        requests_get.side_effect = responses
+
+        response_json = await dataset.get_rest_req(
+            "https://example.com", validation="data", client=HttpClient(backoff=0)
+        )
+
+        self.assertEqual(response_json, {"data": ["ok"]})
+        self.assertEqual(requests_get.call_count, 3)
+
+    @patch("http_client.requests.Session.get")
+    async def test_gives_up_after_retries(self, requests_get):
+        response = MagicMock()
+        response.status_code = 503
+        response.headers = {}
+        requests_get.return_value = response
+
+        with self.assertRaises(dataset.RestRequestError) as error:
+            await dataset.get_rest_req(
+                "https://example.com",
+                validation="data",
+                client=HttpClient(retries=2, backoff=0),
+            )
+
+        self.assertEqual(error.exception.status_code, 503)
+        self.assertEqual(requests_get.call_count, 3)
+
+    @patch("http_client.requests.Session.get")
+    async def test_error_leaves_out_headers_and_response(self, requests_get):
+        response = MagicMock()
+        response.status_code = 403
+        response.text = "response body with details"
+        requests_get.return_value = response
+
+        with self.assertRaises(dataset.RestRequestError) as error:
+            await dataset.get_rest_req(
+                "https://example.com/v1/meters?meter_id=1",
+                headers={"x-api-key": "secret-key"},
+                validation="data",
+            )
+
+        self.assertEqual(
+            str(error.exception),
+            "Error making REST request to example.com/v1/meters, status code: 403",
+        )
+
+    @patch("http_client.requests.Session.get")
+    async def test_slow_request_hedged(self, requests_get):
+        def first_slow(*args, **kwargs):
+            response = MagicMock()
+            response.status_code = 200
+            if requests_get.call_count == 1:
+                time.sleep(0.5)
+                response.json.return_value = {"data": ["slow"]}
+            else:
+                response.json.return_value = {"data": ["hedge"]}
+            return response
+
+        requests_get.side_effect = first_slow
+        client = HttpClient(hedge_after=0.05)
+
+        response_json = await dataset.get_rest_req(
+            "https://example.com", validation="data", client=client
+        )
+
+        self.assertEqual(response_json, {"data": ["hedge"]})
+        self.assertEqual(client.connection_stats()["https://example.com"]["hedged"], 1)
+
+
+class TestDiagnostics(unittest.IsolatedAsyncioTestCase):
+    @patch("dataset.get_rest_req")
+    async def test_out_of_window_intervals_counted(self, get_rest_req):
+        start_half_hour = helper.datetime_to_half_hour(datetime(2023, 1, 1))
+        get_rest_req.return_value = {
+            "data": [
+                {
+                    "start_interval": f"{helper.half_hour_to_timestamp(half_hour)}",
+                    "consumption": "10",
+                    "consumption_units": "kWh",
+                }
+                for half_hour in range(start_half_hour - 100, start_half_hour + 3)
+            ]
+        }
+
+        report_metrics = metrics.Metrics()
+        metrics.set_metrics(report_metrics)
+
+        with self.assertLogs(level="WARNING") as logs:
+            meter_interval_data = await dataset._get_meter_interval_range(
+                datetime(2023, 1, 1), datetime(2023, 1, 1, 1), "1234"
+            )
+
+        self.assertEqual(len(meter_interval_data), 3)
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(logs.records[0].event, "meter_intervals_out_of_window")
+        self.assertEqual(logs.records[0].fields["count"], 100)
+        self.assertEqual(
+            report_metrics.summary()["counters"], {"meter_intervals_out_of_window": 100}
+        )
+
+    def test_events_sampled_and_lazy(self):
+        calls = []
+
+        def field():
+            calls.append(1)
+            return "value"
+
+        # Not enabled, so the field is never worked out
+        diagnostics.log_event(logging.DEBUG, "test_lazy_event", field=field)
+        self.assertEqual(calls, [])
+
+        with patch("diagnostics.SAMPLE_FIRST", 2), patch("diagnostics.SAMPLE_EVERY", 3):
+            with self.assertLogs(level="INFO") as logs:
+                for _ in range(7):
+                    diagnostics.log_event(
+                        logging.INFO, "test_sampled_event", field=field
+                    )
+
+        self.assertEqual(
+            [record.fields["seen"] for record in logs.records], [1, 2, 3, 6]
+        )
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(
+            logs.output[0], "INFO:root:test_sampled_event field=value seen=1"
+        )
+
+
+class TestGenerationMixFetcher(unittest.IsolatedAsyncioTestCase):
+    @patch("dataset.get_generation_mix_data")
+    async def test_same_window_fetched_once(self, get_generation_mix_data):
+        async def slow_generation_mix(*args):
+            await asyncio.sleep(0.01)
+            return {"2023-01-01T0000": {"wind": 100}}
+
+        get_generation_mix_data.side_effect = slow_generation_mix
+
+        fetcher = dataset.GenerationMixFetcher()
+        start_date = datetime(2023, 1, 1)
+        end_date = datetime(2023, 2, 1)
+
+        results = await asyncio.gather(
+            *(
+                fetcher.get(start_date, end_date, region)
+                for region in ["SW1A", "M1", "EH1"] * 3
+            )
+        )
+
+        get_generation_mix_data.assert_called_once_with(start_date, end_date, None)
+        self.assertEqual(fetcher.requested, 9)
+        self.assertEqual(fetcher.saved, 8)
+        self.assertTrue(all(result is results[0] for result in results))
+
+
+def stand_in_generation_mix(api_url: str, **kwargs) -> dict:
+    # Carbon Intensity style /generation response covering the requested window
+
+    from_date, to_date = [
+        datetime.strptime(part, "%Y-%m-%dT%H:%M:%S")
+        for part in api_url.split("/generation/")[1].split("/")
+    ]
+
+    data = []
+    while from_date < to_date:
+        data.append(
+            {
+                "from": from_date.strftime("%Y-%m-%dT%H:%MZ"),
+                "to": (from_date + timedelta(minutes=30)).strftime("%Y-%m-%dT%H:%MZ"),
+                "generationmix": [
+                    {"fuel": "gas", "perc": 40},
+                    {"fuel": "wind", "perc": 60},
+                ],
+            }
+        )
+        from_date += timedelta(minutes=30)
+
+    return {"data": data}
+
+
+def stand_in_meter_intervals(api_url: str, **kwargs) -> dict:
+    # OpenVolt style /v1/interval-data response, start and end both inclusive
+
+    params = dict(part.split("=") for part in api_url.split("?")[1].split("&"))
+    interval = datetime.fromisoformat(params["start_date"])
+    end_date = datetime.fromisoformat(params["end_date"])
+
+    data = []
+    while interval <= end_date:
+        data.append(
+            {
+                "start_interval": interval.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                "meter_id": params["meter_id"],
+                "consumption": "54",
+                "consumption_units": "kWh",
+            }
+        )
+        interval += timedelta(minutes=30)
+
+    return {"data": data}
+
+
+def stand_in_regional_api(api_url: str, **kwargs) -> dict:
+    # Carbon Intensity style regional responses, outcode lookups and
+    # generation mix by region id, anything else national
+
+    if "/regional/postcode/" in api_url:
+        postcode_region = api_url.rsplit("/", 1)[1]
+        return {
+            "data": [
+                {
+                    "regionid": {"SW1A": 13, "EC1A": 13, "M1": 3}[postcode_region],
+                    "postcode": postcode_region,
+                }
+            ]
+        }
+
+    if "/regional/intensity/" in api_url:
+        from_date, to_date, _, region_id = api_url.split("/regional/intensity/")[
+            1
+        ].split("/")
+        return {
+            "data": {
+                "regionid": int(region_id),
+                **stand_in_generation_mix(f"/generation/{from_date}/{to_date}"),
+            }
+        }
+
+    return stand_in_generation_mix(api_url)
+
+
+@patch.object(dataset, "USE_REGIONAL_GENERATION_MIX", True)
+@patch.object(dataset, "CARBON_INTENSITY_HEADERS", {"Authorization": "Bearer token"})
+@patch.dict(dataset._postcode_region_ids, clear=True)
+class TestRegionalGenerationMix(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Each test starts with no fallbacks logged yet
+        fallbacks_logged = patch.object(dataset, "_national_fallbacks_logged", set())
+        fallbacks_logged.start()
+        self.addCleanup(fallbacks_logged.stop)
+
+    @patch("dataset.get_rest_req")
+    async def test_each_region_fetched_once(self, get_rest_req):
+        get_rest_req.side_effect = stand_in_regional_api
+
+        fetcher = dataset.GenerationMixFetcher()
+        start_date = datetime(2023, 1, 1)
+        end_date = datetime(2023, 1, 2)
+
+        results = await asyncio.gather(
+            *(
+                fetcher.get(start_date, end_date, postcode_region)
+                for postcode_region in ["SW1A", "EC1A", "M1"] * 2
+            )
+        )
+
+        # One lookup per outcode, then one download per region as both
+        # London outcodes share region 13
+        api_paths = sorted(
+            "/".join(urlsplit(call.kwargs["api_url"]).path.split("/")[-2:])
+            for call in get_rest_req.call_args_list
+        )
+        self.assertEqual(
+            api_paths,
+            [
+                "postcode/EC1A",
+                "postcode/M1",
+                "postcode/SW1A",
+                "regionid/13",
+                "regionid/3",
+            ],
+        )
+        self.assertIs(results[0], results[1])
+        self.assertIsNot(results[0], results[2])
+        self.assertEqual(len(results[0]), 49)
+
+        for call in get_rest_req.call_args_list:
+            self.assertEqual(call.kwargs["headers"], {"Authorization": "Bearer token"})
+
+    @patch("dataset.get_rest_req")
+    async def test_region_unavailable(self, get_rest_req):
+        def unauthorised_regional_api(api_url: str, **kwargs) -> dict:
+            if "/regional/intensity/" in api_url:
+                raise dataset.RestRequestError("Unauthorized", 401)
+            return stand_in_regional_api(api_url)
+
+        get_rest_req.side_effect = unauthorised_regional_api
+
+        generation_mix_data = await dataset.get_generation_mix_data(
+            datetime(2023, 1, 1), datetime(2023, 1, 2), "M1"
+        )
+        self.assertEqual(len(generation_mix_data), 49)
+        self.assertIn("/generation/", get_rest_req.call_args.kwargs["api_url"])
+
+        with patch.object(dataset, "REGIONAL_FALLBACK_TO_NATIONAL", False):
+            with self.assertRaises(dataset.RestRequestError):
+                await dataset.get_generation_mix_data(
+                    datetime(2023, 1, 1), datetime(2023, 1, 2), "M1"
+                )
+
+    @patch("dataset.get_rest_req")
+    async def test_fallback_decided_once_per_report(self, get_rest_req):
+        def regional_chunk_unavailable(api_url: str, **kwargs) -> dict:
+            if "/regional/intensity/2023-01-15" in api_url:
+                raise dataset.RestRequestError("Service Unavailable", 503)
+            return stand_in_regional_api(api_url)
+
+        get_rest_req.side_effect = regional_chunk_unavailable
+
+        report_metrics = metrics.Metrics()
+        metrics.set_metrics(report_metrics)
+        self.addCleanup(metrics.set_metrics, None)
+
+        fetcher = dataset.GenerationMixFetcher()
+
+        # One of January's three regional chunks fails, so all of January
+        # comes from the national dataset rather than a mix of the two
+        with patch.object(dataset.get_client(), "backoff", 0):
+            generation_mix_data = await fetcher.get(
+                datetime(2023, 1, 1), datetime(2023, 2, 1), "M1"
+            )
+
+        self.assertEqual(len(generation_mix_data), 31 * 48 + 1)
+        national_calls = [
+            call.kwargs["api_url"]
+            for call in get_rest_req.call_args_list
+            if "/generation/" in call.kwargs["api_url"]
+        ]
+        # The failed chunk's own national fetch, then January's three chunks
+        # (with a cache the first of those is served from it)
+        self.assertEqual(len(national_calls), 4)
+        self.assertEqual(fetcher.national_fallbacks, {3})
+        self.assertEqual(report_metrics.summary()["counters"]["regional_fallbacks"], 1)
+
+        # The region stays national for the rest of the report
+        get_rest_req.reset_mock()
+        await fetcher.get(datetime(2023, 2, 1), datetime(2023, 2, 2), "M1")
+        self.assertEqual(
+            [
+                "/".join(urlsplit(call.kwargs["api_url"]).path.split("/")[1:2])
+                for call in get_rest_req.call_args_list
+            ],
+            ["generation"],
+        )
+
+    @patch("dataset.get_rest_req")
+    async def test_regional_api_unreachable(self, get_rest_req):
+        import requests
+
+        unreachable = {"/regional/postcode/M1", "/regional/intensity/"}
+
+        def unreachable_regional_api(api_url: str, **kwargs) -> dict:
+            if any(path in api_url for path in unreachable):
+                raise requests.exceptions.ConnectionError("Connection refused")
+            return stand_in_regional_api(api_url)
+
+        get_rest_req.side_effect = unreachable_regional_api
+
+        # Falls back to national for each meter, logging it once per outcode
+        # and region however many times it happens
+        with self.assertLogs(level=logging.ERROR) as logs:
+            for postcode_region in ["M1", "M1", "SW1A", "SW1A"]:
+                generation_mix_data = await dataset.get_generation_mix_data(
+                    datetime(2023, 1, 1), datetime(2023, 1, 2), postcode_region
+                )
+                self.assertEqual(len(generation_mix_data), 49)
+                self.assertIn("/generation/", get_rest_req.call_args.kwargs["api_url"])
+
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("M1", logs.records[0].getMessage())
+        self.assertIn("region 13", logs.records[1].getMessage())
+
+        with patch.object(dataset, "REGIONAL_FALLBACK_TO_NATIONAL", False):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                await dataset.get_generation_mix_data(
+                    datetime(2023, 1, 1), datetime(2023, 1, 2), "M1"
+                )
+
+
+class TestLocalCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        dataset.set_cache(LocalCache(os.path.join(self.cache_dir.name, "cache.sqlite")))
+
+    def tearDown(self):
+        dataset.set_cache(None)
+        self.cache_dir.cleanup()
+
+    @patch("dataset.get_rest_req")
+    async def test_only_missing_intervals_fetched(self, get_rest_req):
+        get_rest_req.side_effect = stand_in_generation_mix
+
+        first = await dataset.get_generation_mix_data(
+            datetime(2023, 1, 1), datetime(2023, 1, 2)
+        )
+        self.assertEqual(get_rest_req.call_count, 1)
+        self.assertEqual(len(first), 49)
+
+        # Same window again is served entirely from the cache
+        second = await dataset.get_generation_mix_data(
+            datetime(2023, 1, 1), datetime(2023, 1, 2)
+        )
+        self.assertEqual(get_rest_req.call_count, 1)
+        self.assertEqual(second, first)
+
+        # Extending the window only fetches the new intervals
+        extended = await dataset.get_generation_mix_data(
+            datetime(2023, 1, 1), datetime(2023, 1, 3)
+        )
+        self.assertEqual(get_rest_req.call_count, 2)
+        self.assertIn(
+            "2023-01-02T0030", get_rest_req.call_args.kwargs["api_url"].replace(":", "")
+        )
+        self.assertEqual(len(extended), 97)
+        self.assertEqual(list(extended), sorted(extended))
+
+    @patch("dataset.get_rest_req")
+    async def test_meter_store_only_fetches_new_intervals(self, get_rest_req):
+        get_rest_req.side_effect = stand_in_meter_intervals
+
+        await dataset.get_meter_interval_data(
+            datetime(2023, 1, 1), datetime(2023, 1, 2), "1234"
+        )
+        self.assertEqual(get_rest_req.call_count, 1)
+
+        # Rolling the window on a day only asks OpenVolt for the new day
+        meter_interval_data = await dataset.get_meter_interval_data(
+            datetime(2023, 1, 1), datetime(2023, 1, 3), "1234"
+        )
+        self.assertEqual(get_rest_req.call_count, 2)
+        self.assertIn(
+            "start_date=2023-01-02T00:30:00&end_date=2023-01-03T00:00:00",
+            get_rest_req.call_args.kwargs["api_url"],
+        )
+        self.assertEqual(len(meter_interval_data), 97)
+        self.assertEqual(list(meter_interval_data), sorted(meter_interval_data))
+        self.assertEqual(
+            meter_interval_data["2023-01-02T0000"],
+            helper.MeterInterval(
+                helper.timestamp_to_half_hour("2023-01-02T0000"), 54, "kWh"
+            ),
+        )
+
+    @patch("dataset.get_rest_req")
+    async def test_meter_holes_not_fetched_again(self, get_rest_req):
+        def meter_missing_a_read_a_day(api_url: str, **kwargs) -> dict:
+            meter_intervals = stand_in_meter_intervals(api_url)
+            meter_intervals["data"] = [
+                interval
+                for interval in meter_intervals["data"]
+                if "T12:00" not in interval["start_interval"]
+            ]
+            return meter_intervals
+
+        get_rest_req.side_effect = meter_missing_a_read_a_day
+
+        first = await dataset.get_meter_interval_data(
+            datetime(2023, 1, 1), datetime(2023, 4, 1), "1234"
+        )
+        first_requests = get_rest_req.call_count
+        self.assertEqual(first_requests, 3)
+        self.assertEqual(len(first), 90 * 47 + 1)
+
+        # The daily holes were asked for already, so nothing is left to fetch
+        second = await dataset.get_meter_interval_data(
+            datetime(2023, 1, 1), datetime(2023, 4, 1), "1234"
+        )
+        self.assertEqual(get_rest_req.call_count, first_requests)
+        self.assertEqual(second, first)
+
+    @patch("dataset.get_rest_req")
+    async def test_long_window_chunked_without_gaps_or_duplicates(self, get_rest_req):
+        get_rest_req.side_effect = stand_in_generation_mix
+        dataset.set_cache(None)
+
+        generation_mix_data = await dataset.get_generation_mix_data(
+            datetime(2023, 1, 1), datetime(2023, 3, 1)
+        )
+
+        # 59 days at the 14 day cap needs 5 requests
+        self.assertEqual(get_rest_req.call_count, 5)
+        self.assertEqual(len(generation_mix_data), 59 * 48 + 1)
+        self.assertEqual(
+            list(generation_mix_data),
+            [
+                helper.half_hour_to_timestamp(half_hour)
+                for half_hour in helper.half_hour_window(
+                    datetime(2023, 1, 1), datetime(2023, 3, 1)
+                )
+            ],
+        )
+
+    @patch("dataset.get_rest_req")
+    async def test_failed_chunk_retried_on_its_own(self, get_rest_req):
+        failures = {"2023-01-15": 1, "2023-02-12": 10}
+
+        def flaky_generation_mix(api_url: str, **kwargs) -> dict:
+            for chunk_start in failures:
+                if f"/generation/{chunk_start}" in api_url and failures[chunk_start]:
+                    failures[chunk_start] -= 1
+                    raise dataset.RestRequestError("Service Unavailable", 503)
+            return stand_in_generation_mix(api_url)
+
+        get_rest_req.side_effect = flaky_generation_mix
+
+        with patch.object(dataset.get_client(), "backoff", 0):
+            with self.assertRaises(dataset.RestRequestError):
+                await dataset.get_generation_mix_data(
+                    datetime(2023, 1, 1), datetime(2023, 3, 1)
+                )
+
+            # 5 chunks, the first failure recovers on a retry of that chunk
+            # alone and the chunk that keeps failing is tried 1 + CHUNK_RETRIES times
+            self.assertEqual(get_rest_req.call_count, 5 + 1 + dataset.CHUNK_RETRIES)
+
+            # Everything that did arrive was kept, so only the failed chunk is left
+            failures["2023-02-12"] = 0
+            get_rest_req.reset_mock()
+            generation_mix_data = await dataset.get_generation_mix_data(
+                datetime(2023, 1, 1), datetime(2023, 3, 1)
+            )
+
+        self.assertEqual(get_rest_req.call_count, 1)
+        self.assertEqual(len(generation_mix_data), 59 * 48 + 1)
+
+
+class TestIntervalAlignment(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.intervals = [
+            helper.half_hour_to_timestamp(half_hour)
+            for half_hour in helper.half_hour_window(
+                datetime(2023, 1, 1), datetime(2023, 1, 1, 2)
+            )
+        ]
+        self.meter_interval_data = {
+            interval: {"consumption": "10", "consumption_units": "kWh"}
+            for interval in self.intervals
+        }
+
+    def test_gaps_found_either_side(self):
+        generation_mix_data = {
+            interval: {"gas": 40, "wind": 60} for interval in self.intervals[1:]
+        }
+        generation_mix_data["2023-01-01T0230"] = {"gas": 40, "wind": 60}
+        del generation_mix_data[self.intervals[2]]
+
+        missing_intervals, extra_intervals = dataset.align_intervals(
+            self.meter_interval_data, generation_mix_data
+        )
+
+        self.assertEqual(
+            [interval for _, interval in missing_intervals],
+            [self.intervals[0], self.intervals[2]],
+        )
+        self.assertEqual(
+            extra_intervals,
+            [(helper.timestamp_to_half_hour("2023-01-01T0230"), "2023-01-01T0230")],
+        )
+        self.assertFalse(
+            dataset.validate_openvolt_nationalgrid_datasets(
+                self.meter_interval_data, generation_mix_data
+            )
+        )
+
+    async def test_gaps_interpolated_or_carried_forward(self):
+        generation_mix_data = {
+            self.intervals[1]: {"gas": 40, "wind": 60},
+            self.intervals[3]: {"gas": 20, "wind": 80},
+        }
+
+        interpolated = await dataset.fill_generation_mix_gaps(
+            self.meter_interval_data, generation_mix_data, "interpolate"
+        )
+        carried_forward = await dataset.fill_generation_mix_gaps(
+            self.meter_interval_data, generation_mix_data, "carry_forward"
+        )
+
+        self.assertEqual(list(interpolated), self.intervals)
+        self.assertEqual(
+            list(interpolated.values()),
+            [
+                {"gas": 40, "wind": 60},
+                {"gas": 40, "wind": 60},
+                {"gas": 30, "wind": 70},
+                {"gas": 20, "wind": 80},
+                {"gas": 20, "wind": 80},
+            ],
+        )
+        self.assertEqual(carried_forward[self.intervals[2]], {"gas": 40, "wind": 60})
+
+        # The shared dataset itself is left alone
+        self.assertEqual(len(generation_mix_data), 2)
+
+    @patch("dataset.get_rest_req")
+    async def test_refetch_only_missing_intervals(self, get_rest_req):
+        get_rest_req.side_effect = stand_in_generation_mix
+
+        generation_mix_data = await dataset.get_generation_mix_data(
+            datetime(2023, 1, 1), datetime(2023, 1, 1, 2)
+        )
+        partial_generation_mix_data = {
+            interval: generation_mix
+            for interval, generation_mix in generation_mix_data.items()
+            if interval not in [self.intervals[1], self.intervals[2]]
+        }
+        get_rest_req.reset_mock()
+
+        self.assertEqual(
+            await dataset.fill_generation_mix_gaps(
+                self.meter_interval_data, partial_generation_mix_data, "refetch"
+            ),
+            generation_mix_data,
+        )
+
+        # The two missing intervals next to each other come back in one request
+        get_rest_req.assert_called_once()
+        self.assertIn(
+            "/generation/2023-01-01T00:30:00/2023-01-01T01:30:00",
+            get_rest_req.call_args.kwargs["api_url"],
+        )
+
+
+class TestHttpClient(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInApiHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1/meters"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retry_after_capped_at_max_backoff(self):
+        client = HttpClient(max_backoff=5)
+
+        for retry_after in ["3600", "Wed, 21 Oct 2099 07:28:00 GMT"]:
+            response = MagicMock()
+            response.headers = {"Retry-After": retry_after}
+
+            with self.subTest(retry_after=retry_after):
+                self.assertEqual(
+                    client.retry_delay(0, response, api_url=self.api_url), 5
+                )
+
+        # The host is held back no longer than the capped delay either
+        throttle = client._get_throttle(self.api_url)
+        self.assertLessEqual(throttle.next_time, time.monotonic() + 5)
+        client.close()
+
+    async def test_keep_alive_reuses_connection(self):
+        client = HttpClient(max_concurrent_requests=1)
+
+        for _ in range(3):
+            await dataset.get_rest_req(self.api_url, validation="data", client=client)
+
+        stats = list(client.connection_stats().values())[0]
+        client.close()
+
+        self.assertEqual(stats, {"requests": 3, "opened": 1, "reused": 2, "hedged": 0})
+
+    async def test_no_keep_alive_opens_every_time(self):
+        client = HttpClient(max_concurrent_requests=1, keep_alive=False)
+
+        for _ in range(3):
+            await dataset.get_rest_req(self.api_url, validation="data", client=client)
+
+        stats = list(client.connection_stats().values())[0]
+        client.close()
+
+        self.assertEqual(stats, {"requests": 3, "opened": 3, "reused": 0, "hedged": 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
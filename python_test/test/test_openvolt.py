@@ -1,12 +1,85 @@
 import unittest
 from unittest.mock import patch
 
+import os
+import sys
+import csv
+import json
+import logging
+import pickle
+import weakref
+import subprocess
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
 import openvolt_reporting
+import dataset
+import carbon_factors
+import columnar
+import pipeline
+import parallel
+import helper
+import metrics
+import service
+import results_store
+import diagnostics
+
+from datetime import datetime, timedelta, timezone
+
+SAMPLE_DATA_PREFIX = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "davem_6514167223e3d1424bf82742",
+)
+
 
-from datetime import datetime
+def load_sample_datasets() -> tuple:
+    # Rebuild the meter interval and generation mix datasets for January 2023
+    # from the exported sample data streams
+
+    meter_interval_data = {}
+    generation_mix_data = {}
+
+    with open(f"{SAMPLE_DATA_PREFIX}_meter_interval.csv", newline="") as csv_file:
+        for row in csv.reader(csv_file):
+            if row[0][:2] == "20":
+                meter_interval_data[row[0]] = {
+                    "consumption": row[1],
+                    "consumption_units": row[2],
+                }
+
+    with open(f"{SAMPLE_DATA_PREFIX}_generation_mix.csv", newline="") as csv_file:
+        for row in csv.DictReader(csv_file):
+            interval = row.pop("interval")
+            generation_mix_data[interval] = {
+                fuel_type: float(perc) for fuel_type, perc in row.items()
+            }
+
+    return meter_interval_data, generation_mix_data
 
 
 class TestReporting(unittest.IsolatedAsyncioTestCase):
+    carbon_emission_factors = {
+        "biomass": 120,
+        "coal": 937,
+        "dutch imports": 474,
+        "french imports": 53,
+        "gas (combined cycle)": 394,
+        "gas (open cycle)": 651,
+        "hydro": 0,
+        "irish imports": 458,
+        "nuclear": 0,
+        "oil": 935,
+        "other": 300,
+        "pumped storage": 0,
+        "solar": 0,
+        "wind": 0,
+        "imports": 328.3333333333333,
+        "gas": 522.5,
+    }
+
     def setUp(self):
         self.start_date = datetime.strptime("2023-01-01 00:00", "%Y-%m-%d %H:%M")
         self.end_date = datetime.strptime("2023-01-01 02:00", "%Y-%m-%d %H:%M")
@@ -42,25 +115,6 @@ class TestReporting(unittest.IsolatedAsyncioTestCase):
 
         self.meters_empty = {}
 
-        self.carbon_emission_factors = {
-            "biomass": 120,
-            "coal": 937,
-            "dutch imports": 474,
-            "french imports": 53,
-            "gas (combined cycle)": 394,
-            "gas (open cycle)": 651,
-            "hydro": 0,
-            "irish imports": 458,
-            "nuclear": 0,
-            "oil": 935,
-            "other": 300,
-            "pumped storage": 0,
-            "solar": 0,
-            "wind": 0,
-            "imports": 328.3333333333333,
-            "gas": 522.5,
-        }
-
         self.meter_interval_data = {
             "2023-01-01T0000": {
                 "start_interval": "2023-01-01T00:00:00.000Z",
@@ -238,6 +292,1155 @@ class TestReporting(unittest.IsolatedAsyncioTestCase):
             "Carbon emission TOTAL results are wrong",
         )
 
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_stage_metrics(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        get_meters.return_value = self.meters
+        get_carbon_emission_factors.return_value = self.carbon_emission_factors
+        get_meter_interval_data.return_value = self.meter_interval_data
+        get_generation_mix_data.return_value = self.generation_mix_data
+
+        events = []
+        report_metrics = metrics.Metrics(hook=events.append)
+        metrics.set_metrics(report_metrics)
+
+        await openvolt_reporting.generate_reports(
+            self.start_date, self.end_date, self.customer_id, None, None
+        )
+
+        self.assertEqual(
+            list(report_metrics.summary()["stages"]),
+            [
+                "meters",
+                "emission_factors",
+                "meter_intervals",
+                "generation_mix",
+                "validation",
+                "consumption_report",
+                "emissions_report",
+                "totals",
+            ],
+        )
+        self.assertEqual(
+            [event["stage"] for event in events][-3:],
+            ["consumption_report", "emissions_report", "totals"],
+        )
+
+    @unittest.skipUnless(columnar.is_available(), "columnar engine needs numpy")
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_columnar_engine_matches(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        get_meters.return_value = self.meters
+        get_carbon_emission_factors.return_value = self.carbon_emission_factors
+        get_meter_interval_data.return_value = self.meter_interval_data
+        get_generation_mix_data.return_value = self.generation_mix_data
+
+        (
+            test_consumption_source_report_totals,
+            test_carbon_emissions_report_totals,
+        ) = await openvolt_reporting.generate_reports(
+            self.start_date,
+            self.end_date,
+            self.customer_id,
+            meter_id=None,
+            output_file=None,
+            engine="columnar",
+        )
+
+        self.assertDictEqual(
+            test_consumption_source_report_totals,
+            self.consumption_source_report_totals,
+        )
+        self.assertDictEqual(
+            test_carbon_emissions_report_totals,
+            self.carbon_emissions_report_totals,
+        )
+
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_batch_shares_factors_and_generation_mix(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        async def batch_get_meters(customer_id=None, meter_id=None):
+            if customer_id == "unknown":
+                raise ValueError("Error making REST request")
+            return self.meters
+
+        get_meters.side_effect = batch_get_meters
+        get_carbon_emission_factors.return_value = self.carbon_emission_factors
+        get_meter_interval_data.return_value = self.meter_interval_data
+        get_generation_mix_data.return_value = self.generation_mix_data
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            batch_file = os.path.join(output_dir, "batch.txt")
+            with open(batch_file, "w") as batch_lines:
+                batch_lines.write("# customers\n5678\n\nunknown\nmeter:1234\n")
+
+            batch_results = await openvolt_reporting.generate_batch_reports(
+                openvolt_reporting.read_batch_file(batch_file),
+                self.start_date,
+                self.end_date,
+                output_dir,
+                concurrency=2,
+            )
+
+            with open(os.path.join(output_dir, "meter_1234.json")) as json_file:
+                meter_report = json.load(json_file)
+
+            self.assertFalse(
+                os.path.exists(os.path.join(output_dir, "customer_unknown.json"))
+            )
+
+        get_carbon_emission_factors.assert_called_once()
+        get_generation_mix_data.assert_called_once()
+
+        self.assertEqual(
+            list(batch_results),
+            ["customer_5678", "customer_unknown", "meter_1234"],
+        )
+        self.assertIsNone(batch_results["customer_unknown"])
+        self.assertDictEqual(
+            batch_results["customer_5678"][0],
+            self.consumption_source_report_totals,
+        )
+        self.assertDictEqual(
+            meter_report["carbon_emissions_report_totals"],
+            self.carbon_emissions_report_totals,
+        )
+
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_streamed_totals_match(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        get_meters.return_value = self.meters
+        get_carbon_emission_factors.return_value = self.carbon_emission_factors
+        get_meter_interval_data.return_value = self.meter_interval_data
+        get_generation_mix_data.return_value = self.generation_mix_data
+
+        (
+            test_consumption_source_report_totals,
+            test_carbon_emissions_report_totals,
+        ) = await openvolt_reporting.generate_reports(
+            self.start_date,
+            self.end_date,
+            self.customer_id,
+            meter_id=None,
+            output_file=None,
+            stream=True,
+        )
+
+        self.assertDictEqual(
+            test_consumption_source_report_totals,
+            self.consumption_source_report_totals,
+        )
+        self.assertDictEqual(
+            test_carbon_emissions_report_totals,
+            self.carbon_emissions_report_totals,
+        )
+
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_generation_mix_gap_policy(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        # NationalGrid are missing the middle interval
+        generation_mix_data = dict(self.generation_mix_data)
+        del generation_mix_data[list(generation_mix_data)[2]]
+
+        get_meters.return_value = self.meters
+        get_carbon_emission_factors.return_value = self.carbon_emission_factors
+        get_meter_interval_data.return_value = self.meter_interval_data
+        get_generation_mix_data.return_value = generation_mix_data
+
+        with self.assertRaises(ValueError):
+            await openvolt_reporting.generate_reports(
+                self.start_date, self.end_date, self.customer_id, None, None
+            )
+
+        for stream in [False, True]:
+            with self.subTest(stream=stream):
+                (
+                    consumption_source_report_totals,
+                    _,
+                ) = await openvolt_reporting.generate_reports(
+                    self.start_date,
+                    self.end_date,
+                    self.customer_id,
+                    None,
+                    None,
+                    stream=stream,
+                    gap_policy="carry_forward",
+                )
+
+                self.assertEqual(
+                    consumption_source_report_totals["1234"]["total"],
+                    self.consumption_source_report_totals["1234"]["total"],
+                )
+
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_shared_generation_mix_filled_once(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        # Five meters in one region share a generation mix missing an interval
+        generation_mix_data = dict(self.generation_mix_data)
+        del generation_mix_data[list(generation_mix_data)[2]]
+
+        get_meters.return_value = {
+            f"meter_{index}": {"address": "123 Fake Street, London, SW1A 3AB"}
+            for index in range(5)
+        }
+        get_carbon_emission_factors.return_value = self.carbon_emission_factors
+        get_meter_interval_data.return_value = self.meter_interval_data
+
+        for gap_policy in ["refetch", "carry_forward"]:
+            for stream in [False, True]:
+                with self.subTest(gap_policy=gap_policy, stream=stream):
+                    get_generation_mix_data.reset_mock()
+                    get_generation_mix_data.side_effect = [
+                        generation_mix_data,
+                        self.generation_mix_data,
+                    ]
+
+                    with patch(
+                        "dataset.fill_generation_mix_gaps",
+                        wraps=dataset.fill_generation_mix_gaps,
+                    ) as fill_generation_mix_gaps:
+                        (
+                            consumption_source_report_totals,
+                            _,
+                        ) = await openvolt_reporting.generate_reports(
+                            self.start_date,
+                            self.end_date,
+                            self.customer_id,
+                            None,
+                            None,
+                            stream=stream,
+                            gap_policy=gap_policy,
+                        )
+
+                    # One download, then the gap filled (and refetched) once
+                    self.assertEqual(fill_generation_mix_gaps.call_count, 1)
+                    self.assertEqual(
+                        get_generation_mix_data.call_count,
+                        2 if gap_policy == "refetch" else 1,
+                    )
+                    self.assertEqual(len(consumption_source_report_totals), 5)
+
+
+class TestReportEngines(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.meter_interval_data, self.generation_mix_data = load_sample_datasets()
+        self.carbon_emission_factors = TestReporting.carbon_emission_factors
+
+    def get_dict_reports(self) -> tuple:
+        consumption_source = openvolt_reporting.get_consumption_source_report(
+            self.meter_interval_data, self.generation_mix_data
+        )
+        carbon_emissions = openvolt_reporting.get_carbon_emissions_report(
+            self.meter_interval_data, consumption_source, self.carbon_emission_factors
+        )
+        return (
+            consumption_source,
+            carbon_emissions,
+            *openvolt_reporting.get_report_totals(consumption_source, carbon_emissions),
+        )
+
+    def test_fused_matches_dict_on_sample_month(self):
+        dict_reports = self.get_dict_reports()
+
+        self.assertEqual(
+            openvolt_reporting.get_fused_report(
+                self.meter_interval_data,
+                self.generation_mix_data,
+                self.carbon_emission_factors,
+                keep_intervals=True,
+            ),
+            dict_reports,
+        )
+        self.assertEqual(
+            openvolt_reporting.get_fused_report(
+                self.meter_interval_data,
+                self.generation_mix_data,
+                self.carbon_emission_factors,
+            ),
+            ({}, {}, *dict_reports[2:]),
+        )
+
+    def test_reports_read_compact_records(self):
+        dict_reports = self.get_dict_reports()
+
+        self.meter_interval_data = {
+            interval: helper.MeterInterval.from_api(
+                helper.timestamp_to_half_hour(interval), interval_data
+            )
+            for interval, interval_data in self.meter_interval_data.items()
+        }
+
+        self.assertEqual(self.get_dict_reports(), dict_reports)
+        self.assertEqual(
+            openvolt_reporting.get_fused_report(
+                self.meter_interval_data,
+                self.generation_mix_data,
+                self.carbon_emission_factors,
+            )[2:],
+            dict_reports[2:],
+        )
+
+    @unittest.skipUnless(columnar.is_available(), "columnar engine needs numpy")
+    def test_columnar_matches_dict_on_sample_month(self):
+        self.assertEqual(len(self.meter_interval_data), 1489)
+        self.assertEqual(
+            columnar.get_reports(
+                self.meter_interval_data,
+                self.generation_mix_data,
+                self.carbon_emission_factors,
+            ),
+            self.get_dict_reports(),
+        )
+
+    async def test_process_pool_matches_serial(self):
+        # Two meters share a generation mix and one has its own copy
+        records = {
+            interval: helper.MeterInterval.from_api(
+                helper.timestamp_to_half_hour(interval), interval_data
+            )
+            for interval, interval_data in self.meter_interval_data.items()
+        }
+        meter_datasets = [
+            (self.meter_interval_data, self.generation_mix_data),
+            (records, self.generation_mix_data),
+            (self.meter_interval_data, dict(self.generation_mix_data)),
+        ]
+        dict_reports = self.get_dict_reports()
+
+        engines = ["dict", "fused"] + (["columnar"] if columnar.is_available() else [])
+        for engine in engines:
+            for keep_intervals in [True, False]:
+                with self.subTest(engine=engine, keep_intervals=keep_intervals):
+                    expected = (
+                        dict_reports if keep_intervals else ({}, {}, *dict_reports[2:])
+                    )
+                    self.assertEqual(
+                        await parallel.get_reports(
+                            meter_datasets,
+                            self.carbon_emission_factors,
+                            2,
+                            engine=engine,
+                            keep_intervals=keep_intervals,
+                        ),
+                        [expected] * 3,
+                    )
+
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_streamed_chunks_match_dict_on_sample_month(
+        self, get_generation_mix_data, get_meter_interval_data
+    ):
+        def window_of(data: dict, start_date: datetime, end_date: datetime) -> dict:
+            window = helper.half_hour_window(start_date, end_date)
+            return {
+                interval: data[interval]
+                for interval in data
+                if helper.timestamp_to_half_hour(interval) in window
+            }
+
+        async def chunk_meter_intervals(start_date, end_date, meter_id):
+            return window_of(self.meter_interval_data, start_date, end_date)
+
+        async def chunk_generation_mix(start_date, end_date, postcode_region=None):
+            return window_of(self.generation_mix_data, start_date, end_date)
+
+        get_meter_interval_data.side_effect = chunk_meter_intervals
+        get_generation_mix_data.side_effect = chunk_generation_mix
+
+        chunks = []
+        async for meter, chunk_start, chunk_end, totals in pipeline.stream_reports(
+            datetime(2023, 1, 1),
+            datetime(2023, 2, 1),
+            {"1234": {"address": "123 Fake Street, London, SW1A 3AB"}},
+            self.carbon_emission_factors,
+            chunk_window=timedelta(days=7),
+        ):
+            chunks.append(chunk_start)
+
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(
+            (totals.consumption_source, totals.carbon_emissions),
+            self.get_dict_reports()[2:],
+        )
+
+    @patch.dict(diagnostics._event_counts, clear=True)
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_stream_meter_installed_mid_window(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        # The meter has no data until the 10th, so its first chunk is empty
+        installed = helper.datetime_to_half_hour(datetime(2023, 1, 10))
+
+        async def meter_intervals(start_date, end_date, meter_id):
+            window = helper.half_hour_window(start_date, end_date)
+            return {
+                interval: interval_data
+                for interval, interval_data in self.meter_interval_data.items()
+                if helper.timestamp_to_half_hour(interval) in window
+                and helper.timestamp_to_half_hour(interval) >= installed
+            }
+
+        async def generation_mix(start_date, end_date, postcode_region=None):
+            window = helper.half_hour_window(start_date, end_date)
+            return {
+                interval: mix
+                for interval, mix in self.generation_mix_data.items()
+                if helper.timestamp_to_half_hour(interval) in window
+            }
+
+        get_meters.return_value = {
+            "1234": {"address": "123 Fake Street, London, SW1A 3AB"}
+        }
+        get_carbon_emission_factors.return_value = self.carbon_emission_factors
+        get_meter_interval_data.side_effect = meter_intervals
+        get_generation_mix_data.side_effect = generation_mix
+
+        results = {}
+        for stream in [False, True]:
+            with self.assertLogs(level=logging.INFO) as logs:
+                results[stream] = await openvolt_reporting.generate_reports(
+                    datetime(2023, 1, 1),
+                    datetime(2023, 2, 1),
+                    "12345678901234567890",
+                    None,
+                    None,
+                    stream=stream,
+                )
+
+        self.assertEqual(results[True], results[False])
+        self.assertIn(
+            'stream_chunk_totals meter=1234 chunk_end="2023-01-07 23:30:00" kwh=0 co2_kg=0 seen=1',
+            [record.getMessage() for record in logs.records],
+        )
+
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_bucket_totals_match_across_engines(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        def window_of(data: dict, start_date: datetime, end_date: datetime) -> dict:
+            window = helper.half_hour_window(start_date, end_date)
+            return {
+                interval: data[interval]
+                for interval in data
+                if helper.timestamp_to_half_hour(interval) in window
+            }
+
+        async def meter_intervals(start_date, end_date, meter_id):
+            return window_of(self.meter_interval_data, start_date, end_date)
+
+        async def generation_mix(start_date, end_date, postcode_region=None):
+            return window_of(self.generation_mix_data, start_date, end_date)
+
+        get_meters.return_value = {
+            meter: {"address": "123 Fake Street, London, SW1A 3AB"}
+            for meter in ["1234", "5678"]
+        }
+        get_carbon_emission_factors.return_value = self.carbon_emission_factors
+        get_meter_interval_data.side_effect = meter_intervals
+        get_generation_mix_data.side_effect = generation_mix
+
+        runs = {
+            "dict": {},
+            "fused": {"engine": "fused"},
+            "stream": {"stream": True},
+            "workers": {"workers": 2},
+        }
+        if columnar.is_available():
+            runs["columnar"] = {"engine": "columnar"}
+            runs["columnar_workers"] = {"engine": "columnar", "workers": 2}
+
+        results = {}
+        for run, options in runs.items():
+            results[run] = await openvolt_reporting.generate_reports(
+                datetime(2023, 1, 1),
+                datetime(2023, 2, 1),
+                "12345678901234567890",
+                None,
+                None,
+                bucket_sizes=pipeline.BUCKET_SIZES,
+                **options,
+            )
+
+        for run in runs:
+            with self.subTest(run=run):
+                self.assertEqual(results[run], results["dict"])
+
+        consumption_source_totals, _, bucket_report_totals = results["dict"]
+        buckets = bucket_report_totals["1234"]
+
+        # 1 Jan 2023 is a Sunday, the window ends on the first interval of February
+        self.assertEqual(len(buckets["daily"]), 32)
+        self.assertEqual(list(buckets["weekly"])[:2], ["2022-W52", "2023-W01"])
+        self.assertEqual(list(buckets["monthly"]), ["2023-01", "2023-02"])
+        self.assertEqual(list(buckets["peak"]), ["off_peak", "peak"])
+
+        # Every interval lands in one bucket of each size
+        for bucket_size in pipeline.BUCKET_SIZES:
+            self.assertEqual(
+                sum(
+                    totals["consumption_source"]["total"]
+                    for totals in buckets[bucket_size].values()
+                ),
+                consumption_source_totals["1234"]["total"],
+            )
+
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_results_store_answers_repeat_reports(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        def window_of(data: dict, start_date: datetime, end_date: datetime) -> dict:
+            window = helper.half_hour_window(start_date, end_date)
+            return {
+                interval: data[interval]
+                for interval in data
+                if helper.timestamp_to_half_hour(interval) in window
+            }
+
+        async def meter_intervals(start_date, end_date, meter_id):
+            return window_of(self.meter_interval_data, start_date, end_date)
+
+        async def generation_mix(start_date, end_date, postcode_region=None):
+            return window_of(self.generation_mix_data, start_date, end_date)
+
+        get_meters.return_value = {
+            meter: {"address": "123 Fake Street, London, SW1A 3AB"}
+            for meter in ["1234", "5678"]
+        }
+        get_carbon_emission_factors.return_value = self.carbon_emission_factors
+        get_meter_interval_data.side_effect = meter_intervals
+        get_generation_mix_data.side_effect = generation_mix
+
+        async def generate(start_date, end_date, **options) -> list:
+            return await openvolt_reporting.generate_reports(
+                start_date,
+                end_date,
+                "12345678901234567890",
+                None,
+                None,
+                bucket_sizes=pipeline.BUCKET_SIZES,
+                **options,
+            )
+
+        january = (datetime(2023, 1, 1), datetime(2023, 2, 1))
+        second_week = (datetime(2023, 1, 8), datetime(2023, 1, 14, 23, 30))
+        expected = {
+            "january": await generate(*january),
+            "second_week": await generate(*second_week),
+        }
+
+        runs = {
+            "dict": {},
+            "fused": {"engine": "fused"},
+            "stream": {"stream": True, "stream_chunk_window": timedelta(days=10)},
+            "workers": {"workers": 2},
+        }
+        if columnar.is_available():
+            runs["columnar"] = {"engine": "columnar"}
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for run, options in runs.items():
+                with self.subTest(run=run):
+                    store = results_store.ResultsStore(
+                        os.path.join(temp_dir, f"{run}.sqlite")
+                    )
+
+                    # Worked out from the APIs and stored the first time
+                    self.assertEqual(
+                        await generate(*january, results_store=store, **options),
+                        expected["january"],
+                    )
+
+                    # Then answered from the store alone, whole or in part
+                    get_meters.reset_mock()
+                    get_meter_interval_data.reset_mock()
+                    get_generation_mix_data.reset_mock()
+
+                    for window in ["january", "second_week"]:
+                        self.assertEqual(
+                            await generate(
+                                *(january if window == "january" else second_week),
+                                results_store=store,
+                            ),
+                            expected[window],
+                        )
+
+                    get_meters.assert_not_called()
+                    get_meter_interval_data.assert_not_called()
+                    get_generation_mix_data.assert_not_called()
+
+                    # A window the store doesn't cover goes to the APIs
+                    await generate(
+                        datetime(2023, 1, 31), datetime(2023, 2, 2), results_store=store
+                    )
+                    get_meters.assert_called_once()
+
+                    store.close()
+
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    async def test_results_store_fills_in_later_data(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        start_date = datetime(2023, 1, 1)
+        end_date = datetime(2023, 1, 1, 2)
+        window = helper.half_hour_window(start_date, end_date)
+        meter_data_to = [helper.timestamp_to_half_hour("2023-01-01T0100")]
+
+        async def meter_intervals(start_date, end_date, meter_id):
+            # Only the intervals published so far
+            return {
+                interval: self.meter_interval_data[interval]
+                for interval in self.meter_interval_data
+                if helper.timestamp_to_half_hour(interval) in window
+                and helper.timestamp_to_half_hour(interval) <= meter_data_to[0]
+            }
+
+        async def generation_mix(start_date, end_date, postcode_region=None):
+            return {
+                interval: self.generation_mix_data[interval]
+                for interval in self.generation_mix_data
+                if helper.timestamp_to_half_hour(interval) in window
+            }
+
+        get_meters.return_value = {
+            "1234": {"address": "123 Fake Street, London, SW1A 3AB"}
+        }
+        get_carbon_emission_factors.return_value = self.carbon_emission_factors
+        get_meter_interval_data.side_effect = meter_intervals
+        get_generation_mix_data.side_effect = generation_mix
+
+        async def generate(store) -> list:
+            return await openvolt_reporting.generate_reports(
+                start_date,
+                end_date,
+                "12345678901234567890",
+                None,
+                None,
+                results_store=store,
+            )
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = results_store.ResultsStore(os.path.join(temp_dir, "r.sqlite"))
+
+            partial = await generate(store)
+
+            # The rest of the data arrives, the gap sends the report to the APIs
+            meter_data_to[0] = window[-1]
+            expected = await generate(None)
+            get_meter_interval_data.reset_mock()
+
+            self.assertEqual(await generate(store), expected)
+            self.assertNotEqual(partial, expected)
+            get_meter_interval_data.assert_called_once()
+
+            # Now every half-hour is held it comes from the store
+            get_meter_interval_data.reset_mock()
+            self.assertEqual(await generate(store), expected)
+            get_meter_interval_data.assert_not_called()
+
+            # Unfinished half-hours are never stored, so never answered from it
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            window = helper.half_hour_window(now - timedelta(hours=2), now)
+            store.put_emissions_intervals(
+                "1234",
+                window[0],
+                window[-1],
+                [
+                    (helper.half_hour_to_timestamp(half_hour), 1, {}, 0.0, {})
+                    for half_hour in window
+                ],
+            )
+            self.assertFalse(store.covers("1234", window[0], window[-1]))
+
+            store.close()
+
+
+class TestCarbonFactors(unittest.TestCase):
+    def setUp(self):
+        self.sub_fuel_factors = {
+            fuel_type: factor
+            for fuel_type, factor in TestReporting.carbon_emission_factors.items()
+            if fuel_type not in ["imports", "gas"]
+        }
+
+    def test_fuel_buckets_averaged(self):
+        self.assertEqual(
+            carbon_factors.combine_fuel_buckets(self.sub_fuel_factors),
+            TestReporting.carbon_emission_factors,
+        )
+
+    def test_fuel_buckets_weighted(self):
+        carbon_emission_factors = carbon_factors.combine_fuel_buckets(
+            self.sub_fuel_factors,
+            {
+                "gas": {"gas (combined cycle)": 3, "gas (open cycle)": 1},
+                "imports": ["french imports", "norwegian imports"],
+            },
+        )
+
+        self.assertEqual(carbon_emission_factors["gas"], (394 * 3 + 651) / 4)
+        self.assertEqual(carbon_emission_factors["imports"], 53)
+
+    def test_partial_fuel_buckets_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "fuel_buckets.json")
+            with open(path, "w") as json_file:
+                json.dump(
+                    {"gas": {"gas (combined cycle)": 3, "gas (open cycle)": 1}},
+                    json_file,
+                )
+
+            fuel_buckets = carbon_factors.load_fuel_buckets(path)
+
+        # Buckets the file leaves out keep their defaults
+        self.assertEqual(
+            fuel_buckets["imports"], carbon_factors.FUEL_BUCKETS["imports"]
+        )
+
+        carbon_emission_factors = carbon_factors.combine_fuel_buckets(
+            self.sub_fuel_factors, fuel_buckets
+        )
+        self.assertEqual(carbon_emission_factors["gas"], (394 * 3 + 651) / 4)
+        self.assertEqual(
+            carbon_emission_factors["imports"],
+            TestReporting.carbon_emission_factors["imports"],
+        )
+
+        # A fuel left without a factor fails clearly rather than with a KeyError
+        factor_vector = carbon_factors.CarbonFactorVector(self.sub_fuel_factors)
+        with self.assertRaisesRegex(ValueError, "imports"):
+            factor_vector.get_fuel_vector(["gas", "imports"])
+
+    def test_vectors_follow_each_intervals_fuel_order(self):
+        meter_interval_data, generation_mix_data = load_sample_datasets()
+
+        # Every other interval lists its fuels the other way round
+        generation_mix_data = {
+            interval: (
+                dict(reversed(generation_mix.items())) if index % 2 else generation_mix
+            )
+            for index, (interval, generation_mix) in enumerate(
+                generation_mix_data.items()
+            )
+        }
+
+        factor_vector = carbon_factors.CarbonFactorVector(
+            TestReporting.carbon_emission_factors
+        )
+        interval_vectors = factor_vector.get_interval_vectors(generation_mix_data)
+
+        # Resolved once per fuel order and once per generation mix dataset
+        self.assertEqual(len(set(map(id, interval_vectors.values()))), 2)
+        self.assertIs(
+            factor_vector.get_interval_vectors(generation_mix_data), interval_vectors
+        )
+
+        consumption_source = openvolt_reporting.get_consumption_source_report(
+            meter_interval_data, generation_mix_data
+        )
+        carbon_emissions = openvolt_reporting.get_carbon_emissions_report(
+            meter_interval_data, consumption_source, factor_vector
+        )
+
+        self.assertEqual(
+            openvolt_reporting.get_fused_report(
+                meter_interval_data,
+                generation_mix_data,
+                factor_vector,
+                keep_intervals=True,
+            ),
+            (
+                consumption_source,
+                carbon_emissions,
+                *openvolt_reporting.get_report_totals(
+                    consumption_source, carbon_emissions
+                ),
+            ),
+        )
+
+        # The dict engine reads the same vectors given the generation mix
+        self.assertEqual(
+            openvolt_reporting.get_carbon_emissions_report(
+                meter_interval_data,
+                consumption_source,
+                factor_vector,
+                generation_mix_data,
+            ),
+            carbon_emissions,
+        )
+
+    def test_interval_vectors_kept_per_report(self):
+        _, generation_mix_data = load_sample_datasets()
+
+        factor_vector = carbon_factors.CarbonFactorVector(
+            TestReporting.carbon_emission_factors
+        )
+        first_report = factor_vector.for_report()
+        second_report = factor_vector.for_report()
+
+        interval_vectors = first_report.get_interval_vectors(generation_mix_data)
+
+        # Fuel vectors are shared, interval vectors go with their report
+        self.assertIs(
+            second_report.get_interval_vectors(generation_mix_data)[
+                next(iter(generation_mix_data))
+            ],
+            interval_vectors[next(iter(generation_mix_data))],
+        )
+        self.assertEqual(len(factor_vector._interval_vectors), 0)
+
+        first_report_interval_vectors = weakref.ref(first_report._interval_vectors)
+        del first_report
+        self.assertIsNone(first_report_interval_vectors())
+
+
+class TestReportService(unittest.TestCase):
+    def setUp(self):
+        self.fixtures = TestReporting()
+        self.fixtures.setUp()
+
+        self.service = service.ReportService()
+        self.service.start()
+        self.server = service.ReportServer(("127.0.0.1", 0), self.service)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.stop()
+
+    def get_json(self, path: str) -> tuple:
+        try:
+            with urllib.request.urlopen(self.base_url + path) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+    @patch("dataset.get_meters")
+    @patch("dataset.get_carbon_emission_factors")
+    @patch("dataset.get_meter_interval_data")
+    @patch("dataset.get_generation_mix_data")
+    def test_concurrent_requests_share_warm_data(
+        self,
+        get_generation_mix_data,
+        get_meter_interval_data,
+        get_carbon_emission_factors,
+        get_meters,
+    ):
+        get_meters.return_value = self.fixtures.meters
+        get_carbon_emission_factors.return_value = self.fixtures.carbon_emission_factors
+        get_meter_interval_data.return_value = self.fixtures.meter_interval_data
+        get_generation_mix_data.return_value = self.fixtures.generation_mix_data
+
+        paths = [
+            f"/reports?customer_id={self.fixtures.customer_id}&start_date=2023-01-01&end_date=2023-01-02",
+            f"/reports?meter_id=1234&start_date=2023-01-01&end_date=2023-01-02",
+            f"/reports?meter_id=1234&start_date=2023-01-01&end_date=2023-01-02&buckets=daily",
+        ]
+
+        with ThreadPoolExecutor(len(paths)) as executor:
+            responses = list(executor.map(self.get_json, paths))
+
+        for status, report in responses:
+            self.assertEqual(status, 200)
+            self.assertEqual(
+                report["consumption_source_report_totals"],
+                self.fixtures.consumption_source_report_totals,
+            )
+            self.assertEqual(
+                report["carbon_emissions_report_totals"],
+                self.fixtures.carbon_emissions_report_totals,
+            )
+        self.assertIn(
+            "2023-01-01", responses[2][1]["bucket_report_totals"]["1234"]["daily"]
+        )
+
+        # Factors fetched once, the generation mix downloaded once for every report
+        get_carbon_emission_factors.assert_called_once()
+        get_generation_mix_data.assert_called_once()
+
+        # Asking again is answered from the held result
+        self.assertEqual(self.get_json(paths[1]), responses[1])
+        self.assertEqual(get_meter_interval_data.call_count, 3)
+
+        status, service_status = self.get_json("/status")
+        self.assertEqual(status, 200)
+        self.assertEqual(service_status["reports"], 3)
+        self.assertEqual(service_status["result_hits"], 1)
+
+    def test_bad_requests(self):
+        for path, expected_status in [
+            ("/reports?start_date=2023-01-01&end_date=2023-01-02", 400),
+            ("/reports?meter_id=1234&start_date=2023-01-01", 400),
+            ("/reports?meter_id=1234&start_date=2023-01-01&end_date=20230102", 400),
+            (
+                "/reports?meter_id=1234&start_date=2023-01-01&end_date=2023-01-02&buckets=hourly",
+                400,
+            ),
+            ("/meters", 404),
+        ]:
+            with self.subTest(path=path):
+                status, body = self.get_json(path)
+                self.assertEqual(status, expected_status)
+                self.assertIn("error", body)
+
+
+class TestStartup(unittest.TestCase):
+    def test_heavy_dependencies_loaded_lazily(self):
+        # In a fresh interpreter, as the CLI starts
+        imported = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, openvolt_reporting;"
+                " print(sorted(set(sys.modules) & {'requests', 'numpy', 'multiprocessing', 'argparse'}))",
+            ],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+
+        self.assertEqual(imported, "[]")
+
+    def test_bad_log_level_from_environment(self):
+        completed = subprocess.run(
+            [sys.executable, "openvolt_reporting.py"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env={**os.environ, "OPENVOLT_LOG_LEVEL": "verbose"},
+            capture_output=True,
+            text=True,
+        )
+
+        # Rejected up front as a usage error, before anything is run
+        self.assertEqual(completed.returncode, 2)
+        self.assertIn(
+            "OPENVOLT_LOG_LEVEL must be one of DEBUG, INFO, WARNING, ERROR, got VERBOSE",
+            completed.stderr,
+        )
+        self.assertNotIn("Traceback", completed.stderr)
+
+
+class TestDatastreamExport(unittest.TestCase):
+    meter_interval_data = {
+        "2023-01-01T00:00:00.000Z": {"consumption": 10, "consumption_units": "kWh"},
+        "2023-01-01T00:30:00.000Z": {"consumption": 2.5, "consumption_units": "kWh"},
+    }
+    generation_mix_data = {
+        "2023-01-01T00:00:00.000Z": {"gas": 50.0, "wind": 50.0},
+        "2023-01-01T00:30:00.000Z": {"gas": 25.5, "wind": 74.5},
+    }
+
+    def export(self, output_prefix: str, output_formats: tuple):
+        consumption_source = openvolt_reporting.get_consumption_source_report(
+            self.meter_interval_data, self.generation_mix_data
+        )
+        carbon_emissions = openvolt_reporting.get_carbon_emissions_report(
+            self.meter_interval_data,
+            consumption_source,
+            {"gas": 394, "wind": 0},
+        )
+        helper.output_datastream_to_file(
+            "1234",
+            output_prefix,
+            self.meter_interval_data,
+            self.generation_mix_data,
+            consumption_source,
+            carbon_emissions,
+            output_formats=output_formats,
+        )
+
+    def test_csv_layout_unchanged(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_prefix = os.path.join(output_dir, "export")
+            self.export(output_prefix, ("csv",))
+
+            with open(f"{output_prefix}_1234_meter_interval.csv", newline="") as f:
+                self.assertEqual(
+                    f.read(),
+                    "interval,consumption,consumption_units\r\n"
+                    "2023-01-01T00:00:00.000Z,10,kWh\r\n"
+                    "2023-01-01T00:30:00.000Z,2.5,kWh\r\n",
+                )
+            with open(f"{output_prefix}_1234_carbon_emissions.csv", newline="") as f:
+                self.assertEqual(
+                    f.read(),
+                    "interval,total,gas,wind\r\n"
+                    "2023-01-01T00:00:00.000Z,1970.0,1970.0,0.0\r\n"
+                    "2023-01-01T00:30:00.000Z,251.17500000000004,251.17500000000004,0.0\r\n",
+                )
+            self.assertFalse(os.path.exists(f"{output_prefix}_1234_generation_mix.npz"))
+
+    def test_fractional_consumption_totals(self):
+        dict_reports = openvolt_reporting.get_report_totals(
+            *openvolt_reporting.get_fused_report(
+                self.meter_interval_data,
+                self.generation_mix_data,
+                {"gas": 394, "wind": 0},
+                keep_intervals=True,
+            )[:2]
+        )
+        engine_reports = [
+            openvolt_reporting.get_fused_report(
+                self.meter_interval_data,
+                self.generation_mix_data,
+                {"gas": 394, "wind": 0},
+            )[2:]
+        ]
+        if columnar.is_available():
+            engine_reports.append(
+                columnar.get_reports(
+                    self.meter_interval_data,
+                    self.generation_mix_data,
+                    {"gas": 394, "wind": 0},
+                    keep_intervals=False,
+                )[2:]
+            )
+
+        # Nothing is cut off the 2.5 kWh interval, the total still adds up
+        # to the consumption split across fuels
+        consumption_source_totals = dict_reports[0]
+        self.assertEqual(consumption_source_totals["total"], 12.5)
+        self.assertAlmostEqual(
+            consumption_source_totals["gas"] + consumption_source_totals["wind"], 12.5
+        )
+        for reports in engine_reports:
+            self.assertEqual(reports, dict_reports)
+
+        _, total, _ = next(
+            pipeline.consumption_stage(
+                pipeline.join_intervals(
+                    self.meter_interval_data, self.generation_mix_data
+                )
+            )
+        )
+        self.assertEqual(total, 10)
+        self.assertIsInstance(total, int)
+
+    def test_csv_keeps_api_consumption_text(self):
+        records = {
+            interval: helper.MeterInterval.from_api(
+                helper.timestamp_to_half_hour(interval),
+                {"consumption": consumption, "consumption_units": "kWh"},
+            )
+            for interval, consumption in zip(self.meter_interval_data, ["54.0", "2.50"])
+        }
+        self.assertEqual([record.consumption for record in records.values()], [54, 2.5])
+
+        # Text is kept through a round trip to a worker process too
+        records = pickle.loads(pickle.dumps(records))
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_prefix = os.path.join(output_dir, "export")
+            helper.output_datastream_to_file(
+                "1234", output_prefix, records, self.generation_mix_data, {}, {}
+            )
+
+            with open(f"{output_prefix}_1234_meter_interval.csv", newline="") as f:
+                self.assertEqual(
+                    f.read(),
+                    "interval,consumption,consumption_units\r\n"
+                    "2023-01-01T00:00:00.000Z,54.0,kWh\r\n"
+                    "2023-01-01T00:30:00.000Z,2.50,kWh\r\n",
+                )
+
+    @unittest.skipUnless(columnar.is_available(), "npz export needs numpy")
+    def test_npz_matches_csv(self):
+        import numpy as np
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_prefix = os.path.join(output_dir, "export")
+            self.export(output_prefix, ("csv", "npz"))
+
+            with open(f"{output_prefix}_1234_generation_mix.csv", newline="") as f:
+                rows = list(csv.reader(f))
+
+            with np.load(f"{output_prefix}_1234_generation_mix.npz") as npz:
+                self.assertEqual(npz.files, rows[0])
+                self.assertEqual(
+                    [helper.half_hour_to_timestamp(i) for i in npz["interval"]],
+                    [helper.trim_timestamp(row[0]) for row in rows[1:]],
+                )
+                self.assertEqual(
+                    npz["wind"].tolist(), [float(row[2]) for row in rows[1:]]
+                )
+
 
 if __name__ == "__main__":
     unittest.main()